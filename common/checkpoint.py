@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checkpointing of per-spaxel fit results, so that an interrupted Q3DF run can
+be resumed.
+
+Each result written by FITLOOP carries a hash of the initialization
+parameters that affect the fit and of the spaxel's input data. On resume, a
+spaxel is skipped only if its output file can be read and its hash matches.
+Results are written to a temporary file and renamed into place, so a file
+with the final name is always complete.
+
+The hash must be the same in every process and run, so initialization
+values are hashed by content: numbers, strings, arrays, tables, and
+containers of them. Functions and classes are hashed by module and name.
+Any other object raises an InitializationError; if it doesn't affect the
+fit, list its key in initdat['hashignore'].
+
+:Categories:
+   IFSFIT
+
+"""
+
+import hashlib
+import numpy as np
+import os
+import types
+
+from q3dfit.exceptions import InitializationError
+
+# initialization keys that do not change the fit results
+__ignorekeys = ['argscontplot', 'argspltlin1', 'argspltlin2', 'fcnpltcont',
+                'fcnpltlin', 'label', 'logfile', 'mapdir', 'minoraxispa',
+                'name', 'outdir', 'platescale', 'plotMIR', 'positionangle',
+                'hashignore']
+# values hashed by their repr, which holds no addresses
+__scalartypes = (str, bytes, bool, int, float, complex, np.generic,
+                 type(None))
+# values hashed by module and name
+__namedtypes = (types.FunctionType, types.BuiltinFunctionType, type,
+                types.ModuleType)
+
+
+def __update_hash(h, obj, path='initdat'):
+    # Add obj to the hash by content; path names it in errors
+    if isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            h.update(str(key).encode())
+            __update_hash(h, obj[key], f'{path}[{key!r}]')
+    elif isinstance(obj, (list, tuple)):
+        for k, item in enumerate(obj):
+            __update_hash(h, item, f'{path}[{k}]')
+    elif isinstance(obj, np.ndarray):
+        h.update(str(obj.shape).encode() + str(obj.dtype).encode())
+        # e.g. astropy Quantity
+        if hasattr(obj, 'unit'):
+            h.update(str(obj.unit).encode())
+        if obj.dtype == object:
+            for k, item in enumerate(obj.flat):
+                __update_hash(h, item, f'{path}.flat[{k}]')
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, __scalartypes):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, __namedtypes):
+        h.update(f'{getattr(obj, "__module__", None)}.'
+                 f'{getattr(obj, "__qualname__", obj.__name__)}'.encode())
+    elif hasattr(obj, 'colnames') and hasattr(obj, 'columns'):
+        # astropy Table, e.g. lineratio
+        for name in obj.colnames:
+            h.update(str(name).encode())
+            __update_hash(h, np.asarray(obj[name]), f'{path}[{name!r}]')
+    else:
+        raise InitializationError(f'CHECKPOINT: Can\'t hash {path}, of ' +
+                                  f'type {type(obj).__name__}, the same ' +
+                                  'way in every run. If it doesn\'t ' +
+                                  'affect the fit, add its key to ' +
+                                  "initdat['hashignore'].")
+
+
+def initdathash(initdat):
+    '''
+    Hash of the initialization parameters that affect the fit.
+
+    :Params:
+        initdat: in, required, type=dict
+            Initialization dictionary. Keys listed in
+            initdat['hashignore'] are left out.
+
+    :Returns:
+        Hex digest string.
+    '''
+    # hashed from the content on every call, so that changes to the
+    # dictionary are never missed; this is cheap next to a fit
+    ignore = set(__ignorekeys) | set(initdat.get('hashignore', []))
+    h = hashlib.sha1()
+    __update_hash(h, {k: v for k, v in initdat.items()
+                      if k not in ignore})
+    return h.hexdigest()
+
+
+def fithash(initdat, wave, flux, err, dq, inithash=None):
+    '''
+    Hash identifying the fit of one spaxel: the initialization parameters
+    and the input spectrum.
+
+    :Params:
+        initdat: in, required, type=dict
+            Initialization dictionary.
+        wave, flux, err, dq: in, required, type=dblarr(nwave)
+            Input spectrum, before any masking; see SPAXEL_SPECTRUM.
+        inithash: in, optional, type=string
+            Output of INITDATHASH, if already computed.
+
+    :Returns:
+        Hex digest string.
+    '''
+    if inithash is None:
+        inithash = initdathash(initdat)
+    h = hashlib.sha1(inithash.encode())
+    for arr in [wave, flux, err, dq]:
+        __update_hash(h, np.asarray(arr))
+    return h.hexdigest()
+
+
+def spaxel_spectrum(cube, i, j):
+    '''
+    Flux, error, and DQ of spaxel [i, j] (0-offset), as FITLOOP fits and
+    hashes them: copies, with flux and error in double precision, so that
+    masking them leaves the cube alone.
+    '''
+    if cube.dat.ndim == 1:
+        sl = Ellipsis
+    elif cube.dat.ndim == 2:
+        sl = (slice(None), i)
+    else:
+        # the cube may hold only part of the spaxels
+        sl = (i - cube.col0, j - cube.row0, slice(None))
+    return np.array(cube.dat[sl], dtype=np.float64), \
+        np.array(cube.err[sl], dtype=np.float64), np.array(cube.dq[sl])
+
+
+def fit_label(initdat, cube, i, j):
+    '''
+    Output file name, without the .npy extension, for the fit of spaxel
+    [i, j] (0-offset).
+    '''
+    if cube.dat.ndim == 1:
+        return '{[outdir]}{[label]}'.format(initdat, initdat)
+    elif cube.dat.ndim == 2:
+        return '{[outdir]}{[label]}_{:04d}'.format(initdat, initdat, i+1)
+    return '{[outdir]}{[label]}_{:04d}_{:04d}'.format(initdat, initdat,
+                                                      i+1, j+1)
+
+
+def save_fit(outlab, struct):
+    '''
+    Atomically write the fit results for one spaxel to outlab.npy.
+
+    :Params:
+        outlab: in, required, type=string
+            Output file name, without the .npy extension.
+        struct: in, required, type=dict
+            Output of FITSPEC.
+    '''
+    outfile = outlab + '.npy'
+    tmpfile = f'{outfile}.{os.getpid()}.tmp'
+    with open(tmpfile, 'wb') as fh:
+        np.save(fh, struct)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmpfile, outfile)
+
+
+def fit_is_current(outlab, hash):
+    '''
+    Check whether outlab.npy holds a complete fit with the given hash.
+
+    :Params:
+        outlab: in, required, type=string
+            Output file name, without the .npy extension.
+        hash: in, required, type=string
+            Output of FITHASH for this spaxel.
+
+    :Returns:
+        True if the fit can be reused.
+    '''
+    outfile = outlab + '.npy'
+    if not os.path.isfile(outfile):
+        return False
+    try:
+        struct = np.load(outfile, allow_pickle=True).item()
+    except Exception:
+        return False
+    return isinstance(struct, dict) and struct.get('fithash') == hash
@@ -29,6 +29,9 @@ Take outputs from Q3DF and perform fitting loop.
 :Keywords:
    logfile: in, optional, type=strarr
      Names of log filesone per spaxel.
+   resume: in, optional, type=byte
+     If set, skip the spaxel if its output file holds a complete fit made
+     with the same initialization parameters and input data.
 
 
 :History:
@@ -45,7 +48,12 @@ Take outputs from Q3DF and perform fitting loop.
 """
 
 from q3dfit.exceptions import InitializationError
+from q3dfit.common.checkpoint import fithash, fit_is_current, fit_label, \
+    save_fit, spaxel_spectrum
 from q3dfit.common.fitspec import fitspec
+from q3dfit.common.fitstore import get_store, store_index
+from q3dfit.common.ncompselect import ncompselect
+from q3dfit.common.neighborseed import apply_seed, neighbor_seed
 from q3dfit.common.sepfitpars import sepfitpars
 
 import importlib
@@ -54,7 +62,7 @@ import pdb
 
 
 def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
-            quiet=True, logfile=None):
+            quiet=True, logfile=None, resume=False):
 
     if logfile is None:
         from sys import stdout
@@ -69,22 +77,20 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
     i = colarr[ispax]  # colind, rowind]
     j = rowarr[ispax]  # colind, rowind]
 
+    # Copies, in double precision, so that masking below leaves the cube
+    # alone; the cube may be lazy or single precision
+    flux, err, dq = spaxel_spectrum(cube, i, j)
     if cube.dat.ndim == 1:
         print('[spec]=[1] out of [1]', file=logfile)
-        flux = cube.dat
-        err = cube.err
-        dq = cube.dq
+        gdmask = cube.gdmask[...]
     elif cube.dat.ndim == 2:
         print(f'[spec]=[{i+1}] out of [{cube.ncols}]', file=logfile)
-        flux = cube.dat[:, i]
-        err = cube.err[:, i]
-        dq = cube.dq[:, i]
+        gdmask = cube.gdmask[:, i]
     else:
         print(f'[col,row]=[{i+1},{j+1}] out of [{cube.ncols},{cube.nrows}]',
               file=logfile)
-        flux = cube.dat[i, j, :]
-        err = cube.err[i, j, :]
-        dq = cube.dq[i, j, :]
+        # the cube may hold only part of the spaxels
+        gdmask = cube.gdmask[i - cube.col0, j - cube.row0, :]
 
     errmax = max(err)
 
@@ -95,13 +101,25 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
         j = tmpj
         print(f'Reference coordinate: [col, row]=[{i+1}, {j+1}]', file=logfile)
 
-    if cube.dat.ndim == 1:
-        outlab = '{[outdir]}{[label]}'.format(initdat, initdat)
-    elif cube.dat.ndim == 2:
-        outlab = '{[outdir]}{[label]}_{:04d}'.format(initdat, initdat, i+1)
+    outlab = fit_label(initdat, cube, i, j)
+
+    # Results go to a consolidated store or to one file per spaxel
+    if initdat.get('resultstore', False):
+        store = get_store(initdat)
+        istore, jstore = store_index(cube, i, j)
     else:
-        outlab = '{[outdir]}{[label]}_{:04d}_{:04d}'.format(initdat,
-                                                            initdat, i+1, j+1)
+        store = None
+
+    # Identify this fit by its inputs, and skip it if it's already done
+    spaxhash = fithash(initdat, cube.wave, flux, err, dq)
+    if resume:
+        if store is not None:
+            done = store.is_current(istore, jstore, spaxhash)
+        else:
+            done = fit_is_current(outlab, spaxhash)
+        if done:
+            print('FITLOOP: Fit already done; skipping.', file=logfile)
+            return
 
 #   Apply DQ plane
     if dq.ndim>0:
@@ -132,10 +150,20 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
             for line in initdat['lines']:
                 ncomp[line] = initdat['ncomp'][line][i, j]
 
+        # Best fit among neighbors, to seed initial guesses
+        if initdat.get('neighborseed', False):
+            seed = neighbor_seed(cube, initdat, i, j, store=store)
+            if seed is not None:
+                print('FITLOOP: Seeding initial guesses from neighbor.',
+                      file=logfile)
+        else:
+            seed = None
+
         # First fit
 
         dofit = True
         abortfit = False
+        nfevtot = 0
         while(dofit):
 
             # Make sure ncomp > 0 for at least one line
@@ -172,31 +200,16 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
                 zstar = np.nan
 
 #           regions to ignore in fitting. Set to max(err)
+            gdmask_fit = gdmask
             if initdat.__contains__('cutrange'):
-                if initdat['cutrange'].ndim == 1:
-                    indx_cut = \
-                        np.intersect1d((cube.wave >=
-                                        initdat['cutrange'][0]).nonzero(),
-                                       (cube.wave <=
-                                        initdat['cutrange'][1]).nonzero())
-                    if indx_cut.size != 0:
-                        dq[indx_cut] = 1
-                        err[indx_cut] = errmax*100.
-                elif initdat['cutrange'].ndim == 2:
-                    for k in range(initdat['cutrange'].shape[0]):
-                        indx_cut = \
-                            np.intersect1d((cube.wave >=
-                                            initdat['cutrange']
-                                            [k, 0]).nonzero(),
-                                           (cube.wave <=
-                                            initdat['cutrange']
-                                            [k, 1]).nonzero())
-                        if indx_cut.size != 0:
-                            dq[indx_cut] = 1
-                            err[indx_cut] = errmax*100.
-                else:
+                if initdat['cutrange'].ndim not in [1, 2]:
                     raise InitializationError('CUTRANGE not' +
                                               ' properly specified')
+                # computed once per cube
+                indx_cut = cube.wavemask(initdat['cutrange'])
+                dq[indx_cut] = 1
+                err[indx_cut] = errmax*100.
+                gdmask_fit = gdmask & ~indx_cut
 
             # option to tweak continuum fit
             tweakcntfit = False
@@ -214,16 +227,25 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
                                  [(listlines['name'] == line)]) * \
                         (1. + initdat['zinit_gas'][line][i, j, ])
 
+            # the seed sets starting values only; limits and masks still
+            # come from listlinesz
+            cwvinit = None
+            if seed is not None:
+                cwvinit, siginit_gas, zstar = \
+                    apply_seed(seed, initdat, ncomp, listlinesz, siginit_gas,
+                               zstar)
+
             if not quiet:
                 print('FITLOOP: First call to FITSPEC')
             structinit = fitspec(cube.wave, flux, err, dq, zstar, listlines,
                                  listlinesz, ncomp, specConv, initdat, quiet=quiet,
                                  siglim_gas=siglim_gas,
-                                 siginit_gas=siginit_gas,
-                                 tweakcntfit=tweakcntfit)
+                                 siginit_gas=siginit_gas, cwvinit=cwvinit,
+                                 tweakcntfit=tweakcntfit, gdmask=gdmask_fit)
             # if not quiet:
             #    print('FIT STATUS: '+structinit['fitstatus'])
             # To-do: Need to add a check on fit status here.
+            nfevtot += structinit['nfev']
 
             # Second fit
 
@@ -263,11 +285,12 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
                                  peakinit=peakinit_tmp,
                                  siginit_gas=siginit_gas_tmp,
                                  siglim_gas=siglim_gas,
-                                 tweakcntfit=tweakcntfit)
+                                 tweakcntfit=tweakcntfit, gdmask=gdmask_fit)
 
                 # if not quiet:
                 #    print('FIT STATUS: '+structinit['fitstatus'])
                 # To-do: Need to add a check on fit status here.
+                nfevtot += struct['nfev']
 
             else:
 
@@ -275,7 +298,24 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
 
             # Check components
 
-            if 'fcncheckcomp' in initdat and \
+            # Either fit all candidate numbers of components at once, with
+            # the same continuum, and choose one ...
+            if 'ncompselect' in initdat and \
+                'noemlinfit' not in initdat and \
+                    not onefit and not abortfit and \
+                    ct_comp_emlist > 0:
+
+                struct, ncomp, nfevsel = \
+                    ncompselect(cube.wave, flux, err, dq, listlines, ncomp,
+                                specConv, initdat, struct,
+                                siglim_gas=siglim_gas,
+                                tweakcntfit=tweakcntfit, quiet=quiet,
+                                logfile=logfile, gdmask=gdmask_fit)
+                nfevtot += nfevsel
+                dofit = False
+
+            # ... or remove insignificant components and refit
+            elif 'fcncheckcomp' in initdat and \
                 'noemlinfit' not in initdat and \
                     not onefit and not abortfit and \
                     ct_comp_emlist > 0:
@@ -308,5 +348,12 @@ def fitloop(ispax, colarr, rowarr, cube, initdat, listlines, specConv, onefit,
             else:
                 dofit = False
 
+        print(f'FITLOOP: {nfevtot} function evaluations in line fits.',
+              file=logfile)
+
         # save struct to be used by q3da later
-        np.save(outlab, struct)
+        if store is not None:
+            store.write(istore, jstore, struct, spaxhash)
+        else:
+            struct['fithash'] = spaxhash
+            save_fit(outlab, struct)
@@ -1,14 +1,95 @@
 import lmfit
 import numpy as np
 import pdb
-import ppxf.ppxf_util as util
 import sys
 
 from astropy.constants import c
 from ppxf.ppxf import ppxf
 from q3dfit.common.qsohostfcn import qsohostfcn
 from q3dfit.common.interptemp import interptemp
+from q3dfit.common.logrebin import log_rebin_spectra
 from scipy import interpolate
+from scipy.optimize import lsq_linear
+
+# QSO templates, by file name
+_qsotemplates = dict()
+# Legendre bases, by (# of pixels, lower end of abscissa); oldest dropped first
+_legendre = dict()
+_maxlegendre = 16
+# Legendre coefficient names in qsohostfcn, by order
+_legletters = ['i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r']
+
+
+def __qso_template(qsoxdr):
+    '''Read the QSO template file once per process'''
+    if qsoxdr not in _qsotemplates:
+        try:
+            qsotemplate = np.load(qsoxdr, allow_pickle=True).item()
+            try:
+                qsowave = qsotemplate['wave']
+                qsoflux_full = qsotemplate['flux']
+            except:
+                qsotemplate = np.load(qsoxdr, allow_pickle=True)
+                qsowave = qsotemplate['wave'][0]
+                qsoflux_full = qsotemplate['flux'][0]
+        except:
+            sys.exit('Cannot find quasar template (qsoxdr).')
+        _qsotemplates[qsoxdr] = (qsowave, qsoflux_full)
+    return _qsotemplates[qsoxdr]
+
+
+def __legendre_basis(npix, lo):
+    '''Legendre polynomials of each order in qsohostfcn, evaluated as there
+    on npix points from lo to 1'''
+    key = (npix, lo)
+    if key not in _legendre:
+        if len(_legendre) >= _maxlegendre:
+            del _legendre[next(iter(_legendre))]
+        _legendre[key] = np.polynomial.legendre.legvander(
+            np.linspace(lo, 1., npix), len(_legletters)-1)
+    return _legendre[key]
+
+
+def __linear_fit(params, flux, weight, qsotemplate):
+    '''Solve a model of only Legendre terms (qso_mult_leg, stars_add_leg)
+    by bounded linear least squares. Returns parameters with values and
+    uncertainties, like an lmfit fit.'''
+    npix = len(flux)
+    cols = dict()
+    for prefix, lo, scale in (('qso_mult_leg_', 0., qsotemplate),
+                              ('stars_add_leg_', -1., None)):
+        if prefix + _legletters[0] in params:
+            basis = __legendre_basis(npix, lo)
+            for order, letter in enumerate(_legletters):
+                if scale is None:
+                    cols[prefix+letter] = basis[:, order]
+                else:
+                    cols[prefix+letter] = basis[:, order]*scale
+    names = [name for name in cols
+             if params[name].vary and not params[name].expr]
+    # fixed terms
+    offset = np.zeros(npix)
+    for name in cols:
+        if name not in names:
+            offset += params[name].value*cols[name]
+    design = np.column_stack([cols[name] for name in names])
+    good = np.isfinite(flux) & np.isfinite(weight) & \
+        np.all(np.isfinite(design), axis=1)
+    sqrtw = np.sqrt(weight[good])
+    design = design[good, :]*sqrtw[:, np.newaxis]
+    resid = (flux[good]-offset[good])*sqrtw
+    lo = np.array([params[name].min for name in names])
+    hi = np.array([params[name].max for name in names])
+    sol = lsq_linear(design, resid, bounds=(lo, hi), method='bvls')
+
+    # uncertainties, scaled by reduced chi-squared as in lmfit
+    nfree = max(len(resid) - len(names), 1)
+    redchi = np.sum(np.power(sol.fun, 2.))/nfree
+    covar = np.linalg.pinv(design.T @ design)*redchi
+    for k, name in enumerate(names):
+        params[name].value = sol.x[k]
+        params[name].stderr = np.sqrt(max(covar[k, k], 0.))
+    return params
 
 
 def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
@@ -18,7 +99,7 @@ def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
                add_poly_degree=30, siginit_stars=None,
                fitran=None, fittol=None,
                qsoord=None, hostonly=False, hostord=None, blronly=False,
-               blrterms=None, **kwargs):
+               blrterms=None, qsoexp=True, hostexp=True, **kwargs):
     '''Function defined to fit the continuum
 
     Parameters
@@ -45,7 +126,17 @@ def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
     zstar: float
         redshift of the stellar continuum
 
+    qsoexp: bool
+        Include the exponential terms in the QSO template multiplier.
+        Default is True.
 
+    hostexp: bool
+        Include the exponential terms in the additive host continuum.
+        Default is True.
+
+    If neither exponential terms nor BLR components (blrpar) are
+    included, the model is linear in all of its coefficients, and it is
+    solved directly by bounded linear least squares instead of lmfit.
 
 
     returns
@@ -63,17 +154,7 @@ def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
     if qsoxdr is None:
         sys.exit('Quasar template (qsoxdr) not specified in \
                  initialization file.')
-    try:
-        qsotemplate = np.load(qsoxdr, allow_pickle=True).item()
-        try:
-            qsowave = qsotemplate['wave']
-            qsoflux_full = qsotemplate['flux']
-        except:
-            qsotemplate = np.load(qsoxdr, allow_pickle=True)
-            qsowave = qsotemplate['wave'][0]
-            qsoflux_full = qsotemplate['flux'][0]
-    except:
-        sys.exit('Cannot find quasar template (qsoxdr).')
+    qsowave, qsoflux_full = __qso_template(qsoxdr)
 
     #qsoflux = interptemp(wave, qsowave, qsoflux_full)
 
@@ -94,23 +175,31 @@ def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
     ymod, params = \
         qsohostfcn(wave, params_fit=None, qsoxdr=qsoxdr, qsoonly=qsoonly,
                    qsoord=qsoord, hostonly=hostonly, hostord=hostord,
-                   blronly=blronly, blrpar=blrpar, qsoflux=qsoflux, **kwargs)
-    if quiet:
-        lmverbose = 0  # verbosity for scipy.optimize.least_squares
-    else:
-        lmverbose = 2
-    fit_kws = {'verbose': lmverbose}
+                   blronly=blronly, blrpar=blrpar, qsoflux=qsoflux,
+                   qsoexp=qsoexp, hostexp=hostexp, **kwargs)
 
-    result = ymod.fit(iflux, params, weights=np.sqrt(iweight),
-                      qsotemplate=qsoflux[index],
-                      wave=iwave, x=iwave, method='least_squares',
-                      nan_policy='omit', fit_kws=fit_kws)
+    if all(name.startswith(('qso_mult_leg_', 'stars_add_leg_'))
+           for name in params):
+        # Only Legendre terms, so the model is linear
+        bestpars = __linear_fit(params, iflux, iweight, qsoflux[index])
+    else:
+        if quiet:
+            lmverbose = 0  # verbosity for scipy.optimize.least_squares
+        else:
+            lmverbose = 2
+        fit_kws = {'verbose': lmverbose}
+
+        result = ymod.fit(iflux, params, weights=np.sqrt(iweight),
+                          qsotemplate=qsoflux[index],
+                          wave=iwave, x=iwave, method='least_squares',
+                          nan_policy='omit', fit_kws=fit_kws)
+        bestpars = result.params
 
     if not quiet:
-        lmfit.report_fit(result.params)
+        lmfit.report_fit(bestpars)
 
     # comps = result.eval_components(wave=wave, qso_model=qsoflux, x=wave)
-    continuum = result.eval(wave=wave, qsotemplate=qsoflux, x=wave)
+    continuum = ymod.eval(bestpars, wave=wave, qsotemplate=qsoflux, x=wave)
     # Test plot
     # import matplotlib.pyplot as plt
     # for i in comps.keys():
@@ -122,14 +211,14 @@ def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
     # plt.legend(loc='best')
     # plt.show()
 
-    ct_coeff = result.params
+    ct_coeff = bestpars
 
     if refit == 'ppxf' and index_log is not None and \
         err_log is not None and flux_log is not None:
 
         # log rebin residual
         # lamRange1 = np.array([wave.min(), wave.max()])/(1+zstar)
-        cont_log, lambda_log, velscale = util.log_rebin(fitran, continuum)
+        cont_log, lambda_log, velscale = log_rebin_spectra(fitran, continuum)
 
         resid_log = flux_log - cont_log
 
@@ -155,7 +244,7 @@ def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
         #                          kind='cubic', fill_value="extrapolate")
         # poly = pinterp(np.log(wave))
 
-        ct_coeff = {'qso_host': result.params,
+        ct_coeff = {'qso_host': bestpars,
                     'stel': pp.weights,
                     'poly': pp.polyweights,
                     'ppxf_sigma': pp.sol[1]}
@@ -197,6 +286,6 @@ def fitqsohost(wave, flux, weight, template_wave, template_flux, index,
         plt.show()
 
         continuum += cont_resid
-        ct_coeff['qso_host'] = result.params
+        ct_coeff['qso_host'] = bestpars
 
     return continuum, ct_coeff, zstar
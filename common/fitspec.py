@@ -53,6 +53,17 @@
      quiet: in, optional, type=byte
        Use to prevent detailed output to screen. Default is to print
        detailed output.
+     contfit: in, optional, type=structure
+       Output of a previous call to FITSPEC on the same spectrum. If set,
+       its continuum fit is reused rather than fitting the continuum again.
+     gdmask: in, optional, type=bytarr(npix)
+       Good data (nonzero and finite flux, positive and finite error, DQ of
+       0, outside any cutrange), as precomputed for the cube by CUBE and
+       FITLOOP. If not set, it is computed from FLUX, ERR, and DQ.
+     cwvinit: in, optional, type=hash(lines\,maxncomp)
+       Starting emission line wavelengths, e.g. from a neighbor's fit (see
+       NEIGHBORSEED); NaN where there is none. The wavelength limits and
+       line masks are still set from LISTLINESZ.
 
  :History:
      ChangeHistory::
@@ -134,11 +145,14 @@ from astropy.constants import c
 from astropy.table import Table
 from importlib import import_module
 from ppxf.ppxf import ppxf
-from ppxf.ppxf_util import log_rebin
-from q3dfit.common.airtovac import airtovac
 from q3dfit.common.masklin import masklin
 from q3dfit.common.interptemp import interptemp
+from q3dfit.common.linejac import linejac
+from q3dfit.common.linemodel import LINEMODEL
+from q3dfit.common.logrebin import log_rebin_spectra
+from q3dfit.common.neighborseed import seed_wavelengths
 from q3dfit.common.questfit import questfit
+from q3dfit.common.startemp import stellar_template
 from q3dfit.common.plot_quest import plot_quest
 from scipy.interpolate import interp1d
 
@@ -146,7 +160,7 @@ from scipy.interpolate import interp1d
 def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specConv,
             initdat, maskwidths=None, peakinit=None, quiet=True,
             siginit_gas=None, siglim_gas=None, tweakcntfit=None,
-            col=None, row=None):
+            col=None, row=None, contfit=None, gdmask=None, cwvinit=None):
 
     bad = 1e99
 
@@ -204,32 +218,9 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
 
     if istemp and initdat['fcncontfit'] != 'questfit':
 
-        # Get stellar templates
-        startempfile = initdat['startempfile']
-        if isinstance(startempfile, bytes):
-
-            startempfile = startempfile.decode('utf-8')
-
-        sav_data = np.load(startempfile, allow_pickle=True).item()
-        template = sav_data
-        # Redshift stellar templates
-        templatelambdaz = np.copy(template['lambda'])
-        if 'keepstarz' not in initdat:
-            templatelambdaz *= 1. + zstar
-        # This assumes template is in air wavelengths!
-        # TODO: make this an option
-        if vacuum:
-            templatelambdaz = airtovac(templatelambdaz)
-        if 'waveunit' in initdat:
-            templatelambdaz *= initdat['waveunit']
-        if 'fcnconvtemp' in initdat:
-            impModule = import_module('q3dfit.common.'+initdat['fcnconvtemp'])
-            fcnconvtemp = getattr(impModule, initdat['fcnconvtemp'])
-            if 'argsconvtemp' in initdat:
-                newtemplate = fcnconvtemp(templatelambdaz, template,
-                                          **initdat['argsconvtemp'])
-            else:
-                newtemplate = fcnconvtemp(templatelambdaz, template)
+        # Get stellar templates, loaded once per process, and redshifted and
+        # converted once per redshift
+        templatelambdaz, template = stellar_template(initdat, zstar)
     else:
         templatelambdaz = wlambda
     # Set up error in zstar
@@ -243,37 +234,27 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
         fitran_tmp = initdat['fitran']
     else:
         fitran_tmp = [wlambda[0], wlambda[len(wlambda)-1]]
+    # good data, unless precomputed for the cube
+    if gdmask is None:
+        gdmask = (flux != 0.) & (err > 0.) & np.isfinite(flux) & \
+            np.isfinite(err) & (dq == 0)
     # indices locating good data and data within fit range
     # these index the full data range.
-    gd_indx_1 = set(np.where(flux != 0.)[0])
-    gd_indx_2 = set(np.where(err > 0.)[0])
-    gd_indx_3 = set(np.where(np.isfinite(flux))[0])
-    gd_indx_4 = set(np.where(np.isfinite(err))[0])
-    gd_indx_5 = set(np.where(dq == 0)[0])
-    gd_indx_6 = set(np.where(wlambda >= min(templatelambdaz))[0])
-    gd_indx_7 = set(np.where(wlambda <= max(templatelambdaz))[0])
-    gd_indx_8 = set(np.where(wlambda >= fitran_tmp[0])[0])
-    gd_indx_9 = set(np.where(wlambda <= fitran_tmp[1])[0])
-    gd_indx_full = gd_indx_1.intersection(gd_indx_2, gd_indx_3, gd_indx_4,
-                                          gd_indx_5, gd_indx_6, gd_indx_7,
-                                          gd_indx_8, gd_indx_9)
-    gd_indx_full = list(gd_indx_full)
+    gd_indx_full = np.flatnonzero(gdmask &
+                                  (wlambda >= min(templatelambdaz)) &
+                                  (wlambda <= max(templatelambdaz)) &
+                                  (wlambda >= fitran_tmp[0]) &
+                                  (wlambda <= fitran_tmp[1]))
     # limit actual fit range to good data
     fitran = [np.min(wlambda[gd_indx_full]), np.max(wlambda[gd_indx_full])]
 
     # indices locating data within actual fit range
-    fitran_indx1 = np.where(wlambda >= fitran[0])[0]
-    fitran_indx2 = np.where(wlambda <= fitran[1])[0]
-    fitran_indx = np.intersect1d(fitran_indx1, fitran_indx2)
-    # indices locating good regions within wlambda[fitran_indx]
-    gd_indx_full_rezero = gd_indx_full - fitran_indx[0]
-    max_gd_indx_full_rezero = max(fitran_indx) - fitran_indx[0]
-    igdfz1 = np.where(gd_indx_full_rezero >= 0)[0]
-    igdfz2 = np.where(gd_indx_full_rezero <= max_gd_indx_full_rezero)[0]
-    i_gd_indx_full_rezero = np.intersect1d(igdfz1, igdfz2)
+    fitran_indx = np.flatnonzero((wlambda >= fitran[0]) &
+                                 (wlambda <= fitran[1]))
     # Final index for addressing ALL "good" pixels
     # these address only the fitted data range; i.e., they address gdflux, etc.
-    gd_indx = gd_indx_full_rezero[i_gd_indx_full_rezero]
+    gd_indx = gd_indx_full[(gd_indx_full >= fitran_indx[0]) &
+                           (gd_indx_full <= fitran_indx[-1])] - fitran_indx[0]
 
     # Limit data to fit range
     gdflux = flux[fitran_indx]
@@ -282,37 +263,27 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
     gddq = dq[fitran_indx]
     gdinvvar = 1./np.power(gderr, 2.)  # inverse variance
 
-    # Log rebin galaxy spectrum for PPXF
-    gdflux_log, gdlambda_log, velscale = log_rebin(fitran, gdflux)
-    gderrsq_log, _, _ = log_rebin(fitran, np.power(gderr, 2.))
-    gderr_log = np.sqrt(gderrsq_log)
+    # Log rebin galaxy spectrum and variance for PPXF, together, with the
+    # rebinning operator for this grid
+    gdspec_log, gdlambda_log, velscale = \
+        log_rebin_spectra(fitran, np.column_stack([gdflux,
+                                                   np.power(gderr, 2.)]))
+    gdflux_log = gdspec_log[:, 0]
+    gderr_log = np.sqrt(gdspec_log[:, 1])
     # gdinvvar_log = 1./np.power(gderr_log, 2.)
 
     # Find where flux is <= 0 or error is <= 0 or infinite or NaN or dq != 0
     # these index the fitted data range
-    zerinf_indx_1 = np.where(gdflux == 0.)[0]
-    zerinf_indx_2 = np.where(gderr <= 0.)[0]
-    zerinf_indx_3 = np.where(np.isinf(gdflux))[0]
-    zerinf_indx_4 = np.where(np.isinf(gderr))[0]
-    zerinf_indx_5 = np.where(gddq != 0)[0]
-    zerinf_indx = np.unique(np.hstack([zerinf_indx_1, zerinf_indx_2,
-                                       zerinf_indx_3, zerinf_indx_4,
-                                       zerinf_indx_5]))
-
-    zerinf_indx_1 = np.where(gdflux_log == 0.)[0]
-    zerinf_indx_2 = np.where(gderr_log <= 0.)[0]
-    zerinf_indx_3 = np.where(np.isinf(gdflux_log))[0]
-    zerinf_indx_4 = np.where(np.isinf(gderr_log))[0]
+    zerinf_indx = np.flatnonzero(~gdmask[fitran_indx])
+
+    zerinf_log = (gdflux_log == 0.) | (gderr_log <= 0.) | \
+        np.isinf(gdflux_log) | np.isinf(gderr_log)
     # to-do: log rebin dq and apply here?
-    zerinf_indx_log = np.unique(np.hstack([zerinf_indx_1, zerinf_indx_2,
-                                           zerinf_indx_3, zerinf_indx_4]))
+    zerinf_indx_log = np.flatnonzero(zerinf_log)
 
     # good indices for log arrays
-    ctfitran = len(gdflux_log)
-    gd_indx_log = np.arange(ctfitran)
+    gd_indx_log = np.flatnonzero(~zerinf_log)
     ctzerinf_log = len(zerinf_indx_log)
-    if ctzerinf_log > 0:
-        gd_indx_log = np.setdiff1d(gd_indx_log, zerinf_indx_log)
 
     # Set bad points to nan so lmfit will ignore
     ctzerinf = len(zerinf_indx)
@@ -374,10 +345,26 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
         ct_indx = np.intersect1d(ct_indx, gd_indx)
         ct_indx_log = np.intersect1d(ct_indx_log, gd_indx_log)
 
+    # ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+    # # Option 0: Continuum fit from a previous call
+    # ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+        if contfit is not None:
+
+            continuum = contfit['cont_fit_pretweak']
+            ct_coeff = contfit['ct_coeff']
+            ct_indx = contfit['ct_indx']
+            zstar = contfit['zstar']
+            zstar_err = contfit['zstar_err']
+            ebv_star = contfit['ct_ebv']
+            add_poly_weights = contfit['ct_add_poly_weights']
+            ct_rchisq = contfit['ct_rchisq']
+            ppxf_sigma = contfit['ct_ppxf_sigma']
+            ppxf_sigma_err = contfit['ct_ppxf_sigma_err']
+
     # ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
     # # Option 1: Input function
     # ;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
-        if initdat['fcncontfit'] != 'ppxf':
+        elif initdat['fcncontfit'] != 'ppxf':
 
             module = import_module('q3dfit.common.' + initdat['fcncontfit'])
             fcncontfit = getattr(module, initdat['fcncontfit'])
@@ -560,7 +547,14 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
                     # Use first component as a proxy for all components
                     if listlinesz[line][0] >= min(gdlambda) and \
                         listlinesz[line][0] <= max(gdlambda):
-                        peakinit[line] = fline(listlinesz[line][0:ncomp[line]])
+                        wvpk = np.array(listlinesz[line][0:ncomp[line]],
+                                        dtype=np.float64)
+                        if cwvinit is not None and line in cwvinit:
+                            wvseed = cwvinit[line][0:ncomp[line]]
+                            wvpk = np.where(np.isfinite(wvseed), wvseed, wvpk)
+                            wvpk = np.clip(wvpk, min(gdlambda),
+                                           max(gdlambda))
+                        peakinit[line] = fline(wvpk)
                         # If initial guess is negative, set to 0 to prevent
                         # fitter from choking (since we limit peak to be >= 0)
                         peakinit[line] = \
@@ -579,7 +573,8 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
         impModule = import_module('q3dfit.init.' + fcninitpar)
         run_fcninitpar = getattr(impModule, fcninitpar)
         if 'argsinitpar' in initdat:
-            argsinitpar = initdat['argsinitpar']
+            # copy, so that initdat (and its hash) is left as it was
+            argsinitpar = dict(initdat['argsinitpar'])
         else:
             argsinitpar = dict()
         if 'siglim_gas' is not None:
@@ -588,6 +583,8 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
             run_fcninitpar(listlines, listlinesz, initdat['linetie'], peakinit,
                            siginit_gas, initdat['maxncomp'], ncomp, specConv,
                            **argsinitpar)
+        if cwvinit is not None:
+            seed_wavelengths(fit_params, cwvinit, ncomp)
 
         # testsize = len(parinit)
         # if testsize == 0:
@@ -615,13 +612,31 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
             for key, val in initdat['argslinefit'].items():
                 fit_kws[key] = val
 
-        lmout = emlmod.fit(gdflux_nocnt, fit_params, x=gdlambda,
-                           method='least_squares',
-                           weights=np.sqrt(gdinvvar_nocnt),
-                           nan_policy='omit', fit_kws=fit_kws)
+        # Drop the points lmfit would ignore, so that the residual and the
+        # Jacobian line up
+        ifit = np.isfinite(gdflux_nocnt) & np.isfinite(gdinvvar_nocnt)
+        fitlambda = gdlambda[ifit]
+        fitflux = gdflux_nocnt[ifit]
+        fitweights = np.sqrt(gdinvvar_nocnt[ifit])
+        if initdat.get('lineengine', 'lmfit') == 'vector':
+            # single-pass evaluator, with the same outputs as lmfit
+            linemod = LINEMODEL(emlmod, fit_params)
+            lmout = linemod.fit(fitflux, fitlambda, fitweights,
+                                fit_kws=fit_kws)
+            specfit = lmout.eval(gdlambda)
+        else:
+            # Analytic Jacobian, if asked for and not set in argslinefit
+            if initdat.get('linejac', False) and 'jac' not in fit_kws:
+                jac = linejac(emlmod, fit_params, fitlambda, fitweights)
+                if jac is not None:
+                    fit_kws['jac'] = jac
+
+            lmout = emlmod.fit(fitflux, fit_params, x=fitlambda,
+                               method='least_squares', weights=fitweights,
+                               nan_policy='omit', fit_kws=fit_kws)
+            specfit = emlmod.eval(lmout.params, x=gdlambda)
 
         param = lmout.best_values
-        specfit = emlmod.eval(lmout.params, x=gdlambda)
         if not quiet:
             print(lmout.fit_report(show_correl=False))
 
@@ -634,6 +649,9 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
         covar = lmout.covar
         dof = lmout.nfree
         rchisq = lmout.redchi
+        nfev = lmout.nfev
+        bic = lmout.bic
+        aic = lmout.aic
 
         # error messages corresponding to LMFIT,plt
         # documentation was not very helpful with the error messages...
@@ -684,6 +702,9 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
         rchisq = 0
         dof = 1
         niter = 0
+        nfev = 0
+        bic = np.nan
+        aic = np.nan
         status = 0
         outlistlines = 0
         parinit = 0
@@ -737,6 +758,9 @@ def fitspec(wlambda, flux, err, dq, zstar, listlines, listlinesz, ncomp, specCon
               'noemlinfit': noemlinfit,  # was emission line fit done?
               'noemlinmask': noemlinmask,  # were emission lines masked?
               'redchisq': rchisq,
+              'nfev': nfev,  # of function evaluations in line fit
+              'bic': bic,  # information criteria of line fit
+              'aic': aic,
               # 'niter': niter, (DOES NOT EXIST)
               # 'fitstatus': status, [leftover from MPFIT]
               'linelist': outlistlines,
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Consolidated store of Q3DF fit results, used in place of one pickled .npy
+file per spaxel when initdat['resultstore'] is set.
+
+The store is a directory, [outdir][label].store, holding one .npy array per
+quantity with the spaxel as its leading two indices. Each worker writes the
+bytes of its own spaxels in place, so workers write concurrently; Q3DA reads
+the arrays as memory maps, without unpickling anything. The layout is fixed
+when the store is created:
+
+   status: bytarr(ncols, nrows)
+     1 once a spaxel's fit has been completely written, 2 if PRESCREEN found
+     no detection, 0 otherwise. It is set last, so a spaxel interrupted
+     mid-write reads as not fit. To keep small writes to a minimum, each
+     process syncs the other arrays to disk and only then sets the status
+     of its spaxels, once per batch of spaxels (see FLUSH_STORES) rather
+     than once per spaxel.
+   fithash: strarr(ncols, nrows)
+     Output of FITHASH, for resuming.
+   fitran_indx: lonarr(ncols, nrows, 2)
+     First and last+1 index of the fit range in the cube wavelength array.
+   param, perror: dblarr(ncols, nrows, npar)
+     Best-fit line parameters and errors, in the order of layout['parnames'].
+     NaN where a parameter was not fit (e.g., fewer than maxncomp
+     components).
+   spec, spec_err, cont_dat, ...: dblarr(ncols, nrows, nwave)
+     Model and data spectra on the cube wavelength grid, NaN outside the fit
+     range.
+   gd_indx, ct_indx: bytarr(ncols, nrows, nwave)
+     Index arrays of FITSPEC, stored as masks on the cube wavelength grid.
+   zstar, redchisq, ...: dblarr(ncols, nrows)
+     Scalar outputs of FITSPEC.
+   inextras: bytarr(ncols, nrows, nmasks+nscalars)
+     Set for the index arrays and scalars above whose value didn't fit the
+     fixed layout (e.g., CT_INDX = 0 with no continuum fit, or CT_EBV =
+     None); these are kept with the extras below instead.
+
+Any other output of FITSPEC (e.g., CT_COEFF, whose form depends on the
+continuum fitting routine) is pickled to an append-only file per writing
+process, extras_[host]-[pid].pkl, and indexed by file and offset. The
+file is named by host as well as process ID, since MPI workers on
+different nodes can share a process ID. It is unpickled
+only when Q3DA asks for it. Q3DA does ask for CT_COEFF when it decomposes
+the continuum (e.g., with fitqsohost or ppxf), so those runs still
+unpickle one record per spaxel.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import json
+import numpy as np
+import os
+import pickle
+import socket
+
+from q3dfit.common.lmlabel import lmlabel
+
+# spectra stored on the cube wavelength grid
+_spectra = ['spec', 'spec_err', 'cont_dat', 'cont_fit', 'cont_fit_pretweak',
+            'emlin_dat', 'emlin_fit']
+# index arrays into the fit range, stored as masks
+_masks = ['gd_indx', 'ct_indx']
+# scalar outputs
+_scalars = ['zstar', 'zstar_err', 'ct_ebv', 'ct_ppxf_sigma',
+            'ct_ppxf_sigma_err', 'ct_rchisq', 'redchisq', 'nfev', 'bic',
+            'aic']
+# index arrays and scalars that can instead be kept with the extras
+_inextras = _masks + _scalars
+# outputs rebuilt from the arrays above
+_derived = ['wave', 'fitran', 'fitran_indx', 'param', 'perror',
+            'perror_resid', 'noemlinfit', 'noemlinmask', 'siglim']
+
+# stores opened by this process, by path
+_stores = dict()
+# spaxels written by a process between syncs to disk
+_syncbatch = 32
+# bytes in the key naming a process's extras file; a host name is at most 64
+_keylen = 80
+
+
+def store_path(initdat):
+    '''
+    Directory holding the result store for this initialization.
+    '''
+    return '{[outdir]}{[label]}.store'.format(initdat, initdat)
+
+
+def store_index(cube, i, j):
+    '''
+    Indices into the store of the spaxel with (0-offset) column i and row j.
+    '''
+    if cube.dat.ndim == 1:
+        return 0, 0
+    elif cube.dat.ndim == 2:
+        return i, 0
+    return i, j
+
+
+def _parnames(initdat):
+    # Line parameters for the maximum number of components, plus any
+    # fitted line ratios; see PARINIT
+    parnames = []
+    if 'noemlinfit' in initdat:
+        return parnames
+    for line in initdat['lines']:
+        lmline = lmlabel(line)
+        for comp in range(initdat['maxncomp']):
+            for gpar in ['flx', 'cwv', 'sig', 'srsigslam']:
+                parnames.append(f'{lmline.lmlabel}_{comp}_{gpar}')
+    if 'argsinitpar' in initdat and \
+            'lineratio' in initdat['argsinitpar']:
+        lineratio = initdat['argsinitpar']['lineratio']
+        for ilinrat in range(len(lineratio)):
+            lmline1 = lmlabel(lineratio['line1'][ilinrat])
+            lmline2 = lmlabel(lineratio['line2'][ilinrat])
+            parnames.append(f'{lmline1.lmlabel}_div_{lmline2.lmlabel}_' +
+                            f'{lineratio["comp"][ilinrat]}')
+    return parnames
+
+
+def create_store(initdat, cube):
+    '''
+    Create the result store for this initialization and cube, unless a
+    store with the same layout already exists. Call once, before any fits
+    are written.
+
+    :Params:
+        initdat: in, required, type=dict
+            Initialization dictionary.
+        cube: in, required, type=object
+            Output of READCUBE.
+    '''
+    path = store_path(initdat)
+    if cube.dat.ndim == 1:
+        ncols, nrows = 1, 1
+    elif cube.dat.ndim == 2:
+        ncols, nrows = cube.ncols, 1
+    else:
+        ncols, nrows = cube.ncols, cube.nrows
+    parnames = _parnames(initdat)
+    nwave = len(cube.wave)
+
+    shape = (ncols, nrows)
+    npar = len(parnames)
+    arrays = {'status': ('u1', shape, 0),
+              'fithash': ('S40', shape, b''),
+              'fitran_indx': ('i8', shape + (2,), 0),
+              'param': ('f8', shape + (npar,), np.nan),
+              'perror': ('f8', shape + (npar,), np.nan),
+              'noemlinfit': ('u1', shape, 0),
+              'noemlinmask': ('u1', shape, 0),
+              'siglim': ('f8', shape + (2,), np.nan),
+              'extras_key': (f'S{_keylen}', shape, b''),
+              'extras_off': ('i8', shape, 0),
+              'extras_len': ('i8', shape, 0),
+              'inextras': ('u1', shape + (len(_inextras),), 0)}
+    for key in _spectra:
+        arrays[key] = ('f8', shape + (nwave,), np.nan)
+    for key in _masks:
+        arrays[key] = ('u1', shape + (nwave,), 0)
+    for key in _scalars:
+        arrays[key] = ('f8', shape, np.nan)
+    layout = {'ncols': ncols, 'nrows': nrows, 'nwave': nwave,
+              'parnames': parnames, 'arrays': sorted(arrays)}
+
+    layoutfile = os.path.join(path, 'layout.json')
+    if os.path.isfile(layoutfile):
+        with open(layoutfile, 'r') as fh:
+            if json.load(fh) == layout:
+                return path
+        os.remove(layoutfile)
+    os.makedirs(path, exist_ok=True)
+    for key, (dtype, ashape, fill) in arrays.items():
+        arr = np.lib.format.open_memmap(os.path.join(path, key + '.npy'),
+                                        mode='w+', dtype=dtype, shape=ashape)
+        arr[:] = fill
+        arr.flush()
+        del arr
+    for extras in os.listdir(path):
+        if extras.startswith('extras_') and extras.endswith('.pkl'):
+            os.remove(os.path.join(path, extras))
+    # the layout file is written last, so its presence means the store is
+    # complete
+    with open(layoutfile, 'w') as fh:
+        json.dump(layout, fh)
+    return path
+
+
+def get_store(initdat, mode='r+'):
+    '''
+    Open the result store for this initialization, or return it if this
+    process has already opened it.
+    '''
+    path = store_path(initdat)
+    if path not in _stores or _stores[path].mode != mode:
+        _stores[path] = FITSTORE(path, mode=mode)
+    return _stores[path]
+
+
+def flush_stores():
+    '''
+    Sync to disk the fits written by this process to any store it has open,
+    and mark them done. Call at the end of each batch of spaxels.
+    '''
+    for store in _stores.values():
+        store.flush()
+
+
+class FITSTORE:
+    '''
+    Read and write access to a result store made by CREATE_STORE.
+
+    :Params:
+        path: in, required, type=string
+            Store directory.
+        mode: in, optional, type=string, default='r'
+            'r' to read, 'r+' to also write fits.
+        key: in, optional, type=string, default=[host]-[pid]
+            Key naming the file this writer pickles extras to; it must be
+            unique among the processes writing the store.
+
+    :Attributes:
+        layout: dict
+            Store dimensions and parameter names.
+        [array]: memory map
+            Each stored array, e.g. STATUS or PARAM, can be sliced directly.
+    '''
+
+    def __init__(self, path, mode='r', key=None):
+        self.path = path
+        self.mode = mode
+        self.key = key
+        with open(os.path.join(path, 'layout.json'), 'r') as fh:
+            self.layout = json.load(fh)
+        self.parindex = {name: k for k, name
+                         in enumerate(self.layout['parnames'])}
+        for fname in os.listdir(path):
+            if fname.endswith('.npy'):
+                setattr(self, fname[:-4],
+                        np.load(os.path.join(path, fname), mmap_mode='r'))
+        self.__fds = dict()
+        self.__extrasfile = None
+        # status of spaxels written but not yet synced, by (i, j)
+        self.__pending = dict()
+
+    def __put(self, key, i, j, val):
+        # Write the values for one spaxel directly to the file, rather than
+        # through a shared memory map, so that only those bytes are touched
+        arr = getattr(self, key)
+        if key not in self.__fds:
+            self.__fds[key] = os.open(os.path.join(self.path, key + '.npy'),
+                                      os.O_WRONLY)
+        buf = np.ascontiguousarray(np.broadcast_to(val, arr.shape[2:]),
+                                   dtype=arr.dtype).tobytes()
+        os.pwrite(self.__fds[key], buf,
+                  arr.offset + (i*arr.shape[1] + j)*len(buf))
+
+    def __begin(self, i, j):
+        # Before overwriting a spaxel, make sure it no longer reads as done
+        self.__pending.pop((i, j), None)
+        if self.status[i, j] != 0:
+            self.__put('status', i, j, 0)
+            os.fsync(self.__fds['status'])
+
+    def __finish(self, i, j, status):
+        # Mark spaxel [i, j] done at the next sync
+        self.__pending[(i, j)] = status
+        if len(self.__pending) >= _syncbatch:
+            self.flush()
+
+    def fit_status(self, i, j):
+        '''
+        Status of spaxel [i, j], including fits written by this process but
+        not yet synced.
+        '''
+        return self.__pending.get((i, j), self.status[i, j])
+
+    def is_current(self, i, j, hash):
+        '''
+        Check whether spaxel [i, j] holds a complete fit with this hash.
+        '''
+        return bool(self.fit_status(i, j)) and \
+            self.fithash[i, j] == hash.encode()
+
+    def write(self, i, j, struct, hash=''):
+        '''
+        Write the output of FITSPEC for spaxel [i, j].
+
+        :Params:
+            i, j: in, required, type=int
+                Store indices of the spaxel; see STORE_INDEX.
+            struct: in, required, type=dict
+                Output of FITSPEC.
+            hash: in, optional, type=string
+                Output of FITHASH.
+        '''
+        if self.mode == 'r':
+            raise IOError('FITSTORE: store opened read-only')
+        self.__begin(i, j)
+
+        nwave = self.layout['nwave']
+        extras = dict()
+        inextras = np.zeros(len(_inextras), dtype='u1')
+        lo = int(struct['fitran_indx'][0])
+        hi = int(struct['fitran_indx'][-1]) + 1
+        self.__put('fitran_indx', i, j, [lo, hi])
+        for key in _spectra:
+            row = np.full(nwave, np.nan)
+            row[lo:hi] = struct[key]
+            self.__put(key, i, j, row)
+        for key in _masks:
+            row = np.zeros(nwave, dtype='u1')
+            if np.ndim(struct[key]) == 0:
+                # not an index array, e.g. CT_INDX with no continuum fit
+                extras[key] = struct[key]
+                inextras[_inextras.index(key)] = 1
+            else:
+                row[lo + np.asarray(struct[key], dtype=int)] = 1
+            self.__put(key, i, j, row)
+        for key in _scalars:
+            try:
+                self.__put(key, i, j, float(struct[key]))
+            except (TypeError, ValueError):
+                self.__put(key, i, j, np.nan)
+                extras[key] = struct[key]
+                inextras[_inextras.index(key)] = 1
+        self.__put('inextras', i, j, inextras)
+
+        self.__put('noemlinfit', i, j, bool(struct['noemlinfit']))
+        self.__put('noemlinmask', i, j, struct['noemlinmask'] == b'1')
+        if struct['siglim'] is not None:
+            self.__put('siglim', i, j, struct['siglim'])
+        param = np.full(len(self.parindex), np.nan)
+        perror = np.full(len(self.parindex), np.nan)
+        if isinstance(struct['param'], dict):
+            for name, val in struct['param'].items():
+                if name in self.parindex:
+                    param[self.parindex[name]] = val
+                    if struct['perror'][name] is not None:
+                        perror[self.parindex[name]] = struct['perror'][name]
+        self.__put('param', i, j, param)
+        self.__put('perror', i, j, perror)
+
+        # everything else, pickled
+        for key, val in struct.items():
+            if key not in _spectra + _masks + _scalars + _derived + \
+                    ['fithash']:
+                extras[key] = val
+        if self.__extrasfile is None:
+            # named when first written, so that a store opened before a fork
+            # isn't shared by the children
+            if self.key is None:
+                self.__key = f'{socket.gethostname()}-{os.getpid()}'
+            else:
+                self.__key = self.key
+            if len(self.__key.encode()) > _keylen:
+                raise ValueError(f'FITSTORE: Writer key {self.__key} is ' +
+                                 f'longer than {_keylen} bytes.')
+            self.__extrasfile = \
+                open(os.path.join(self.path, f'extras_{self.__key}.pkl'),
+                     'ab')
+        blob = pickle.dumps(extras)
+        self.__put('extras_key', i, j, self.__key.encode())
+        self.__put('extras_off', i, j, self.__extrasfile.tell())
+        self.__put('extras_len', i, j, len(blob))
+        self.__extrasfile.write(blob)
+        self.__put('fithash', i, j, hash.encode())
+        self.__finish(i, j, 1)
+
+    def write_nodetect(self, i, j, hash=''):
+        '''
+        Mark spaxel [i, j] as having no detection (see PRESCREEN).
+        '''
+        if self.mode == 'r':
+            raise IOError('FITSTORE: store opened read-only')
+        self.__begin(i, j)
+        self.__put('fithash', i, j, hash.encode())
+        self.__finish(i, j, 2)
+
+    def flush(self):
+        '''
+        Sync the spaxels written since the last call to disk, then set their
+        status, so that a spaxel never reads as done before its data are on
+        disk.
+        '''
+        if not self.__pending:
+            return
+        if self.__extrasfile is not None:
+            self.__extrasfile.flush()
+            os.fsync(self.__extrasfile.fileno())
+        for key, fd in self.__fds.items():
+            if key != 'status':
+                os.fsync(fd)
+        for (i, j), status in self.__pending.items():
+            self.__put('status', i, j, status)
+        os.fsync(self.__fds['status'])
+        self.__pending = dict()
+
+    def read_extras(self, i, j):
+        '''
+        Unpickle the outputs of FITSPEC for spaxel [i, j] that don't have a
+        fixed layout.
+        '''
+        fname = os.path.join(self.path,
+                             f'extras_{self.extras_key[i, j].decode()}.pkl')
+        with open(fname, 'rb') as fh:
+            fh.seek(self.extras_off[i, j])
+            return pickle.loads(fh.read(self.extras_len[i, j]))
+
+    def read(self, i, j, wave):
+        '''
+        Rebuild the output of FITSPEC for spaxel [i, j].
+
+        :Params:
+            i, j: in, required, type=int
+                Store indices of the spaxel; see STORE_INDEX.
+            wave: in, required, type=dblarr(nwave)
+                Cube wavelength array.
+
+        :Returns:
+            Dict with the keys of the FITSPEC output. Keys without a fixed
+            layout are unpickled on first access.
+        '''
+        lo, hi = self.fitran_indx[i, j]
+        struct = _FITSTRUCT(self, i, j)
+        struct['fitran_indx'] = np.arange(lo, hi)
+        struct['wave'] = np.asarray(wave[lo:hi])
+        struct['fitran'] = [struct['wave'][0], struct['wave'][-1]]
+        for key in _spectra:
+            struct[key] = np.array(getattr(self, key)[i, j, lo:hi])
+        # values kept with the extras are left to be unpickled
+        inextras = self.inextras[i, j]
+        for key in _masks:
+            if not inextras[_inextras.index(key)]:
+                struct[key] = \
+                    np.flatnonzero(getattr(self, key)[i, j, lo:hi])
+        for key in _scalars:
+            if not inextras[_inextras.index(key)]:
+                struct[key] = float(getattr(self, key)[i, j])
+        struct['noemlinfit'] = bool(self.noemlinfit[i, j])
+        struct['noemlinmask'] = b'1' if self.noemlinmask[i, j] else b'0'
+        siglim = np.array(self.siglim[i, j])
+        struct['siglim'] = None if np.isnan(siglim).all() else siglim
+        if struct['noemlinfit']:
+            struct['param'] = 0
+            struct['perror'] = 0
+        else:
+            param = self.param[i, j]
+            perror = self.perror[i, j]
+            ifit = np.flatnonzero(np.isfinite(param))
+            names = self.layout['parnames']
+            struct['param'] = {names[k]: param[k] for k in ifit}
+            struct['perror'] = {names[k]: perror[k] for k in ifit}
+        struct['perror_resid'] = struct['perror']
+        return struct
+
+    def close(self):
+        '''
+        Sync any pending fits and close any files opened for writing.
+        '''
+        self.flush()
+        for fd in self.__fds.values():
+            os.close(fd)
+        self.__fds = dict()
+        if self.__extrasfile is not None:
+            self.__extrasfile.close()
+            self.__extrasfile = None
+
+
+class _FITSTRUCT(dict):
+    # Output of FITSPEC read from a store. Keys that aren't stored in fixed
+    # arrays are unpickled the first time one of them is asked for.
+
+    def __init__(self, store, i, j):
+        super().__init__()
+        self.__store = store
+        self.__ij = (i, j)
+        self.__loaded = False
+
+    def __load(self):
+        if not self.__loaded:
+            self.__loaded = True
+            for key, val in self.__store.read_extras(*self.__ij).items():
+                self.setdefault(key, val)
+
+    def __missing__(self, key):
+        self.__load()
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self.__load()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
@@ -40,6 +40,8 @@ Created on Wed Dec 16 13:54:17 2020
 #      2013oct17, DSNR, documented
 #      2013nov13, DSNR, renamed, added license and copyright
 #      2013dec11, DSNR, added a comment
+#      interpolate all templates at once, with shared weights; fixed
+#        handling of 2D template arrays
 #
 # :Copyright:
 #    Copyright (C) 2013 David S. N. Rupke
@@ -58,33 +60,42 @@ Created on Wed Dec 16 13:54:17 2020
 #    along with this program.  If not, see
 #    http://www.gnu.org/licenses/.
 
-from scipy import interpolate
 import numpy as np
 
 def interptemp(spec_lam, temp_lam, template):
 
     if len(template.shape) == 2:
-        ntemp = template.shape(1)
-        new_temp = np.zeros((spec_lam.shape[0],ntemp))
+        ntemp = template.shape[1]
     else:
         ntemp = 1
 
     if np.min(temp_lam) > np.min(spec_lam):
         print('IFSF_INTERPTEMP: WARNING -- Extrapolating template from ' +
-              min(temp_lam) + ' to ' + min(spec_lam) + '.')
+              str(np.min(temp_lam)) + ' to ' + str(np.min(spec_lam)) + '.')
     if np.max(temp_lam) < np.max(spec_lam):
         print('IFSF_INTERPTEMP: WARNING -- Extrapolating template from ' +
-              max(temp_lam) + ' to ' + max(spec_lam) + '.')
+              str(np.max(temp_lam)) + ' to ' + str(np.max(spec_lam)) + '.')
 
-    # Default interpolation for INTERPOL is linear
-    if ntemp !=1:
-        for i in range(ntemp - 1):
-            interpfunc = \
-                interpolate.interp1d(temp_lam, template[:,i], kind='linear')
-            new_temp[:, i] = interpfunc(spec_lam)
+    # Default interpolation for INTERPOL is linear. The weights are the same
+    # for all templates, so compute them once and interpolate all templates
+    # together.
+    temp_lam = np.asarray(temp_lam, dtype=np.float64)
+    isort = None
+    if np.any(np.diff(temp_lam) < 0.):
+        isort = np.argsort(temp_lam)
+        temp_lam = temp_lam[isort]
+    ilo = np.clip(np.searchsorted(temp_lam, spec_lam) - 1, 0,
+                  len(temp_lam) - 2)
+    weight = (spec_lam - temp_lam[ilo]) / (temp_lam[ilo+1] - temp_lam[ilo])
+    if isort is not None:
+        ilo_temp = isort[ilo]
+        ihi_temp = isort[ilo+1]
     else:
-        interpfunc = \
-            interpolate.interp1d(temp_lam, template, kind='linear')
-        new_temp = interpfunc(spec_lam)
+        ilo_temp = ilo
+        ihi_temp = ilo + 1
+    if ntemp != 1:
+        weight = weight[:, np.newaxis]
+    template = np.asarray(template)
+    new_temp = template[ilo_temp] * (1. - weight) + \
+        template[ihi_temp] * weight
     return new_temp
-    
\ No newline at end of file
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Analytic Jacobian of the emission-line model built by PARINIT, for
+lmfit's least_squares method.
+
+Without it, scipy estimates the Jacobian by finite differences, which costs
+a full model evaluation (including the convolution with the spectral
+resolution, if any) per free parameter per iteration. Here the derivatives
+of each MANYGAUSS component with respect to flx, cwv, and sig are computed
+directly. Since the convolution is linear, the derivatives of a convolved
+component are the convolved derivatives. Derivatives through tied
+parameters (linetie, doublets, line ratios) are taken numerically from the
+tie expressions, which is cheap.
+
+FITSPEC uses it if initdat['linejac'] is set.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import numpy as np
+import re
+
+from q3dfit.init.parinit import gausswin, manygauss
+
+# speed of light in km/s, as in MANYGAUSS
+c = np.float64(299792.458)
+
+# functions available to tie expressions; see lmfit's asteval
+_exprfuncs = {name: getattr(np, name) for name in
+              ['sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan', 'arcsin',
+               'arccos', 'arctan', 'abs', 'pi']}
+
+
+def linejac(model, params, x, weights):
+    '''
+    Make the Jacobian function for a line fit, if the model allows it.
+
+    :Params:
+        model: in, required, type=lmfit.Model
+            Sum of MANYGAUSS components, as returned by PARINIT.
+        params: in, required, type=lmfit.Parameters
+            Parameters to fit, with initial values and ties.
+        x: in, required, type=dblarr(npix)
+            Wavelengths of the fitted points.
+        weights: in, required, type=dblarr(npix)
+            Weights of the fitted points, as passed to lmfit.
+
+    :Returns:
+        LINEJAC instance to pass as fit_kws['jac'], or None if some
+        component is not MANYGAUSS or some tie can't be evaluated.
+    '''
+    for comp in model.components:
+        if comp.func is not manygauss:
+            return None
+    try:
+        return LINEJAC(model, params, x, weights)
+    except Exception:
+        return None
+
+
+class LINEJAC:
+    '''
+    Jacobian of the weighted residual of a sum of MANYGAUSS components,
+    with respect to the varied parameters, in lmfit's order. Called by
+    scipy.optimize.least_squares.
+    '''
+
+    def __init__(self, model, params, x, weights):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.components = [(comp.prefix, comp.opts.get('SPECRES'),
+                            comp.opts.get('NSIGWIN'))
+                           for comp in model.components]
+        self.values = {name: par.value for name, par in params.items()}
+        # varied parameters, in the order lmfit passes them
+        self.varnames = [name for name, par in params.items()
+                         if par.vary and not par.expr]
+        # tied parameters, in an order in which they can be evaluated,
+        # and the varied parameters each depends on
+        tokens = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+        deps = dict()
+        codes = dict()
+        for name, par in params.items():
+            if par.expr:
+                deps[name] = set(tokens.findall(par.expr)) & set(params)
+                codes[name] = compile(par.expr, name, 'eval')
+        self.exprs = []
+        vardeps = dict()
+        while len(self.exprs) < len(codes):
+            nadded = 0
+            for name in codes:
+                if name in vardeps or \
+                        any(d in codes and d not in vardeps
+                            for d in deps[name]):
+                    continue
+                vardeps[name] = set()
+                for d in deps[name]:
+                    vardeps[name] |= vardeps.get(d, {d})
+                self.exprs.append((name, codes[name]))
+                nadded += 1
+            if nadded == 0:
+                raise ValueError('LINEJAC: circular parameter ties')
+        # tied parameters that depend on each varied parameter
+        self.tied = {var: [name for name, _ in self.exprs
+                           if var in vardeps[name]]
+                     for var in self.varnames}
+        # make sure the ties evaluate
+        self.__eval_exprs(dict(self.values))
+
+    def __eval_exprs(self, values, names=None):
+        # Evaluate the tied parameters (or only those in names), in place
+        namespace = dict(_exprfuncs, **values)
+        for name, code in self.exprs:
+            if names is None or name in names:
+                values[name] = namespace[name] = \
+                    eval(code, {'__builtins__': {}}, namespace)
+        return values
+
+    def __model_derivs(self, values):
+        # Derivatives of the model with respect to each flx, cwv, and sig
+        dm = dict()
+        for prefix, specres, nsigwin in self.components:
+            flx = values[prefix + 'flx']
+            cwv = values[prefix + 'cwv']
+            sig = values[prefix + 'sig']
+            srsigslam = values[prefix + 'srsigslam']
+            sigs = np.sqrt(np.power((sig/c)*cwv, 2.) +
+                           np.power(srsigslam, 2.))
+            # same window as MANYGAUSS, if any
+            if nsigwin is not None:
+                lo, hi = gausswin(self.x, cwv, nsigwin*sigs)
+            else:
+                lo, hi = 0, len(self.x)
+            dx = self.x[lo:hi] - cwv
+            expon = np.exp(-np.power(dx / sigs, 2.)/2.)
+            gaussian = flx*expon
+            # d(model)/d(sigs), and d(sigs)/d(cwv) and d(sigs)/d(sig)
+            dgdsigs = gaussian*np.power(dx, 2.)/np.power(sigs, 3.)
+            dsigsdcwv = np.power(sig/c, 2.)*cwv/sigs
+            dsigsdsig = np.power(cwv/c, 2.)*sig/sigs
+            derivs = {'flx': expon,
+                      'cwv': gaussian*dx/np.power(sigs, 2.) +
+                      dgdsigs*dsigsdcwv,
+                      'sig': dgdsigs*dsigsdsig}
+            for par, deriv in derivs.items():
+                if lo > 0 or hi < len(self.x):
+                    full = np.zeros(len(self.x))
+                    full[lo:hi] = deriv
+                    deriv = full
+                if specres is not None:
+                    deriv = specres.spect_convolver(self.x, deriv, cwv)
+                dm[prefix + par] = deriv
+        return dm
+
+    def __call__(self, xvals, *args, **kwargs):
+        values = dict(self.values)
+        values.update(zip(self.varnames, xvals))
+        self.__eval_exprs(values)
+        dm = self.__model_derivs(values)
+        jac = np.zeros((len(self.x), len(self.varnames)))
+        for k, var in enumerate(self.varnames):
+            if var in dm:
+                jac[:, k] += dm[var]
+            if len(self.tied[var]) > 0:
+                # derivatives of the tied parameters, by central difference
+                step = 1e-6*max(abs(values[var]), 1e-6)
+                hi = dict(values)
+                hi[var] += step
+                self.__eval_exprs(hi, self.tied[var])
+                lo = dict(values)
+                lo[var] -= step
+                self.__eval_exprs(lo, self.tied[var])
+                for name in self.tied[var]:
+                    if name in dm:
+                        jac[:, k] += dm[name]*(hi[name]-lo[name])/(2.*step)
+        return jac * self.weights[:, np.newaxis]
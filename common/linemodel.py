@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-pass evaluator and fitter for the emission-line model built by
+PARINIT, as an alternative to lmfit's composite Model.
+
+lmfit evaluates the sum of MANYGAUSS components one Model at a time, and
+re-evaluates each tie expression with asteval on every call. LINEMODEL
+instead packs the free parameters into one vector and maps it to the full
+parameter vector through a tie map computed once per fit. Ties that are
+affine in the free parameters (linetie, doublets) become a matrix; other
+ties (e.g., line ratios) are compiled once and evaluated after it. All
+Gaussians are then evaluated in one array expression, and the fit calls
+scipy.optimize.least_squares directly, with the analytic Jacobian.
+
+FITSPEC uses it if initdat['lineengine'] = 'vector'. The fit result has the
+attributes of lmfit's ModelResult that FITSPEC reads, so PARAM, PERROR, and
+the rest of FITSPEC's output are the same as with lmfit.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import copy
+import numpy as np
+import re
+
+from lmfit import fit_report
+from scipy.optimize import least_squares
+from q3dfit.init.parinit import manygauss
+
+# speed of light in km/s, as in MANYGAUSS
+c = np.float64(299792.458)
+
+# functions available to tie expressions; see lmfit's asteval
+_exprfuncs = {name: getattr(np, name) for name in
+              ['sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan', 'arcsin',
+               'arccos', 'arctan', 'abs', 'pi']}
+
+
+class LINEMODEL:
+    '''
+    Sum of MANYGAUSS components with its tie map.
+
+    :Params:
+        model: in, required, type=lmfit.Model
+            Sum of MANYGAUSS components, as returned by PARINIT.
+        params: in, required, type=lmfit.Parameters
+            Parameters to fit, with initial values, limits, and ties.
+
+    Raises ValueError if some component is not MANYGAUSS or the ties can't
+    be evaluated.
+    '''
+
+    def __init__(self, model, params):
+        for comp in model.components:
+            if comp.func is not manygauss:
+                raise ValueError('LINEMODEL: all components must be ' +
+                                 'MANYGAUSS.')
+        self.params = params
+        self.names = list(params.keys())
+        index = {name: k for k, name in enumerate(self.names)}
+        self.index = index
+        # varied parameters, in lmfit's order
+        self.varnames = [name for name, par in params.items()
+                         if par.vary and not par.expr]
+        ivar = np.array([index[name] for name in self.varnames], dtype=int)
+        self.x0 = np.array([params[name].value for name in self.varnames],
+                           dtype=np.float64)
+        self.lower = np.array([params[name].min for name in self.varnames],
+                              dtype=np.float64)
+        self.upper = np.array([params[name].max for name in self.varnames],
+                              dtype=np.float64)
+        self.x0 = np.clip(self.x0, self.lower, self.upper)
+
+        # component parameters, as indices into the full parameter vector
+        self.specres = []
+        nsigwin = []
+        iflx, icwv, isig, isrs = [], [], [], []
+        for comp in model.components:
+            iflx.append(index[comp.prefix + 'flx'])
+            icwv.append(index[comp.prefix + 'cwv'])
+            isig.append(index[comp.prefix + 'sig'])
+            isrs.append(index[comp.prefix + 'srsigslam'])
+            self.specres.append(comp.opts.get('SPECRES'))
+            nsigwin.append(comp.opts.get('NSIGWIN'))
+        self.iflx = np.array(iflx, dtype=int)
+        self.icwv = np.array(icwv, dtype=int)
+        self.isig = np.array(isig, dtype=int)
+        self.isrs = np.array(isrs, dtype=int)
+        self.convolve = any(s is not None for s in self.specres)
+        # windows in sigma, as in MANYGAUSS; infinite if not windowed
+        self.windowed = any(n is not None for n in nsigwin)
+        self.nsigwin = np.array([np.inf if n is None else n
+                                 for n in nsigwin],
+                                dtype=np.float64)[:, np.newaxis]
+
+        # tie map: values = tiemat @ x + tieoff for free, fixed, and affine
+        # tied parameters; the rest are evaluated after, in order
+        nall = len(self.names)
+        nvar = len(self.varnames)
+        self.tiemat = np.zeros((nall, nvar))
+        self.tieoff = np.array([params[name].value for name in self.names],
+                               dtype=np.float64)
+        self.tiemat[ivar, np.arange(nvar)] = 1.
+        self.tieoff[ivar] = 0.
+        exprs = self.__order_exprs(params)
+        # coefficients from unit steps in each free parameter; the map is
+        # affine in a parameter if a second, random point agrees
+        self.exprs = []
+        self.nonlin = []
+        base = self.__eval_all(self.x0, exprs)
+        steps = [self.__eval_all(self.x0 + np.eye(nvar)[k], exprs)
+                 for k in range(nvar)]
+        rng = np.random.default_rng(0)
+        xtest = self.x0 + rng.uniform(0.5, 1.5, nvar) * \
+            np.maximum(np.abs(self.x0), 1.)
+        test = self.__eval_all(xtest, exprs)
+        for name, code in exprs:
+            k = index[name]
+            coeffs = np.array([step[k] - base[k] for step in steps])
+            offset = base[k] - coeffs @ self.x0
+            predict = offset + coeffs @ xtest
+            if np.isfinite(predict) and \
+                    np.isclose(predict, test[k], rtol=1e-9,
+                               atol=1e-12*max(abs(test[k]), 1.)):
+                self.tiemat[k, :] = coeffs
+                self.tieoff[k] = offset
+            else:
+                self.exprs.append((name, code))
+                self.nonlin.append(k)
+        self.nonlin = np.array(self.nonlin, dtype=int)
+
+    def __order_exprs(self, params):
+        # Compiled tie expressions, in an order in which they can be
+        # evaluated
+        tokens = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+        deps = dict()
+        codes = dict()
+        for name, par in params.items():
+            if par.expr:
+                deps[name] = set(tokens.findall(par.expr)) & set(params)
+                codes[name] = compile(par.expr, name, 'eval')
+        exprs = []
+        done = set()
+        while len(exprs) < len(codes):
+            nadded = 0
+            for name in codes:
+                if name in done or \
+                        any(d in codes and d not in done for d in deps[name]):
+                    continue
+                done.add(name)
+                exprs.append((name, codes[name]))
+                nadded += 1
+            if nadded == 0:
+                raise ValueError('LINEMODEL: circular parameter ties')
+        return exprs
+
+    def __eval_all(self, xvals, exprs):
+        # Full parameter vector from the free parameters, evaluating the
+        # tie expressions in exprs after the tie matrix
+        values = self.tiemat @ xvals + self.tieoff
+        if len(exprs) > 0:
+            namespace = dict(_exprfuncs, **dict(zip(self.names, values)))
+            for name, code in exprs:
+                values[self.index[name]] = namespace[name] = \
+                    eval(code, {'__builtins__': {}}, namespace)
+        return values
+
+    def values(self, xvals):
+        '''
+        Full parameter vector from the free parameters.
+        '''
+        return self.__eval_all(xvals, self.exprs)
+
+    def __gaussians(self, x, values):
+        # Gaussians of all components, dblarr(ncomp, npix), and the pieces
+        # needed for their derivatives. If windowed, these cover only the
+        # pixels spanned by the windows, given by the returned slice, and
+        # are zero outside of each component's window.
+        flx = values[self.iflx][:, np.newaxis]
+        cwv = values[self.icwv][:, np.newaxis]
+        sig = values[self.isig][:, np.newaxis]
+        srs = values[self.isrs][:, np.newaxis]
+        sigs = np.sqrt(np.power((sig/c)*cwv, 2.) + np.power(srs, 2.))
+        if self.windowed:
+            halfwidth = self.nsigwin*sigs
+            lo = np.searchsorted(x, np.min(cwv - halfwidth), side='left')
+            hi = np.searchsorted(x, np.max(cwv + halfwidth), side='right')
+        else:
+            lo, hi = 0, len(x)
+        dx = x[np.newaxis, lo:hi] - cwv
+        expon = np.exp(-np.power(dx / sigs, 2.)/2.)
+        if self.windowed:
+            expon[np.abs(dx) > halfwidth] = 0.
+        return flx, cwv, sig, sigs, dx, expon, slice(lo, hi)
+
+    def __convolve(self, x, rows, values, sl):
+        # Convolve each row with its component's spectral resolution. Returns
+        # the rows and the slice of x that they cover.
+        if not self.convolve:
+            return rows, sl
+        full = np.zeros((rows.shape[0], len(x)))
+        full[:, sl] = rows
+        for k, specres in enumerate(self.specres):
+            if specres is not None:
+                full[k, :] = specres.spect_convolver(x, full[k, :],
+                                                     values[self.icwv[k]])
+        return full, slice(None)
+
+    def eval(self, x, values):
+        '''
+        Evaluate the model.
+
+        :Params:
+            x: in, required, type=dblarr(npix)
+                Wavelengths.
+            values: in, required, type=dblarr(npar)
+                Full parameter vector, as from VALUES.
+
+        :Returns:
+            dblarr(npix) with the sum of the components.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        flx, _, _, _, _, expon, sl = self.__gaussians(x, values)
+        rows, sl = self.__convolve(x, flx*expon, values, sl)
+        model = np.zeros(len(x))
+        model[sl] = rows.sum(axis=0)
+        return model
+
+    def jacobian(self, x, xvals):
+        '''
+        Derivatives of the model with respect to the free parameters.
+
+        :Params:
+            x: in, required, type=dblarr(npix)
+                Wavelengths.
+            xvals: in, required, type=dblarr(nvar)
+                Free parameters.
+
+        :Returns:
+            dblarr(npix, nvar)
+        '''
+        values = self.values(xvals)
+        flx, cwv, sig, sigs, dx, expon, sl = self.__gaussians(x, values)
+        gaussian = flx*expon
+        dgdsigs = gaussian*np.power(dx, 2.)/np.power(sigs, 3.)
+        dflx, _ = self.__convolve(x, expon, values, sl)
+        dcwv, _ = self.__convolve(x, gaussian*dx/np.power(sigs, 2.) +
+                                  dgdsigs*np.power(sig/c, 2.)*cwv/sigs,
+                                  values, sl)
+        dsig, sl = self.__convolve(x, dgdsigs*np.power(cwv/c, 2.)*sig/sigs,
+                                   values, sl)
+        # chain rule through the tie map
+        dvals = self.dvalues(xvals, values)
+        jac = np.zeros((len(x), len(xvals)))
+        jac[sl, :] = dflx.T @ dvals[self.iflx, :] + \
+            dcwv.T @ dvals[self.icwv, :] + dsig.T @ dvals[self.isig, :]
+        return jac
+
+    def dvalues(self, xvals, values=None):
+        '''
+        Derivatives of the full parameter vector with respect to the free
+        parameters, dblarr(npar, nvar). Rows of affine ties come from the
+        tie matrix; the others are taken by central difference.
+        '''
+        dvals = self.tiemat.copy()
+        if len(self.exprs) > 0:
+            for k in range(len(xvals)):
+                step = 1e-6*max(abs(xvals[k]), 1e-6)
+                hi = np.array(xvals, dtype=np.float64)
+                hi[k] += step
+                lo = np.array(xvals, dtype=np.float64)
+                lo[k] -= step
+                dvals[self.nonlin, k] = \
+                    (self.values(hi)[self.nonlin] -
+                     self.values(lo)[self.nonlin]) / (2.*step)
+        return dvals
+
+    def fit(self, y, x, weights, fit_kws=None):
+        '''
+        Fit the model with scipy.optimize.least_squares.
+
+        :Params:
+            y: in, required, type=dblarr(npix)
+                Data, with no non-finite values.
+            x: in, required, type=dblarr(npix)
+                Wavelengths.
+            weights: in, required, type=dblarr(npix)
+                Inverse errors.
+            fit_kws: in, optional, type=dict
+                Keywords for least_squares, as for lmfit.
+
+        :Returns:
+            LINEFIT instance.
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        kws = dict() if fit_kws is None else dict(fit_kws)
+        if 'jac' not in kws:
+            kws['jac'] = \
+                lambda xvals: self.jacobian(x, xvals)*weights[:, np.newaxis]
+
+        def resid(xvals):
+            return (self.eval(x, self.values(xvals)) - y)*weights
+
+        out = least_squares(resid, self.x0, bounds=(self.lower, self.upper),
+                            **kws)
+        return LINEFIT(self, out, x, weights)
+
+
+class LINEFIT:
+    '''
+    Result of LINEMODEL.FIT, with the attributes of lmfit's ModelResult that
+    FITSPEC uses: params, best_values, covar, nfree, redchi, chisqr, nfev,
+    bic, aic, success, and message.
+    '''
+
+    def __init__(self, linemod, out, x, weights):
+        self.linemod = linemod
+        self.success = out.success
+        self.message = out.message
+        self.nfev = out.nfev
+        xbest = out.x
+        values = linemod.values(xbest)
+        self.ndata = len(x)
+        self.nvarys = len(xbest)
+        self.nfree = self.ndata - self.nvarys
+        self.chisqr = np.sum(np.power(out.fun, 2.))
+        self.redchi = self.chisqr / max(self.nfree, 1)
+        # information criteria, as computed by lmfit
+        _neg2_log_likel = self.ndata * np.log(self.chisqr / self.ndata)
+        self.aic = _neg2_log_likel + 2. * self.nvarys
+        self.bic = _neg2_log_likel + np.log(self.ndata) * self.nvarys
+
+        # covariance from the Jacobian at the solution, scaled by the reduced
+        # chi-squared as lmfit does; tied errors propagated through the map
+        self.covar = None
+        stderr = np.full(len(values), np.nan)
+        try:
+            self.covar = np.linalg.inv(out.jac.T @ out.jac) * self.redchi
+        except np.linalg.LinAlgError:
+            pass
+        if self.covar is not None and np.all(np.diag(self.covar) >= 0.):
+            dvals = linemod.dvalues(xbest, values)
+            stderr = np.sqrt(np.abs(np.einsum('ij,jk,ik->i', dvals,
+                                              self.covar, dvals)))
+        self.params = copy.deepcopy(linemod.params)
+        for k, name in enumerate(linemod.names):
+            par = self.params[name]
+            if not par.expr:
+                par.value = values[k]
+            if self.covar is not None and (par.vary or par.expr):
+                par.stderr = stderr[k]
+            else:
+                par.stderr = None
+        self.best_values = dict(zip(linemod.names, values))
+
+    def eval(self, x):
+        '''
+        Evaluate the best-fit model at wavelengths x.
+        '''
+        return self.linemod.eval(x, np.array(list(self.best_values.values())))
+
+    def fit_report(self, show_correl=False):
+        '''
+        Parameter report, as from lmfit.
+        '''
+        return fit_report(self.params, show_correl=show_correl)
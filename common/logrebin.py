@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Log-rebinning for PPXF as a cached sparse operator.
+
+ppxf's log_rebin is linear in the spectrum, and its output depends only on
+the wavelength range and the number of pixels. LOG_REBIN_OPERATOR builds
+that linear map as a sparse matrix once per (range, npix), directly from
+the overlaps of the linear and logarithmic pixels, following log_rebin's
+algorithm (flux=False, velscale=None, oversample=1); its output is the same
+as log_rebin's to rounding. After that, rebinning any number of spectra on
+that grid is one sparse product.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import numpy as np
+
+from scipy import sparse
+
+# speed of light in km/s, as in log_rebin
+c = 299792.458
+# Operators, by (wavelength range, # of pixels); oldest dropped first
+_operators = dict()
+_maxoperators = 16
+
+
+def log_rebin_operator(lamrange, npix):
+    '''
+    Get the log-rebinning operator for a linear wavelength grid.
+
+    :Params:
+        lamrange: in, required, type=dblarr(2)
+            First and last wavelengths of the grid, as passed to log_rebin.
+        npix: in, required, type=int
+            Number of pixels.
+
+    :Returns:
+        Sparse matrix of shape (npix, npix), and the log wavelengths and
+        velocity scale, as returned by log_rebin.
+    '''
+    key = (float(lamrange[0]), float(lamrange[1]), int(npix))
+    if key not in _operators:
+        # pixel edges, as in log_rebin
+        lam = np.array(key[0:2])
+        dlam = (lam[1] - lam[0])/(npix - 1)
+        lim = lam + np.array([-0.5, 0.5])*dlam
+        borders = np.linspace(*lim, npix + 1)
+        lnlim = np.log(lim)
+        velscale = c*(lnlim[1] - lnlim[0])/npix
+        newborders = np.exp(lnlim[0] + velscale/c*np.arange(npix + 1))
+        # linear pixel holding each log pixel edge
+        k = ((newborders - lim[0])/dlam).clip(0, npix-1).astype(int)
+        # Log pixel m gets linear pixels k[m] to k[m+1]-1 in full, plus the
+        # part of pixel k[m+1] below its upper edge, less the part of
+        # pixel k[m] below its lower edge
+        nfull = np.diff(k)
+        frac = (newborders - borders[k])
+        rows = np.concatenate([np.repeat(np.arange(npix), nfull),
+                               np.arange(npix), np.arange(npix)])
+        cols = np.concatenate([np.arange(k[0], k[-1]), k[1:], k[:-1]])
+        vals = np.concatenate([np.full(k[-1] - k[0], dlam), frac[1:],
+                               -frac[:-1]])
+        op = sparse.csr_matrix((vals, (rows, cols)), shape=(npix, npix))
+        # flux density
+        op = sparse.diags(1./np.diff(newborders)) @ op
+        lnlam = 0.5*np.log(newborders[1:]*newborders[:-1])
+        if len(_operators) >= _maxoperators:
+            del _operators[next(iter(_operators))]
+        _operators[key] = (op.tocsr(), lnlam, velscale)
+    return _operators[key]
+
+
+def log_rebin_spectra(lamrange, spec):
+    '''
+    Log-rebin one or more spectra with the cached operator.
+
+    :Params:
+        lamrange: in, required, type=dblarr(2)
+            First and last wavelengths of the grid.
+        spec: in, required, type=dblarr(npix) or dblarr(npix, nspec)
+            Spectra, on a linear wavelength grid.
+
+    :Returns:
+        Rebinned spectra, log wavelengths, and velocity scale, as from
+        log_rebin.
+    '''
+    spec = np.asarray(spec, dtype=np.float64)
+    op, lnlam, velscale = log_rebin_operator(lamrange, spec.shape[0])
+    return op @ spec, lnlam, velscale
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Choose the number of line components by fitting the candidates side by
+side, rather than by the serial refits of FITLOOP's checkcomp loop.
+
+Set initdat['ncompselect'] to a dict, possibly empty, to turn it on. Its
+optional keys are:
+
+   method: in, optional, type=string, default='checkcomp'
+     How to choose among the candidates. 'checkcomp' picks the candidate
+     with the most components that FCNCHECKCOMP (default CHECKCOMP, with
+     ARGSCHECKCOMP) accepts as is. 'bic' or 'aic' picks the candidate with
+     the lowest Bayesian or Akaike information criterion of the line fit.
+   ncores: in, optional, type=int, default=1
+     Number of processes over which to split the candidate fits. The pool
+     is started the first time it is needed and reused for every spaxel
+     after that. Ignored in the worker processes of Q3DF's 'processes'
+     backend, which can't start processes of their own; most useful when
+     Q3DF runs on one core.
+
+Candidate k has min(k, ncomp) components in each line, for k from 1 to the
+largest ncomp of the spaxel (and, for 'checkcomp', k = 0). All candidates
+reuse the continuum fit and the initial guesses from the second fit with
+all components, so each is a single line fit.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import atexit
+import copy
+import importlib
+import multiprocessing as mp
+
+from concurrent.futures import ProcessPoolExecutor
+from q3dfit.common.fitspec import fitspec
+from q3dfit.common.sepfitpars import sepfitpars
+
+# Pool for the candidate fits, and its number of processes
+_pool = None
+_poolsize = 0
+
+
+def __get_pool(ncores):
+    # The process's pool, started on first use; the cost of starting it
+    # is paid once per run rather than once per spaxel
+    global _pool, _poolsize
+    if _pool is None or _poolsize != ncores:
+        shutdown_pool()
+        if 'fork' in mp.get_all_start_methods():
+            ctx = mp.get_context('fork')
+        else:
+            ctx = mp.get_context()
+        _pool = ProcessPoolExecutor(max_workers=ncores, mp_context=ctx)
+        _poolsize = ncores
+    return _pool
+
+
+@atexit.register
+def shutdown_pool():
+    '''
+    Stop the pool for the candidate fits, if one was started.
+    '''
+    global _pool, _poolsize
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+        _poolsize = 0
+
+
+def __fit_candidate(args):
+    # One candidate fit; a separate function so that it can run in a pool
+    fitargs, fitkwargs = args
+    return fitspec(*fitargs, **fitkwargs)
+
+
+def __checkcomp_accepts(struct, listlines, ncomp, initdat):
+    # True if FCNCHECKCOMP would keep all components of this fit
+    if 'fcncheckcomp' in initdat:
+        fcnname = initdat['fcncheckcomp']
+    else:
+        fcnname = 'checkcomp'
+    module = importlib.import_module('q3dfit.common.' + fcnname)
+    fcncheckcomp = getattr(module, fcnname)
+    linepars = sepfitpars(listlines, struct['param'], struct['perror'],
+                          initdat['maxncomp'])
+    # checkcomp changes ncomp in place
+    ncomp_tmp = dict(ncomp)
+    if 'argscheckcomp' in initdat:
+        newncomp = fcncheckcomp(linepars, initdat['linetie'], ncomp_tmp,
+                                struct['siglim'], **initdat['argscheckcomp'])
+    else:
+        newncomp = fcncheckcomp(linepars, initdat['linetie'], ncomp_tmp,
+                                struct['siglim'])
+    return len(newncomp) == 0
+
+
+def ncompselect(wave, flux, err, dq, listlines, ncomp, specConv, initdat,
+                struct, siglim_gas=None, tweakcntfit=None, quiet=True,
+                logfile=None, gdmask=None):
+    '''
+    Fit the candidate numbers of components and choose one.
+
+    :Params:
+        wave, flux, err, dq: in, required, type=dblarr(nwave)
+            Spectrum, as passed to FITSPEC.
+        listlines: in, required, type=Table
+            Output of LINELIST.
+        ncomp: in, required, type=hash(lines)
+            Number of components in STRUCT.
+        specConv: in, required, type=object
+            Spectral resolution, as passed to FITSPEC.
+        initdat: in, required, type=dict
+            Initialization dictionary.
+        struct: in, required, type=dict
+            Output of FITSPEC with NCOMP components.
+        siglim_gas, tweakcntfit, gdmask: in, optional
+            As passed to FITSPEC.
+
+    :Returns:
+        Output of FITSPEC for the chosen candidate; its NCOMP; and the total
+        number of function evaluations in the candidate fits.
+    '''
+    if logfile is None:
+        from sys import stdout
+        logfile = stdout
+    args = initdat['ncompselect']
+    method = args.get('method', 'checkcomp')
+    if method not in ['checkcomp', 'bic', 'aic']:
+        raise ValueError("NCOMPSELECT: method must be 'checkcomp', " +
+                         "'bic', or 'aic'.")
+    ncores = args.get('ncores', 1)
+
+    # initial guesses from the fit with all components
+    linepars = sepfitpars(listlines, struct['param'], struct['perror'],
+                          initdat['maxncomp'])
+    if 'masksig_secondfit' in initdat:
+        masksig_secondfit = initdat['masksig_secondfit']
+    else:
+        masksig_secondfit = 2.  # should match fitloop
+    maskwidths = linepars['sigma_obs']
+    for col in maskwidths.columns:
+        maskwidths[col] *= masksig_secondfit
+
+    maxk = max(ncomp.values())
+    candidates = {maxk: (struct, ncomp)}
+    if method == 'checkcomp':
+        klist = range(maxk-1, -1, -1)
+    else:
+        klist = range(maxk-1, 0, -1)
+    jobs = []
+    for k in klist:
+        ncomp_k = {line: min(nc, k) for line, nc in ncomp.items()}
+        # fitspec overwrites unused components of these in place
+        fitargs = (wave, flux, err, dq, struct['zstar'], listlines,
+                   copy.deepcopy(linepars['wave']), ncomp_k, specConv,
+                   initdat)
+        fitkwargs = {'quiet': quiet,
+                     'maskwidths': copy.deepcopy(maskwidths),
+                     'peakinit': copy.deepcopy(linepars['fluxpk_obs']),
+                     'siginit_gas': copy.deepcopy(linepars['sigma']),
+                     'siglim_gas': siglim_gas, 'tweakcntfit': tweakcntfit,
+                     'contfit': struct, 'gdmask': gdmask}
+        jobs.append((k, ncomp_k, (fitargs, fitkwargs)))
+
+    # Pool workers can't start processes of their own
+    if ncores > 1 and len(jobs) > 1 and not mp.current_process().daemon:
+        results = __get_pool(ncores).map(__fit_candidate,
+                                         [job[2] for job in jobs])
+        for (k, ncomp_k, _), result in zip(jobs, results):
+            candidates[k] = (result, ncomp_k)
+    else:
+        for k, ncomp_k, job in jobs:
+            candidates[k] = (__fit_candidate(job), ncomp_k)
+    nfev = sum(candidates[k][0]['nfev'] for k, _, _ in jobs)
+
+    if method == 'checkcomp':
+        # most components that are all significant; if none, no lines
+        best = 0
+        for k in sorted(candidates, reverse=True):
+            if k == 0 or __checkcomp_accepts(candidates[k][0], listlines,
+                                             candidates[k][1], initdat):
+                best = k
+                break
+    else:
+        crit = {k: cand[0][method] for k, cand in candidates.items()}
+        best = min(crit, key=crit.get)
+    print(f'NCOMPSELECT: Chose {best} of up to {maxk} components by ' +
+          f'{method}.', file=logfile)
+    return candidates[best][0], candidates[best][1], nfev
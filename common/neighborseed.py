@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Initial guesses for a spaxel's fit from the fits to its neighbors.
+
+Adjacent spaxels usually have nearly the same kinematics, so the best-fit
+line wavelengths and widths and the stellar redshift of a neighbor are
+better starting points than the global initial guesses. Set
+initdat['neighborseed'] to use them. Q3DF then visits the spaxels along a
+Hilbert curve, so that most spaxels have a neighbor that is already fit.
+
+Seeds change only the starting values of the fit. The limits on the line
+wavelengths and the masks around the lines are still set from the
+unseeded guesses (zinit_gas), so they can't drift from spaxel to spaxel
+along the curve. A neighbor is used only if its fit is current, i.e., its
+FITHASH matches that of the present initialization and the neighbor's
+data; fits left by other runs are ignored. Seeding is not done for
+Voronoi-binned data.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import numpy as np
+import os
+
+from q3dfit.common.checkpoint import fit_label, fithash, initdathash, \
+    spaxel_spectrum
+from q3dfit.common.fitstore import store_index
+from q3dfit.common.lmlabel import lmlabel
+
+
+def __neighbor_fit(cube, initdat, i, j, store, inithash):
+    # Output of FITSPEC for spaxel [i, j], or None if it hasn't been fit
+    # with the present initialization and data
+    hash = fithash(initdat, cube.wave, *spaxel_spectrum(cube, i, j),
+                   inithash=inithash)
+    if store is not None:
+        istore, jstore = store_index(cube, i, j)
+        if store.fit_status(istore, jstore) != 1 or \
+                not store.is_current(istore, jstore, hash):
+            return None
+        return store.read(istore, jstore, cube.wave)
+    outfile = fit_label(initdat, cube, i, j) + '.npy'
+    if not os.path.isfile(outfile):
+        return None
+    try:
+        struct = np.load(outfile, allow_pickle=True).item()
+    except Exception:
+        return None
+    # no-detection records from PRESCREEN have nothing to seed from
+    if 'nodetect' in struct or struct.get('fithash') != hash:
+        return None
+    return struct
+
+
+def neighbor_seed(cube, initdat, i, j, store=None):
+    '''
+    Find the neighbor of spaxel [i, j] with the best existing fit.
+
+    :Params:
+        cube: in, required, type=object
+            Output of READCUBE.
+        initdat: in, required, type=dict
+            Initialization dictionary.
+        i, j: in, required, type=int
+            Column and row of the spaxel, 0-offset.
+        store: in, optional, type=object
+            FITSTORE holding the fits, if initdat['resultstore'] is set.
+
+    :Returns:
+        Output of FITSPEC for the neighbor with the lowest reduced chi-squared
+        of its line fit, or None if no neighbor has been fit.
+    '''
+    if cube.dat.ndim == 1 or 'vormap' in initdat:
+        return None
+    if cube.dat.ndim == 2:
+        offsets = [(-1, 0), (1, 0)]
+    else:
+        offsets = [(di, dj) for di in [-1, 0, 1] for dj in [-1, 0, 1]
+                   if di != 0 or dj != 0]
+    # the cube may hold only part of the spaxels
+    col0 = getattr(cube, 'col0', 0)
+    row0 = getattr(cube, 'row0', 0) if cube.dat.ndim == 3 else 0
+    ncols = cube.dat.shape[0] if cube.dat.ndim == 3 else cube.ncols
+    nrows = cube.dat.shape[1] if cube.dat.ndim == 3 else 1
+    inithash = initdathash(initdat)
+    best = None
+    for di, dj in offsets:
+        ni = i + di
+        nj = j + dj
+        if ni < col0 or ni >= col0 + ncols or \
+                nj < row0 or nj >= row0 + nrows:
+            continue
+        struct = __neighbor_fit(cube, initdat, ni, nj, store, inithash)
+        if struct is None:
+            continue
+        if best is None or struct['redchisq'] < best['redchisq']:
+            best = struct
+    return best
+
+
+def apply_seed(seed, initdat, ncomp, listlinesz, siginit_gas, zstar,
+               siginit_gas_def=100.):
+    '''
+    Starting values from a neighbor's fit.
+
+    :Params:
+        seed: in, required, type=dict
+            Output of NEIGHBOR_SEED.
+        initdat: in, required, type=dict
+            Initialization dictionary.
+        ncomp: in, required, type=hash(lines)
+            Number of components fit to each line in this spaxel.
+        listlinesz: in, required, type=hash(lines\\,maxncomp)
+            Initial guesses for observed-frame line wavelengths. These are
+            not changed; they still set the wavelength limits and masks.
+        siginit_gas: in, required, type=hash(lines\\,maxncomp)
+            Initial guesses for line widths, or False if not set.
+        zstar: in, required, type=double
+            Initial guess for stellar redshift.
+        siginit_gas_def: in, optional, type=double, default=100.
+            Line width for components with no other initial guess.
+
+    :Returns:
+        Starting line wavelengths, hash(lines\\,maxncomp), NaN where the
+        neighbor has none (pass to FITSPEC as CWVINIT); new siginit_gas;
+        and new zstar. Components that the neighbor did not fit keep their
+        original guesses.
+    '''
+    if np.isfinite(seed['zstar']):
+        zstar = seed['zstar']
+    cwvinit = dict()
+    newsiginit = dict()
+    for line in listlinesz:
+        cwvinit[line] = np.full(len(listlinesz[line]), np.nan)
+        if isinstance(siginit_gas, dict):
+            newsiginit[line] = np.array(siginit_gas[line], dtype=float)
+        else:
+            newsiginit[line] = np.zeros(initdat['maxncomp']) + \
+                siginit_gas_def
+        if not isinstance(seed['param'], dict):
+            continue
+        lmline = lmlabel(line)
+        for comp in range(ncomp[line]):
+            cwv = seed['param'].get(f'{lmline.lmlabel}_{comp}_cwv')
+            sig = seed['param'].get(f'{lmline.lmlabel}_{comp}_sig')
+            if cwv is not None and sig is not None and \
+                    np.isfinite(cwv) and np.isfinite(sig):
+                cwvinit[line][comp] = cwv
+                newsiginit[line][comp] = sig
+    return cwvinit, newsiginit, zstar
+
+
+def seed_wavelengths(fit_params, cwvinit, ncomp):
+    '''
+    Set the starting line wavelengths of a set of parameters, within their
+    limits, leaving the limits as they are.
+
+    :Params:
+        fit_params: in, required, type=lmfit.Parameters
+            Output of the INITPAR function. Changed in place.
+        cwvinit: in, required, type=hash(lines\\,maxncomp)
+            Starting wavelengths; see APPLY_SEED. NaN values are skipped.
+        ncomp: in, required, type=hash(lines)
+            Number of components fit to each line.
+    '''
+    for line, cwvs in cwvinit.items():
+        lmline = lmlabel(line)
+        for comp in range(ncomp.get(line, 0)):
+            name = f'{lmline.lmlabel}_{comp}_cwv'
+            if name not in fit_params or not np.isfinite(cwvs[comp]):
+                continue
+            par = fit_params[name]
+            # tied wavelengths follow the line they're tied to
+            if par.expr:
+                continue
+            par.set(value=np.clip(cwvs[comp], par.min, par.max))
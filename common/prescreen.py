@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cube-wide signal pre-screen, to skip fitting spaxels with no detected
+continuum or line emission.
+
+Set initdat['prescreen'] to True, or to a dict of options, to turn it on.
+The optional keys of the dict are:
+
+   snrcont: in, optional, type=double, default=3.
+     Minimum median S/N per pixel of the continuum.
+   snrline: in, optional, type=double, default=3.
+     Minimum S/N of the flux above the continuum in any line window.
+   linewin: in, optional, type=double, default=500.
+     Half-width of the line windows, in km/s, around each line at its
+     initial redshift (first component).
+
+A spaxel is fit if it passes either threshold. Otherwise Q3DF writes a
+short record in place of the fit, with tags NODETECT, SNRCONT, SNRLINE, and
+FITHASH, and Q3DA skips it.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import numpy as np
+
+from astropy.constants import c
+
+snrcont_def = 3.
+snrline_def = 3.
+linewin_def = 500.
+
+
+def prescreen(cube, initdat, listlines, colarr, rowarr):
+    '''
+    Compute the continuum and line S/N of each spaxel to be fit.
+
+    :Params:
+        cube: in, required, type=object
+            Output of READCUBE.
+        initdat: in, required, type=dict
+            Initialization dictionary.
+        listlines: in, required, type=Table
+            Output of LINELIST.
+        colarr, rowarr: in, required, type=intarr(nspax)
+            Columns and rows of the spaxels to be fit, 0-offset.
+
+    :Returns:
+        Boolean array over spaxels, True where the spaxel should be fit; a
+        dblarr(nspax) with the continuum S/N; and a dict of dblarr(nspax)
+        with the S/N in each line window.
+    '''
+    args = initdat['prescreen']
+    if not isinstance(args, dict):
+        args = dict()
+    snrcont_min = args.get('snrcont', snrcont_def)
+    snrline_min = args.get('snrline', snrline_def)
+    linewin = args.get('linewin', linewin_def) / c.to('km/s').value
+
+    nspax = len(colarr)
+    lines = []
+    if 'noemlinfit' not in initdat:
+        lines = initdat['lines']
+    snrcont = np.zeros(nspax)
+    snrline = {line: np.zeros(nspax) for line in lines}
+    wave = cube.wave[np.newaxis, :]
+    # in chunks, to limit memory use
+    chunk = 1024
+    for k in range(0, nspax, chunk):
+        sl = slice(k, k+chunk)
+        if cube.dat.ndim == 1:
+            flux = cube.dat[np.newaxis, :]
+            err = cube.err[np.newaxis, :]
+            dq = cube.dq[np.newaxis, :]
+        elif cube.dat.ndim == 2:
+            flux = cube.dat[:, colarr[sl]].T
+            err = cube.err[:, colarr[sl]].T
+            dq = cube.dq[:, colarr[sl]].T
+        else:
+            icube = colarr[sl] - cube.col0
+            jcube = rowarr[sl] - cube.row0
+            flux = cube.dat[icube, jcube, :]
+            err = cube.err[icube, jcube, :]
+            dq = cube.dq[icube, jcube, :]
+        good = np.isfinite(flux) & np.isfinite(err) & (err > 0.) & (dq == 0)
+        flux = np.where(good, flux, np.nan)
+        var = np.where(good, err, np.nan)**2.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snrcont[sl] = np.nanmedian(flux / np.sqrt(var), axis=1)
+            cont = np.nanmedian(flux, axis=1)[:, np.newaxis]
+            for line in lines:
+                zinit = np.asarray(initdat['zinit_gas'][line])
+                if zinit.ndim == 3:
+                    zinit = zinit[colarr[sl], rowarr[sl], 0]
+                elif zinit.ndim == 2:
+                    zinit = zinit[colarr[sl], 0]
+                else:
+                    zinit = np.atleast_1d(zinit)[0]
+                wline = listlines['lines'][listlines['name'] == line][0] * \
+                    (1. + np.broadcast_to(zinit, (flux.shape[0],)))
+                inwin = np.abs(wave - wline[:, np.newaxis]) <= \
+                    wline[:, np.newaxis] * linewin
+                sumflux = np.nansum(np.where(inwin, flux - cont, 0.), axis=1)
+                sumvar = np.nansum(np.where(inwin, var, 0.), axis=1)
+                snrline[line][sl] = sumflux / np.sqrt(sumvar)
+    snrcont = np.nan_to_num(snrcont)
+    dofit = snrcont >= snrcont_min
+    for line in lines:
+        snrline[line] = np.nan_to_num(snrline[line])
+        dofit |= snrline[line] >= snrline_min
+    return dofit, snrcont, snrline
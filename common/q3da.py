@@ -3,8 +3,9 @@
 Routine to plot the continuum and emission lines fits to a spectrum.
 
 As input, it requires a dictionary of initialization parameters and the output
-dictionary, struct.npy, from Q3DF. The tags for the initialization structure
-can be found in INITTAGS.txt.
+dictionary, struct.npy, from Q3DF (or, if initdat['resultstore'] is set, the
+result store written by Q3DF; see FITSTORE). The tags for the initialization
+structure can be found in INITTAGS.txt.
 ----------
 Returns: Nothing
 ----------
@@ -38,7 +39,8 @@ import pdb
 from astropy.table import Table
 from ppxf.ppxf_util import log_rebin
 from q3dfit.common.linelist import linelist
-from q3dfit.common.readcube import CUBE
+from q3dfit.common.fitstore import FITSTORE, store_index, store_path
+from q3dfit.common.readcube import CUBE, VORBINS
 from q3dfit.common.sepfitpars import sepfitpars
 from q3dfit.common import qsohostfcn
 from q3dfit.exceptions import InitializationError
@@ -147,12 +149,10 @@ def q3da(initproc, cols=None, rows=None, noplots=False, quiet=True,
                     dqext=dqext)
 
     if 'vormap' in initdat:
-        vormap = initdat['vormap']
-        nvorcols = max(vormap)
-        vorcoords = np.zeros(nvorcols, 2)
-        for i in range(0, nvorcols):
-            xyvor = np.where(vormap == i).nonzero()
-            vorcoords[:, i] = xyvor  # TODO
+        # for each spaxel, the first spaxel of its bin, which holds the
+        # bin's fit; -1 for spaxels in no bin
+        vorbins = VORBINS(initdat['vormap'])
+        vorspax = vorbins.to_map(vorbins.vorcoords, fill=-1)
 
 
 # INITIALIZE OUTPUT FILES, need to write helper functions (printlinpar,
@@ -219,6 +219,12 @@ def q3da(initproc, cols=None, rows=None, noplots=False, quiet=True,
             irow = initdat['flipsort'][1][i]-1
             flipsort[icol, irow] = bytes(1)  # b
 
+    # fits are either in a consolidated store or in one file per spaxel
+    if initdat.get('resultstore', False):
+        store = FITSTORE(store_path(initdat))
+    else:
+        store = None
+
     # LOOP THROUGH SPAXELS
 
     # switch to track when first continuum processed
@@ -259,12 +265,16 @@ def q3da(initproc, cols=None, rows=None, noplots=False, quiet=True,
                 flux = cube.dat
                 err = cube.err
                 dq = cube.dq
+                iuse = i
+                juse = j
                 labin = '{[outdir]}{[label]}'.format(initdat, initdat)
                 labout = labin
             elif cube.dat.ndim == 2:
                 flux = cube.dat[:, i]
                 err = cube.err[:, i]
                 dq = cube.dq[:, i]
+                iuse = i
+                juse = j
                 labin = '{[outdir]}{[label]}_{:04d}'.\
                     format(initdat, initdat, i+1)
                 labout = labin
@@ -273,11 +283,8 @@ def q3da(initproc, cols=None, rows=None, noplots=False, quiet=True,
                     print(f'    Row {j+1} of {cube.nrows}')
 
                 if 'vormap' in initdat:
-                    if np.isfinite(initdat['vormap'][i][j]) and \
-                            (initdat['vormap'][i][j] is not bad):
-                        iuse = vorcoords[initdat['vormap'][i][j] - 1, 0]
-                        juse = vorcoords[initdat['vormap'][i][j] - 1, 1]
-                    else:
+                    iuse, juse = vorspax[i, j]
+                    if iuse < 0:
                         novortile = True
                 else:
                     iuse = i
@@ -299,19 +306,36 @@ def q3da(initproc, cols=None, rows=None, noplots=False, quiet=True,
                 outfile = labout
                 nodata = flux.nonzero()
                 ct = len(nodata[0])
-                filepresent = os.path.isfile(infile)  # check file
+                if store is not None:
+                    istore, jstore = store_index(cube, iuse, juse)
+                    filepresent = store.status[istore, jstore] == 1
+                    nodetect = store.status[istore, jstore] == 2
+                else:
+                    filepresent = os.path.isfile(infile)  # check file
+                    nodetect = False
+                    if filepresent:
+                        struct = \
+                            (np.load(infile, allow_pickle='TRUE')).item()
+                        # spaxel skipped by the pre-screen in Q3DF
+                        nodetect = 'nodetect' in struct
             else:
                 # missing Voronoi bin for this spaxel
                 filepresent = False
+                nodetect = False
                 ct = 0
 
-            if not filepresent or ct == 0:
+            if nodetect:
+
+                print(f'        No detection in [{i+1}, {j+1}]')
+
+            elif not filepresent or ct == 0:
 
                 badmessage = f'        No data for [{i+1}, {j+1}]'
                 print(badmessage)
 
             else:
-                struct = (np.load(infile, allow_pickle='TRUE')).item()
+                if store is not None:
+                    struct = store.read(istore, jstore, cube.wave)
 
                 # Restore original error.
                 struct['spec_err'] = err[struct['fitran_indx']]
@@ -678,7 +702,8 @@ def q3da(initproc, cols=None, rows=None, noplots=False, quiet=True,
                         qsomod = qsohostfcn.qsohostfcn(struct['wave'], params_fit=par_qsohost, qsoflux = qsoflux,
                                           qsoonly=True, blrterms = blrterms,
                                           qsoscl = qsomod_polynorm, qsoord = qsoord,
-                                          hostord = hostord)
+                                          hostord = hostord,
+                                          qsoexp = initdat['argscontfit'].get('qsoexp', True))
 
     #                    qsomod = qsohostfcn.qsohostfcn(struct['wave'], params_fit=par_qsohost, qsoflux = qsoflux
     #                                                   ,blrterms = blrterms)
@@ -18,6 +18,21 @@ cols: in, optional, type=intarr, default=all
        two-element vector listing the first and last columns to fit.
      ncores: in, optional, type=int, default=1
        Number of cores to split processing over.
+     backend: in, optional, type=string, default='mpi'
+       How to split processing over multiple cores. 'mpi' launches
+       mpiexec, with each rank reading the cube itself. 'processes' uses a
+       local process pool; the inputs are read once in this process and
+       only spaxel indices are sent to the workers. Use 'processes' in
+       Jupyter or where MPI is not available.
+     batchsize: in, optional, type=int, default=1
+       Number of spaxels handed to a worker at a time when ncores > 1.
+       Spaxels are ordered by an estimate of their fitting cost and given
+       out on demand, so that slow spaxels don't hold up one core. With
+       MPI, one rank coordinates and the others fit.
+     resume: in, optional, type=byte, default=False
+       Resume an interrupted run: skip spaxels whose output file holds a
+       complete fit made with the same initialization parameters and input
+       data, and refit the rest.
      rows: in, optional, type=intarr, default=all
        Rows to fit, in 1-offset format. Either a scalar or a
        two-element vector listing the first and last rows to fit.
@@ -46,10 +61,17 @@ __last_modified__ = '2021 Feb 22'
 # invoke the correct q3df helper function depending on whether this is to a
 # single or multi-threaded process
 def q3df(initproc, cols=None, rows=None, onefit=False, ncores=1,
-         quiet=True, mpipath=None):
+         quiet=True, mpipath=None, backend='mpi', batchsize=1,
+         resume=False):
+    if backend not in ['mpi', 'processes']:
+        raise ValueError("Q3DF: ERROR: backend must be 'mpi' or 'processes'.")
     if ncores == 1:
         from q3dfit.common.q3df_helperFunctions import q3df_oneCore
-        q3df_oneCore(initproc, cols, rows, onefit, quiet)
+        q3df_oneCore(initproc, cols, rows, onefit, quiet, resume)
+    elif ncores > 1 and backend == 'processes':
+        from q3dfit.common.q3df_helperFunctions import q3df_multiProcess
+        q3df_multiProcess(initproc, cols, rows, onefit, ncores, quiet,
+                          batchsize, resume)
     elif ncores > 1:
         from inspect import getfile
         from q3dfit.common import q3df_helperFunctions
@@ -67,4 +89,5 @@ def q3df(initproc, cols=None, rows=None, onefit=False, ncores=1,
         if mpipath is not None:
             mpistr = mpipath + mpistr
         call([mpistr, "-n", str(ncores), "python", filename,
-              initproc, cols, rows, str(onefit), str(quiet)])
+              initproc, cols, rows, str(onefit), str(quiet),
+              str(batchsize), str(resume)])
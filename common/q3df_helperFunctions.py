@@ -85,8 +85,14 @@ def __get_dispersion(initdat):
     else:
         return None
 
+# load the stellar templates into this process's cache, if they're used
+def __load_templates(initdat):
+    if 'startempfile' in initdat and initdat.get('fcncontfit') != 'questfit':
+        from q3dfit.common.startemp import load_template
+        load_template(initdat)
+
 # initialize CUBE object
-def __get_CUBE(initdat, quiet, logfile=None):
+def __get_CUBE(initdat, quiet, logfile=None, cols=None, rows=None):
     from q3dfit.common.readcube import CUBE
 
 #   Read data
@@ -116,16 +122,49 @@ def __get_CUBE(initdat, quiet, logfile=None):
         from sys import stdout
         logfile = stdout
     if initdat.__contains__('argsreadcube'):
-        cube = CUBE(infile=initdat['infile'], datext=datext, dqext=dqext,
-                    quiet=quiet, varext=varext, vormap=vormap,
-                    logfile=logfile, wavext=wavext, **initdat['argsreadcube'])
+        argsreadcube = dict(initdat['argsreadcube'])
     else:
-        cube = CUBE(infile=initdat['infile'], datext=datext, dqext=dqext,
-                    quiet=quiet, varext=varext, vormap=vormap,
-                    logfile=logfile, wavext=wavext)
+        argsreadcube = dict()
+#   Read only the spaxels to be fit, if asked. All wavelengths are read, so
+#   that indices into the wavelength array (e.g., FITRAN_INDX) refer to the
+#   same grid as in Q3DA.
+    if initdat.get('readroi', False) and vormap is False:
+        if cols:
+            argsreadcube['cols'] = cols
+        if rows:
+            argsreadcube['rows'] = rows
+    cube = CUBE(infile=initdat['infile'], datext=datext, dqext=dqext,
+                quiet=quiet, varext=varext, vormap=vormap,
+                logfile=logfile, wavext=wavext, **argsreadcube)
     return cube, vormap
 
 
+# Read the cube once per node and share it (SHAREDCUBE); the other ranks on
+# the node attach to the shared copy. Returns the node communicator too, for
+# cleanup. Lazy cubes are memory-mapped, so each rank opens its own.
+def __get_shared_CUBE(initdat, quiet, comm, logfile=None, cols=None,
+                      rows=None):
+    from mpi4py import MPI
+    from q3dfit.common.sharedcube import attach_cube, share_cube
+    nodecomm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    if nodecomm.Get_rank() == 0:
+        cube, vormap = __get_CUBE(initdat, quiet, logfile=logfile,
+                                  cols=cols, rows=rows)
+        if cube.lazy:
+            stub = None
+        else:
+            stub = share_cube(cube)
+        nodecomm.bcast((stub, vormap), root=0)
+    else:
+        stub, vormap = nodecomm.bcast(None, root=0)
+        if stub is None:
+            cube, vormap = __get_CUBE(initdat, quiet, logfile=logfile,
+                                      cols=cols, rows=rows)
+        else:
+            cube = attach_cube(stub)
+    return cube, vormap, nodecomm
+
+
 # construct voronoi map
 def __get_voronoi(cols, rows, vormap):
     # Voronoi binned case
@@ -144,8 +183,8 @@ def __get_spaxels(cube, cols=None, rows=None):
     # Set up 2-element arrays with starting and ending columns/rows
     # These are unity-offset to reflect pixel labels
     if not cols:
-        cols = [1, cube.ncols]
-        ncols = cube.ncols
+        cols = cube.cols
+        ncols = cols[1]-cols[0]+1
 #   case: cols is a scalar
     elif not isinstance(cols, (list, np.ndarray)):
         cols = [cols, cols]
@@ -156,8 +195,8 @@ def __get_spaxels(cube, cols=None, rows=None):
     else:
         ncols = cols[1]-cols[0]+1
     if not rows:
-        rows = [1, cube.nrows]
-        nrows = cube.nrows
+        rows = cube.rows
+        nrows = rows[1]-rows[0]+1
     elif not isinstance(rows, (list, np.ndarray)):
         rows = [rows, rows]
         nrows = 1
@@ -180,28 +219,54 @@ def __get_spaxels(cube, cols=None, rows=None):
     return nspax, colarr, rowarr
 
 
-# handle the FITLOOP execution.
-# In its own function due to commonality between single- and
-# multi-threaded execution
-def execute_fitloop(nspax, colarr, rowarr, cube, initdat, linelist, specConv,
-                    onefit, quiet, logfile=None):
-    from q3dfit.common.fitloop import fitloop
-    for ispax in range(0, nspax):
-        fitloop(ispax, colarr, rowarr, cube, initdat, linelist, specConv,
-                onefit, quiet, logfile=logfile)
-
-
-# q3df setup for single-threaded execution
-def q3df_oneCore(initproc, cols=None, rows=None, onefit=False,
-                 quiet=True):
+# If initdat['prescreen'] is set, drop spaxels with no detected signal, and
+# (if write is set) record them as such in place of a fit.
+def __prescreen_spaxels(cube, initdat, linelist, colarr, rowarr, write=True,
+                        logfile=None):
+    import numpy as np
+    from q3dfit.common.checkpoint import fithash, fit_label, save_fit, \
+        spaxel_spectrum
+    from q3dfit.common.fitstore import FITSTORE, store_index, store_path
+    from q3dfit.common.prescreen import prescreen
+    if not initdat.get('prescreen') or 'vormap' in initdat:
+        return len(colarr), colarr, rowarr
+    if logfile is None:
+        from sys import stdout
+        logfile = stdout
+    dofit, snrcont, snrline = prescreen(cube, initdat, linelist, colarr,
+                                        rowarr)
+    if write:
+        if initdat.get('resultstore', False):
+            store = FITSTORE(store_path(initdat), mode='r+')
+        else:
+            store = None
+        for ispax in np.flatnonzero(~dofit):
+            i = colarr[ispax]
+            j = rowarr[ispax]
+            # hashed as FITLOOP would
+            spaxhash = fithash(initdat, cube.wave,
+                               *spaxel_spectrum(cube, i, j))
+            if store is not None:
+                store.write_nodetect(*store_index(cube, i, j), spaxhash)
+            else:
+                save_fit(fit_label(initdat, cube, i, j),
+                         {'nodetect': True,
+                          'snrcont': snrcont[ispax],
+                          'snrline': {line: snr[ispax] for line, snr
+                                      in snrline.items()},
+                          'fithash': spaxhash})
+        if store is not None:
+            store.close()
+    print(f'Q3DF: Pre-screen found no signal in {np.sum(~dofit)} of ' +
+          f'{len(colarr)} spaxels; skipping them.', file=logfile)
+    return int(np.sum(dofit)), colarr[dofit], rowarr[dofit]
+
+
+# Get the initialization dictionary from initproc, which can be a .npy file,
+# the name of an initialization routine, a loaded ndarray, or a dict.
+def __load_initdat(initproc):
     import numpy as np
-    import time
-    from sys import path
     from q3dfit.exceptions import InitializationError
-    # add common subdirectory to Python PATH for ease of importing
-    path.append("common/")
-    starttime = time.time()
-
     # If it's a string, assume it's an input .npy file
     if type(initproc) == str:
         # When initproc was a routine rather than an input dictionary
@@ -220,6 +285,39 @@ def q3df_oneCore(initproc, cols=None, rows=None, onefit=False,
         initdat = initproc
     else:
         raise InitializationError('initproc not in expected format')
+    return initdat
+
+
+# handle the FITLOOP execution.
+# In its own function due to commonality between single- and
+# multi-threaded execution
+def execute_fitloop(nspax, colarr, rowarr, cube, initdat, linelist, specConv,
+                    onefit, quiet, logfile=None, resume=False):
+    from q3dfit.common.fitloop import fitloop
+    from q3dfit.common.fitstore import flush_stores
+    from q3dfit.common.ncompselect import shutdown_pool
+    if initdat.get('neighborseed', False):
+        order = __get_spaxel_order(colarr, rowarr)
+    else:
+        order = range(0, nspax)
+    for ispax in order:
+        fitloop(ispax, colarr, rowarr, cube, initdat, linelist, specConv,
+                onefit, quiet, logfile=logfile, resume=resume)
+    flush_stores()
+    # the pool for NCOMPSELECT's candidate fits lasts for the whole run
+    shutdown_pool()
+
+
+# q3df setup for single-threaded execution
+def q3df_oneCore(initproc, cols=None, rows=None, onefit=False,
+                 quiet=True, resume=False):
+    import time
+    from sys import path
+    # add common subdirectory to Python PATH for ease of importing
+    path.append("common/")
+    starttime = time.time()
+
+    initdat = __load_initdat(initproc)
     linelist = __get_linelist(initdat)
     specConv = __get_dispersion(initdat)
 
@@ -228,16 +326,23 @@ def q3df_oneCore(initproc, cols=None, rows=None, onefit=False,
     else:
         logfile = None
 
-    cube, vormap = __get_CUBE(initdat, quiet, logfile=logfile)
-    if cols and rows and vormap:
+    cube, vormap = __get_CUBE(initdat, quiet, logfile=logfile, cols=cols,
+                              rows=rows)
+    if cols and rows and vormap is not False:
         cols = __get_voronoi(cols, rows, vormap)
         rows = 1
     nspax, colarr, rowarr = __get_spaxels(cube, cols, rows)
+    if initdat.get('resultstore', False):
+        from q3dfit.common.fitstore import create_store
+        create_store(initdat, cube)
+    nspax, colarr, rowarr = \
+        __prescreen_spaxels(cube, initdat, linelist, colarr, rowarr,
+                            logfile=logfile)
 
     # execute FITLOOP
 
     execute_fitloop(nspax, colarr, rowarr, cube, initdat, linelist, specConv,
-                    onefit, quiet, logfile=logfile)
+                    onefit, quiet, logfile=logfile, resume=resume)
 
     if logfile is None:
         from sys import stdout
@@ -253,26 +358,15 @@ def q3df_oneCore(initproc, cols=None, rows=None, onefit=False,
 
 # q3df setup for multi-threaded execution
 def q3df_multiCore(rank, initproc, cols=None, rows=None,
-                   onefit=False, ncores=1, quiet=True):
-    import numpy as np
+                   onefit=False, ncores=1, quiet=True, batchsize=1,
+                   resume=False):
     import time
-#    from exceptions import InitializationError
+    from mpi4py import MPI
+    from q3dfit.common.fitloop import fitloop
+    from q3dfit.common.fitstore import flush_stores
+    comm = MPI.COMM_WORLD
     starttime = time.time()
-    # If it's a string, assume it's an input .npy file
-    if type(initproc) == str:
-        # When initproc was a routine rather than an input dictionary
-        # initdat = __get_initdat(initproc)
-        initdatarr = np.load(initproc, allow_pickle=True)
-        initdat = initdatarr[()]
-    # If it's an ndarray, assume the file's been loaded but not stripped
-    # to dict{}
-    elif isinstance(initproc, np.ndarray):
-        initdat = initproc[()]
-    # If it's a dictionary, assume all is well
-    elif isinstance(initproc, dict):
-        initdat = initproc
-#    else:
-#        raise InitializationError('initproc not in expected format')
+    initdat = __load_initdat(initproc)
     linelist = __get_linelist(initdat)
     specConv = __get_dispersion(initdat)
 
@@ -281,27 +375,299 @@ def q3df_multiCore(rank, initproc, cols=None, rows=None,
     else:
         logfile = None
 
-    cube, vormap = __get_CUBE(initdat, quiet, logfile=logfile)
-    if cols and rows and vormap:
+    if initdat.get('sharedcube', False):
+        cube, vormap, nodecomm = \
+            __get_shared_CUBE(initdat, quiet, comm, logfile=logfile,
+                              cols=cols, rows=rows)
+    else:
+        cube, vormap = __get_CUBE(initdat, quiet, logfile=logfile,
+                                  cols=cols, rows=rows)
+        nodecomm = None
+    if cols and rows and vormap is not False:
         cols = __get_voronoi(cols, rows, vormap)
         rows = 1
     nspax, colarr, rowarr = __get_spaxels(cube, cols, rows)
-    # get the range of spaxels this core is responsible for
-    start = int(np.floor(nspax * rank / size))
-    stop = int(np.floor(nspax * (rank+1) / size))
-    colarr = colarr[start:stop]
-    rowarr = rowarr[start:stop]
-    # number of spaxels THIS CORE is responsible for
-    nspax_thisCore = stop-start
+    # one rank sets up the result store before anyone writes to it
+    if initdat.get('resultstore', False):
+        from q3dfit.common.fitstore import create_store
+        if rank == 0:
+            create_store(initdat, cube)
+        comm.Barrier()
+    nspax, colarr, rowarr = \
+        __prescreen_spaxels(cube, initdat, linelist, colarr, rowarr,
+                            write=(rank == 0), logfile=logfile)
+    if logfile is None:
+        from sys import stdout
+        logtmp = stdout
+    else:
+        logtmp = logfile
+
     # execute FITLOOP
-    execute_fitloop(nspax_thisCore, colarr, rowarr, cube, initdat, linelist, specConv,
-                    onefit, quiet, logfile=logfile)
+    if ncores == 1:
+        execute_fitloop(nspax, colarr, rowarr, cube, initdat, linelist,
+                        specConv, onefit, quiet, logfile=logfile,
+                        resume=resume)
+    # Rank 0 is the master. It hands out batches of spaxels, most expensive
+    # first, to whichever worker asks for more work.
+    elif rank == 0:
+        batches = __get_batches(cube, initdat, colarr, rowarr, batchsize)
+        status = MPI.Status()
+        stats = dict()
+        ibatch = 0
+        nstopped = 0
+        while nstopped < ncores - 1:
+            # workers report their total busy time and # of spaxels fitted
+            # with each request
+            report = comm.recv(source=MPI.ANY_SOURCE, status=status)
+            worker = status.Get_source()
+            stats[worker] = report
+            if ibatch < len(batches):
+                comm.send(batches[ibatch], dest=worker)
+                ibatch += 1
+            else:
+                comm.send(None, dest=worker)
+                nstopped += 1
+        __print_utilisation(stats, time.time()-starttime, logtmp)
+    else:
+        busy = 0.
+        nfit = 0
+        while True:
+            comm.send((busy, nfit), dest=0)
+            batch = comm.recv(source=0)
+            if batch is None:
+                break
+            batchstart = time.time()
+            for ispax in batch:
+                fitloop(ispax, colarr, rowarr, cube, initdat, linelist,
+                        specConv, onefit, quiet, logfile=logfile,
+                        resume=resume)
+            flush_stores()
+            busy += time.time() - batchstart
+            nfit += len(batch)
+
+    # the rank that shared the cube removes it once the node is done
+    if nodecomm is not None:
+        from q3dfit.common.sharedcube import release_cube
+        nodecomm.Barrier()
+        release_cube(unlink=(nodecomm.Get_rank() == 0))
+
+    timediff = time.time()-starttime
+    print(f'Q3DF: Total time for calculation: {timediff:.2f} s.',
+          file=logtmp)
+    if logfile is not None:
+        logfile.close()
+
+
+# Cheap estimate of the relative cost of fitting each spaxel. Fits with
+# more line components and higher S/N (which are more likely to need
+# checkcomp refits) take longer.
+def __get_spaxel_cost(cube, initdat, colarr, rowarr):
+    import numpy as np
+    nspax = len(colarr)
+    # spaxel coordinates in the initialization arrays
+    if 'vormap' in initdat and hasattr(cube, 'vorcoords'):
+        icol = cube.vorcoords[colarr, 0]
+        irow = cube.vorcoords[colarr, 1]
+    else:
+        icol = colarr
+        irow = rowarr
+    ncomp = np.ones(nspax)
+    if 'noemlinfit' not in initdat and 'lines' in initdat:
+        for line in initdat['lines']:
+            ncomp += np.asarray(initdat['ncomp'][line])[icol, irow]
+    # median S/N, in chunks to limit memory use
+    snr = np.zeros(nspax)
+    chunk = 1024
+    for k in range(0, nspax, chunk):
+        sl = slice(k, k+chunk)
+        if cube.dat.ndim == 1:
+            flux = cube.dat[np.newaxis, :]
+            err = cube.err[np.newaxis, :]
+        elif cube.dat.ndim == 2:
+            flux = cube.dat[:, colarr[sl]].T
+            err = cube.err[:, colarr[sl]].T
+        else:
+            icube = colarr[sl] - cube.col0
+            jcube = rowarr[sl] - cube.row0
+            flux = cube.dat[icube, jcube, :]
+            err = cube.err[icube, jcube, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snr[sl] = np.nanmedian(np.where(err > 0., flux/err, np.nan),
+                                   axis=1)
+    snr = np.clip(np.nan_to_num(snr), 0., None)
+    return ncomp * (1. + np.log1p(snr))
+
+
+# Order spaxels along a Hilbert curve, so that consecutive spaxels are
+# adjacent. Returns indices into colarr/rowarr.
+def __get_spaxel_order(colarr, rowarr):
+    import numpy as np
+    x = np.array(colarr, dtype=np.int64)
+    y = np.array(rowarr, dtype=np.int64)
+    n = 1
+    while n <= max(x.max(initial=0), y.max(initial=0)):
+        n *= 2
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.int64)
+        ry = ((y & s) > 0).astype(np.int64)
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant
+        flip = (ry == 0) & (rx == 1)
+        x[flip] = n - 1 - x[flip]
+        y[flip] = n - 1 - y[flip]
+        swap = ry == 0
+        x[swap], y[swap] = y[swap], x[swap]
+        s //= 2
+    return np.argsort(d, kind='stable')
+
+
+# Split the spaxels into batches of indices into colarr/rowarr, ordered by
+# decreasing cost. If initial guesses are seeded from neighbors, batches
+# instead follow a Hilbert curve, so that each batch is a compact patch.
+def __get_batches(cube, initdat, colarr, rowarr, batchsize=1):
+    import numpy as np
+    if initdat.get('neighborseed', False):
+        order = __get_spaxel_order(colarr, rowarr)
+    else:
+        cost = __get_spaxel_cost(cube, initdat, colarr, rowarr)
+        order = np.argsort(-cost, kind='stable')
+    nbatch = max(int(np.ceil(len(order) / max(batchsize, 1))), 1)
+    return np.array_split(order, nbatch)
+
+
+# Print time each worker spent fitting, as a fraction of the wall time
+def __print_utilisation(stats, walltime, logfile):
+    for worker in sorted(stats):
+        busy, nfit = stats[worker]
+        print(f'Q3DF: Worker {worker}: {nfit} spaxels, busy {busy:.2f} s ' +
+              f'({100.*busy/walltime:.0f}% of wall time).', file=logfile)
+
+
+# State of each process-pool worker. Set by __init_poolworker. With the
+# 'fork' start method the initializer arguments are inherited copy-on-write
+# rather than pickled, so the cube is never copied or re-read. With
+# SHAREDCUBE, the cube is a stub from SHARE_CUBE, which workers attach to,
+# so it isn't copied under other start methods either.
+__poolstate = dict()
+
+
+# process-pool worker initialization
+def __init_poolworker(colarr, rowarr, cube, initdat, linelist, specConv,
+                      onefit, quiet, resume, sharedcube=False):
+    from multiprocessing import current_process
+    if sharedcube:
+        from q3dfit.common.sharedcube import attach_cube
+        cube = attach_cube(cube)
+    __poolstate['colarr'] = colarr
+    __poolstate['rowarr'] = rowarr
+    __poolstate['cube'] = cube
+    __poolstate['initdat'] = initdat
+    __poolstate['linelist'] = linelist
+    __poolstate['specConv'] = specConv
+    __poolstate['onefit'] = onefit
+    __poolstate['quiet'] = quiet
+    __poolstate['resume'] = resume
+    if 'logfile' in initdat:
+        __poolstate['logfile'] = \
+            open(initdat['logfile'] + '_core' +
+                 str(current_process()._identity[0]), 'w+')
+    else:
+        __poolstate['logfile'] = None
+
+
+# fit a batch of spaxels, given by their indices into colarr/rowarr, in a
+# process-pool worker. Returns the worker's ID, the time spent fitting, and
+# the number of spaxels fitted.
+def __fitloop_poolworker(ispaxes):
+    import time
+    from multiprocessing import current_process
+    from q3dfit.common.fitloop import fitloop
+    from q3dfit.common.fitstore import flush_stores
+    batchstart = time.time()
+    st = __poolstate
+    for ispax in ispaxes:
+        fitloop(ispax, st['colarr'], st['rowarr'], st['cube'], st['initdat'],
+                st['linelist'], st['specConv'], st['onefit'], st['quiet'],
+                logfile=st['logfile'], resume=st['resume'])
+    flush_stores()
+    if st['logfile'] is not None:
+        st['logfile'].flush()
+    return current_process()._identity[0], time.time() - batchstart, \
+        len(ispaxes)
+
+
+# q3df setup for multi-process execution on a single machine, without MPI.
+# The initialization, line list, dispersion data, and cube are read once
+# here; workers receive only spaxel indices.
+def q3df_multiProcess(initproc, cols=None, rows=None, onefit=False, ncores=1,
+                      quiet=True, batchsize=1, resume=False):
+    import multiprocessing as mp
+    import numpy as np
+    import time
+    starttime = time.time()
+
+    initdat = __load_initdat(initproc)
+    linelist = __get_linelist(initdat)
+    specConv = __get_dispersion(initdat)
+
+    if 'logfile' in initdat:
+        logfile = open(initdat['logfile'], 'w+')
+    else:
+        logfile = None
+
+    cube, vormap = __get_CUBE(initdat, quiet, logfile=logfile, cols=cols,
+                              rows=rows)
+    if cols and rows and vormap is not False:
+        cols = __get_voronoi(cols, rows, vormap)
+        rows = 1
+    nspax, colarr, rowarr = __get_spaxels(cube, cols, rows)
+    if initdat.get('resultstore', False):
+        from q3dfit.common.fitstore import create_store
+        create_store(initdat, cube)
+    nspax, colarr, rowarr = \
+        __prescreen_spaxels(cube, initdat, linelist, colarr, rowarr,
+                            logfile=logfile)
+    # load the templates before forking, so that workers share one copy
+    __load_templates(initdat)
+    # Fork where possible so that workers share the parent's memory
+    forked = 'fork' in mp.get_all_start_methods()
+    if forked:
+        ctx = mp.get_context('fork')
+    else:
+        ctx = mp.get_context()
+    # put the cube in shared memory, if asked. Forked workers inherit the
+    # views; others get the stub and attach to it.
+    sharedcube = initdat.get('sharedcube', False) and not cube.lazy
+    cubearg = cube
+    if sharedcube:
+        from q3dfit.common.sharedcube import release_cube, share_cube
+        stub = share_cube(cube)
+        if not forked:
+            cubearg = stub
+    # Batches are handed to workers on demand, most expensive first
+    batches = __get_batches(cube, initdat, colarr, rowarr, batchsize)
+    stats = dict()
+    with ctx.Pool(processes=max(min(ncores, nspax), 1),
+                  initializer=__init_poolworker,
+                  initargs=(colarr, rowarr, cubearg, initdat, linelist,
+                            specConv, onefit, quiet, resume,
+                            sharedcube and not forked)) as pool:
+        for worker, busy, nfit in \
+            pool.imap_unordered(__fitloop_poolworker, batches, chunksize=1):
+            busy_prev, nfit_prev = stats.get(worker, (0., 0))
+            stats[worker] = (busy_prev + busy, nfit_prev + nfit)
+    if sharedcube:
+        release_cube(unlink=True)
+
     if logfile is None:
         from sys import stdout
         logtmp = stdout
     else:
         logtmp = logfile
     timediff = time.time()-starttime
+    __print_utilisation(stats, timediff, logtmp)
     print(f'Q3DF: Total time for calculation: {timediff:.2f} s.',
           file=logtmp)
     if logfile is not None:
@@ -345,4 +711,10 @@ if __name__ == "__main__":
         quiet = True
     else:
         quiet = False
-    q3df_multiCore(rank, initproc, cols, rows, onefit, size, quiet)
+    batchsize = int(argv[6])
+    if argv[7].startswith("T"):
+        resume = True
+    else:
+        resume = False
+    q3df_multiCore(rank, initproc, cols, rows, onefit, size, quiet,
+                   batchsize, resume)
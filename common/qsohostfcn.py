@@ -217,7 +217,8 @@ def setup_stars_add_exp(p):
 
 def qsohostfcn(wave, params_fit=None, qsoflux=None,
                qsoonly=False, qsoord=None, hostonly=False, hostord=None,
-               blronly=False, blrpar=None, **kwargs):
+               blronly=False, blrpar=None, qsoexp=True, hostexp=True,
+               **kwargs):
 
     # maximum model legendre polynomial order
     legordmax = 10
@@ -225,9 +226,10 @@ def qsohostfcn(wave, params_fit=None, qsoflux=None,
     # Additive starlight component:
     if not qsoonly and not blronly:
         # Terms with exponentials
-        stars_add = setup_stars_add_exp(np.zeros(8))
-        ymod = stars_add[0]
-        params = stars_add[1]
+        if hostexp:
+            stars_add = setup_stars_add_exp(np.zeros(8))
+            ymod = stars_add[0]
+            params = stars_add[1]
         # optional legendre polynomials up to order ordmax
         if hostord is not None:
             if hostord <= legordmax:
@@ -235,8 +237,12 @@ def qsohostfcn(wave, params_fit=None, qsoflux=None,
                 for ind in np.arange(legordmax, hostord, -1):
                     initvals[ind] = np.nan
                 stars_add = setup_stars_add_leg(initvals)
-                ymod += stars_add[0]
-                params += stars_add[1]
+                if 'ymod' not in vars():
+                    ymod = stars_add[0]
+                    params = stars_add[1]
+                else:
+                    ymod += stars_add[0]
+                    params += stars_add[1]
             else:
                 raise InitializationError('Order of starlight additive ' +
                                           'Legendre polynomial [hostord] ' +
@@ -245,13 +251,14 @@ def qsohostfcn(wave, params_fit=None, qsoflux=None,
     # Scaled QSO component
     if not hostonly and not blronly:
         # Terms with exponentials
-        qso_mult = setup_qso_mult_exp(np.zeros(8))
-        if 'ymod' not in vars():
-            ymod = qso_mult[0]
-            params = qso_mult[1]
-        else:
-            ymod += qso_mult[0]
-            params += qso_mult[1]
+        if qsoexp:
+            qso_mult = setup_qso_mult_exp(np.zeros(8))
+            if 'ymod' not in vars():
+                ymod = qso_mult[0]
+                params = qso_mult[1]
+            else:
+                ymod += qso_mult[0]
+                params += qso_mult[1]
         # optional legendre polynomials up to order 5
         if qsoord is not None:
             if qsoord <= legordmax:
@@ -259,8 +266,12 @@ def qsohostfcn(wave, params_fit=None, qsoflux=None,
                 for ind in np.arange(legordmax, qsoord, -1):
                     initvals[ind] = np.nan
                 qso_mult = setup_qso_mult_leg(initvals)
-                ymod += qso_mult[0]
-                params += qso_mult[1]
+                if 'ymod' not in vars():
+                    ymod = qso_mult[0]
+                    params = qso_mult[1]
+                else:
+                    ymod += qso_mult[0]
+                    params += qso_mult[1]
             else:
                 raise InitializationError('Order of multiplicative ' +
                                           'Legendre polynomial for scaling ' +
@@ -312,6 +323,11 @@ def qsohostfcn(wave, params_fit=None, qsoflux=None,
                 params += gaussian_model_parameters
             counter += 3
 
+    if 'ymod' not in vars():
+        raise InitializationError('QSO/host model has no components; ' +
+                                  'check qsoexp, hostexp, qsoord, hostord, ' +
+                                  'and blrpar')
+
     # Option to evaulate model for plotting, else return the lmfit model
     # and parameters for fitting in fitqsohost
     if params_fit is not None:
@@ -1,15 +1,17 @@
 import numpy as np
 import lmfit
 import copy
+import hashlib
+import os
 from scipy import constants
 from astropy import units as u
 from q3dfit.common import interptemp
 from q3dfit.common import questfitfcn
 from q3dfit.common import questfit_readcf
-from lmfit.models import ExpressionModel
 from matplotlib import pyplot as plt
 from q3dfit.common import interp_temp_quest
 from q3dfit.common import writeout_quest
+from q3dfit.common.varpro import varpro_fit
 import q3dfit
 from matplotlib import pyplot as plt
 
@@ -18,7 +20,7 @@ from matplotlib import pyplot as plt
 def questfit(wlambda, flux, weights, singletemplatelambda, singletemplateflux, index,
     z, quiet=True, config_file=None, global_ice_model='None', global_ext_model='None', \
     models_dictionary={}, template_dictionary={}, fitran=None, convert2Flambda=True, \
-    outdir=None):
+    outdir=None, solver='lmfit'):
     '''Function defined to fit the MIR continuum
 
     Parameters
@@ -46,6 +48,11 @@ def questfit(wlambda, flux, weights, singletemplatelambda, singletemplateflux, i
     z: float
         redshift
 
+    solver: str
+        'lmfit' (default) fits all parameters with least_squares. 'varpro' solves for the
+        template, blackbody, and powerlaw amplitudes by bounded linear least squares within
+        a fit of the remaining parameters; see varpro.py.
+
 
 
     returns
@@ -71,6 +78,157 @@ def questfit(wlambda, flux, weights, singletemplatelambda, singletemplateflux, i
         import sys; sys.exit()
 
     else:
+        # model, parameters, and resampled templates for this config file and
+        # wavelength grid, built on first use
+        qmodel = questfit_model(config_file, wlambda, convert2Flambda)
+        model = qmodel.model
+        param = copy.deepcopy(qmodel.params)
+        if qmodel.global_extinction:
+            global_ext_model = qmodel.global_ext_model
+            global_ice_model = qmodel.global_ice_model
+        # upper limits of template scalings depend on the spectrum
+        for ampname, ampvalue in qmodel.template_amps:
+            param[ampname].set(value=ampvalue, min=0.,
+                               max=1.05*max(flux[index]))
+        models_dictionary = dict(qmodel.models_dictionary)
+        c_scale = qmodel.c_scale
+
+        models_dictionary['wave'] = wlambda/(1+z)
+        models_dictionary['fitFlambda'] = bool(convert2Flambda)
+
+        if convert2Flambda:
+            flux *= c_scale
+
+
+        plot_ini_guess = False
+        if plot_ini_guess:
+            plt.plot(models_dictionary['wave'], param['template_0_amp'].value * models_dictionary['template_0']/c_scale, color='c', label = 'QSO model init')
+
+            data1 = np.load('../data/questfit_templates/' + 'miri_qsotemplate_flexB.npy', allow_pickle='TRUE').item()
+            F1 = data1['flux'][:-1] * c_scale
+            plt.plot(models_dictionary['wave'], F1/c_scale, color='b', label = 'QSO real')
+
+            gal_model_comp = [el for el in models_dictionary if 'template' in el and 'template_0' not in el]
+            Fgalmodel = 0
+            for comp_i in gal_model_comp:
+                Fgalmodel += param[comp_i+'_amp'].value * models_dictionary[comp_i]
+            plt.plot(models_dictionary['wave'], Fgalmodel/c_scale, color='plum', label = 'host model init')
+
+            data2 = np.load('../data/questfit_templates/' + 'miri_gal_spec.npy', allow_pickle='TRUE').item()
+            F2 = data2['flux'][:-1] * c_scale
+            plt.plot(models_dictionary['wave'], F2/c_scale, color='darkviolet', label = 'host real')
+            plt.yscale("log")
+            plt.xlabel(r'$\lambda \ \mathrm{[micron]}$')
+            plt.legend()
+            plt.show()
+            breakpoint()
+
+        flux_cut = flux[index]
+        models_dictionary_cut = copy.deepcopy(models_dictionary)
+        for el in models_dictionary.keys():
+            if not ('fitFlambda' in el):
+                models_dictionary_cut[el] = models_dictionary_cut[el][index]
+
+
+
+
+
+        # from multiprocessing import Pool
+        # with Pool() as pool:
+        use_emcee = False
+        if use_emcee:
+
+            # -- Originally used max_nfev=int(1e5), and method='least_squares'
+            emcee_kws = dict(steps=5000, burn=500, thin=20, is_weighted=False, progress=True) #, run_mcmc_kwargs={'skip_initial_state_check': True} )
+            #emcee_kws = dict(nwalkers=500, steps=5000, burn=500, thin=20, workers=pool, is_weighted=False, progress=True) #, run_mcmc_kwargs={'skip_initial_state_check': True} )
+            # emcee_kws = dict(nwalkers=256, steps=50000, burn=500, thin=5, is_weighted=False, progress=True) #, run_mcmc_kwargs={'skip_initial_state_check': True} )
+
+            param.add('__lnsigma', value=np.log(0.1), min=np.log(0.001), max=np.log(2.0))
+            import time
+            t1 = time.time()
+            result = model.fit(flux_cut,param,**models_dictionary_cut,max_nfev=int(1e5),method='emcee',nan_policy='omit', fit_kws=emcee_kws)#method='least_squares'nan_policy='omit'
+            print('Time needed for fitting: ', time.time()-t1)
+
+            import corner
+            emcee_plot = corner.corner(result.flatchain, labels=result.var_names,truths=list(result.params.valuesdict().values()))
+            plt.savefig(outdir+'corner')
+
+        elif solver == 'varpro':
+            result = varpro_fit(model,param,flux_cut,max_nfev=int(1e5),**models_dictionary_cut)
+
+        else:
+            result = model.fit(flux_cut,param,**models_dictionary_cut,max_nfev=int(1e5),method='least_squares',nan_policy='omit')#method='least_squares'nan_policy='omit'
+
+        lmfit.report_fit(result.params)
+        with open(outdir+'it_result.txt', 'w') as fh:
+            fh.write(result.fit_report())
+            fh.write('\n')
+
+        best_fit = result.eval(**models_dictionary) # use models_dictionary rather than models_dictionary_cut to evaluate over all wavelengths within fitran (not just [index])
+        comp_best_fit = result.eval_components(**models_dictionary)
+        # print(result.best_values)
+
+        if convert2Flambda:
+            flux /= c_scale
+            best_fit /= c_scale
+            for el in comp_best_fit.keys():
+                if not (global_ext_model in el) and not (global_ice_model in el) and not ('ext' in el) and not ('ice' in el):
+                    try:
+                        comp_best_fit[el] /= c_scale
+                    except Exception as e:
+                        print(e)
+                        import pdb; pdb.set_trace()
+
+        ct_coeff = {'MIRparams': result.params, 'comp_best_fit': comp_best_fit}
+
+        #return best_fit,comp_best_fit,result
+        return best_fit, ct_coeff, z
+
+
+# Models built by QUESTFITMODEL, by configuration file and wavelength grid
+_models = dict()
+
+
+def questfit_model(config_file, wlambda, convert2Flambda=True):
+    '''
+    Get the QUESTFITMODEL for a configuration file and wavelength grid,
+    building it on first use.
+    '''
+    wlambda = np.asarray(wlambda, dtype=np.float64)
+    key = (os.path.abspath(config_file), os.path.getmtime(config_file),
+           hashlib.sha1(wlambda.tobytes()).hexdigest(), bool(convert2Flambda))
+    if key not in _models:
+        _models[key] = QUESTFITMODEL(config_file, wlambda, convert2Flambda)
+    return _models[key]
+
+
+class QUESTFITMODEL:
+    '''
+    The lmfit model for a questfit configuration file, with its parameters
+    and its templates and extinction and absorption curves resampled onto
+    the wavelength grid of the data. Everything here is the same for all
+    spaxels with the same grid, so questfit() builds it once and reuses it.
+
+    :Params:
+        config_file: in, required, type=str
+            Questfit configuration file.
+        wlambda: in, required, type=dblarr(nwave)
+            Wavelengths of the data, in micron.
+        convert2Flambda: in, optional, type=bool, default=True
+            Convert templates to F_lambda.
+
+    The template scalings have no upper limit in PARAMS; questfit() sets it
+    from each spectrum. TEMPLATE_AMPS lists their names and initial values.
+    '''
+
+    def __init__(self, config_file, wlambda, convert2Flambda=True):
+
+        models_dictionary = {}
+        template_dictionary = {}
+        template_amps = []
+        global_ext_model = 'None'
+        global_ice_model = 'None'
+
         config_file = questfit_readcf.readcf(config_file)
         global_extinction = False
         for key in config_file:
@@ -163,7 +321,9 @@ def questfit(wlambda, flux, weights, singletemplatelambda, singletemplateflux, i
                 ice_model = config_file[i][9]
 
                 if not 'poly' in i:
-                    model_temp_template,param_temp_template = questfitfcn.set_up_fit_model_scale([float(model_parameters[1])],[float(model_parameters[2])],name_model,name_model, maxamp=1.05*max(flux[index]) ) #name_model.split('.')[0]template+'_'+str(n_temp)
+                    model_temp_template,param_temp_template = questfitfcn.set_up_fit_model_scale([float(model_parameters[1])],[float(model_parameters[2])],name_model,name_model) #name_model.split('.')[0]template+'_'+str(n_temp)
+                    # upper limit set for each spectrum by questfit()
+                    template_amps.append((name_model+'_amp', float(model_parameters[1])))
                 else:
                     minamp = float(model_parameters[1]) / 1.25
                     maxamp = float(model_parameters[1]) * 1.25
@@ -286,97 +446,14 @@ def questfit(wlambda, flux, weights, singletemplatelambda, singletemplateflux, i
                 models_dictionary[i] = temp_value_rebin*c_scale
             models_dictionary[i] = models_dictionary[i]/models_dictionary[i].max()  # normalise
 
-
-        models_dictionary['wave'] = wlambda/(1+z)
-        models_dictionary['fitFlambda'] = bool(convert2Flambda)
-
-        if convert2Flambda:
-            flux *= c_scale
-
-
-        plot_ini_guess = False
-        if plot_ini_guess:
-            plt.plot(models_dictionary['wave'], param['template_0_amp'].value * models_dictionary['template_0']/c_scale, color='c', label = 'QSO model init')
-
-            data1 = np.load('../data/questfit_templates/' + 'miri_qsotemplate_flexB.npy', allow_pickle='TRUE').item()
-            F1 = data1['flux'][:-1] * c_scale
-            plt.plot(models_dictionary['wave'], F1/c_scale, color='b', label = 'QSO real')
-
-            gal_model_comp = [el for el in models_dictionary if 'template' in el and 'template_0' not in el]
-            Fgalmodel = 0
-            for comp_i in gal_model_comp:
-                Fgalmodel += param[comp_i+'_amp'].value * models_dictionary[comp_i]
-            plt.plot(models_dictionary['wave'], Fgalmodel/c_scale, color='plum', label = 'host model init')
-
-            data2 = np.load('../data/questfit_templates/' + 'miri_gal_spec.npy', allow_pickle='TRUE').item()
-            F2 = data2['flux'][:-1] * c_scale
-            plt.plot(models_dictionary['wave'], F2/c_scale, color='darkviolet', label = 'host real')
-            plt.yscale("log")
-            plt.xlabel(r'$\lambda \ \mathrm{[micron]}$')
-            plt.legend()
-            plt.show()
-            breakpoint()
-
-        flux_cut = flux[index]
-        models_dictionary_cut = copy.deepcopy(models_dictionary)
-        for el in models_dictionary.keys():
-            if not ('fitFlambda' in el):
-                models_dictionary_cut[el] = models_dictionary_cut[el][index]
-
-        outpy = '../data/questfit_templates/' + 'miri_qsotemplate_flex.npy'
-        data1 = np.load(outpy, allow_pickle=True)
-        f_orig = data1.item()['flux'][:-1]
-
-
-
-
-        # from multiprocessing import Pool
-        # with Pool() as pool:
-        use_emcee = False
-        if use_emcee:
-
-            # -- Originally used max_nfev=int(1e5), and method='least_squares'
-            emcee_kws = dict(steps=5000, burn=500, thin=20, is_weighted=False, progress=True) #, run_mcmc_kwargs={'skip_initial_state_check': True} )
-            #emcee_kws = dict(nwalkers=500, steps=5000, burn=500, thin=20, workers=pool, is_weighted=False, progress=True) #, run_mcmc_kwargs={'skip_initial_state_check': True} )
-            # emcee_kws = dict(nwalkers=256, steps=50000, burn=500, thin=5, is_weighted=False, progress=True) #, run_mcmc_kwargs={'skip_initial_state_check': True} )
-
-            param.add('__lnsigma', value=np.log(0.1), min=np.log(0.001), max=np.log(2.0))
-            import time
-            t1 = time.time()
-            result = model.fit(flux_cut,param,**models_dictionary_cut,max_nfev=int(1e5),method='emcee',nan_policy='omit', fit_kws=emcee_kws)#method='least_squares'nan_policy='omit'
-            print('Time needed for fitting: ', time.time()-t1)
-
-            import corner
-            emcee_plot = corner.corner(result.flatchain, labels=result.var_names,truths=list(result.params.valuesdict().values()))
-            plt.savefig(outdir+'corner')
-
-        else:
-            result = model.fit(flux_cut,param,**models_dictionary_cut,max_nfev=int(1e5),method='least_squares',nan_policy='omit')#method='least_squares'nan_policy='omit'
-
-        lmfit.report_fit(result.params)
-        with open(outdir+'it_result.txt', 'w') as fh:
-            fh.write(result.fit_report())
-            fh.write('\n')
-
-        best_fit = result.eval(**models_dictionary) # use models_dictionary rather than models_dictionary_cut to evaluate over all wavelengths within fitran (not just [index])
-        comp_best_fit = result.eval_components(**models_dictionary)
-        # print(result.best_values)
-
-        if convert2Flambda:
-            flux /= c_scale
-            best_fit /= c_scale
-            for el in comp_best_fit.keys():
-                if not (global_ext_model in el) and not (global_ice_model in el) and not ('ext' in el) and not ('ice' in el):
-                    try:
-                        comp_best_fit[el] /= c_scale
-                    except Exception as e:
-                        print(e)
-                        import pdb; pdb.set_trace()
-
-        ct_coeff = {'MIRparams': result.params, 'comp_best_fit': comp_best_fit}
-
-        #return best_fit,comp_best_fit,result
-        return best_fit, ct_coeff, z
+        self.model = model
+        self.params = param
+        self.models_dictionary = models_dictionary
+        self.template_amps = template_amps
+        self.global_extinction = global_extinction
+        self.global_ext_model = global_ext_model
+        self.global_ice_model = global_ice_model
+        self.c_scale = c_scale
 
 
 def quest_extract_QSO_contrib(ct_coeff, initdat):
@@ -1,8 +1,76 @@
+import inspect
 import numpy as np
 import lmfit
-from lmfit.models import ExpressionModel
 from astropy import units as u
 
+
+def named_kernel(func, argnames, name):
+    '''Wrap func so that lmfit sees its arguments under the names in argnames
+
+    lmfit takes independent variables and parameters from the names of a model
+    function's arguments. The extinction, absorption, and scaling terms need names
+    that depend on the configuration (curve names and prefixed parameters), so
+    they are written as plain functions and given their names here.
+
+    Parameters
+    -----
+    func: function
+    function of len(argnames) positional arguments
+    argnames: list
+    names of the arguments, in order
+    name: str
+    name of the function, as shown by lmfit
+
+    returns
+    -------
+    kernel: function
+    '''
+
+    def kernel(**kwargs):
+        return func(*[kwargs[arg] for arg in argnames])
+
+    kernel.__signature__ = inspect.Signature(
+        [inspect.Parameter(arg, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+         for arg in argnames])
+    kernel.__name__ = name
+    return kernel
+
+
+def cached_log10():
+    '''Return a function that gives log10 of an array, recomputed only when it gets a
+    different array; the extinction curves don't change during a fit'''
+
+    cache = [None, None]
+
+    def log10(curve):
+        if cache[0] is not curve:
+            cache[0] = curve
+            cache[1] = np.log10(curve)
+        return cache[1]
+
+    return log10
+
+
+def screen_extinction(curve_log10, Av):
+    '''Screen extinction factor, from log10 of the extinction curve'''
+    return np.power(10, (-0.4*Av*curve_log10))
+
+
+def mixed_extinction(curve_log10, Av):
+    '''Mixed extinction factor, from log10 of the extinction curve'''
+    tau = 0.4*Av*curve_log10
+    return 1 - np.exp(-tau)/(tau)
+
+
+def absorption(curve, tau):
+    '''Absorption factor for an optical depth curve'''
+    return np.exp(-1*tau*curve)
+
+
+def scale(template, amp):
+    '''Template times its amplitude'''
+    return amp*template
+
 def blackbody(wave,a,T, fitFlambda=True):
 
     '''Function defined for fitting a blackbody model
@@ -253,14 +321,15 @@ def set_up_fit_extinction(p,p_fixfree,model_name,extinction_model,mixed_or_scree
         '''
 
     model_name = model_name
+    log10 = cached_log10()
     if mixed_or_screen == 'M':
-        exp = "1 - exp(-0.4*%s_Av*log10(%s))/(0.4*%s_Av*log10(%s))" % (model_name,extinction_model,model_name,extinction_model)
+        func = lambda curve, Av: mixed_extinction(log10(curve), Av)
 
     if mixed_or_screen == 'S':
-        exp = "power(10,(-0.4*%s_Av*log10(%s)))" % (model_name,extinction_model)
-        #exp = "power(10,(-0.4*%s_Av*(%s)))" % (model_name,extinction_model)
+        func = lambda curve, Av: screen_extinction(log10(curve), Av)
 
-    model_extinction = ExpressionModel(exp,independent_vars=[extinction_model],name = model_name)
+    kernel = named_kernel(func, [extinction_model, model_name+'_Av'], model_name)
+    model_extinction = lmfit.Model(kernel,independent_vars=[extinction_model],name = model_name)
 
     #model_scale_model = lmfit.Model(powerlaw,independent_vars=['extinction_curve'],prefix=model_name)
     model_extinction_parameters = model_extinction.make_params()
@@ -289,8 +358,8 @@ def set_up_fit_model_scale(p,p_fixfree,model_name,model, fitFlambda=True, maxamp
         '''
 
 
-    exp = "1*%s_amp*1*%s" % (model,model)
-    model_scale_model = ExpressionModel(exp,independent_vars=[model],name=model_name)
+    kernel = named_kernel(scale, [model, model+'_amp'], model_name)
+    model_scale_model = lmfit.Model(kernel,independent_vars=[model],name=model_name)
     model_scale_parameters = model_scale_model.make_params()
 
     if maxamp is not None:
@@ -320,8 +389,8 @@ def set_up_absorption(p,p_fixfree,model_name,abs_model):
         '''
 
 
-    exp = "exp(-1*%s_tau*%s)" % (model_name,abs_model)
-    model = ExpressionModel(exp,independent_vars=[abs_model],name = model_name)
+    kernel = named_kernel(absorption, [abs_model, model_name+'_tau'], model_name)
+    model = lmfit.Model(kernel,independent_vars=[abs_model],name = model_name)
     abs_model_parameters = model.make_params()
     abs_model_parameters[model_name+'_tau'].set(value=p[0],min=0.,max=10.,vary=p_fixfree[0])#min=0.
 
@@ -2,7 +2,7 @@ from astropy.constants import c
 from astropy.io import fits
 from astropy import units as u
 from q3dfit.exceptions import CubeError
-from scipy import interpolate
+from scipy import sparse
 from sys import stdout
 
 import copy
@@ -30,8 +30,8 @@ cube = CUBE(fp='/path/to/data/', infile='datafits')
         phu: primary fits extension
         dat: data array
         var: variance array
-        err: error array, the values are recorded as nan when the
-             variances are negative.
+        err: error array, the square root of the variance; computed when
+             first needed (for each spectrum read, if lazy)
         dq: dq array
         wave: wavelength array
         header_phu: header for the primary fits extension
@@ -40,7 +40,17 @@ cube = CUBE(fp='/path/to/data/', infile='datafits')
         header_dq: header for the dq extension
         ncols: number of columns in the cube
         nrows: number of rows in the cube
+        cols, rows: first and last columns and rows read (1-offset); the
+             planes hold only these, and spaxel [i, j] of the cube is
+             element [i-col0, j-row0] of the planes
+        col0, row0: first column and row read (0-offset)
         nz: number of elements in wavelength array
+        gdmask: boolean array, same shape as dat; True where the flux is
+             nonzero and finite, the variance is positive and finite,
+             and DQ is 0. A LAZYMASK if lazy.
+    methods:
+        wavemask(ranges): boolean array, True where wave is within any
+             of the ranges; computed once per set of ranges
 :Params:
     infile: in, required, type=string
      Name of input FITS file.
@@ -61,6 +71,8 @@ cube = CUBE(fp='/path/to/data/', infile='datafits')
       output structure will still contain the variance.
     linearize: in, optional, type=byte, default=False
       If set, resample the input wavelength scale so it is linearized.
+      Resampling conserves flux; DQ flags of overlapping input pixels are
+      combined.
     quiet: in, optional, type=byte
       Suppress progress messages.
     varext: in, optional, type=integer, default=2
@@ -70,12 +82,37 @@ cube = CUBE(fp='/path/to/data/', infile='datafits')
     zerodq: in, optional, type=byte
       Zero out the DQ array.
     vormap: in, optional, 2D array for the voronoi binning map
+      Bin number (1-offset) of each spaxel; 0 or NaN for spaxels in no bin.
+      The planes then hold one spectrum per bin, in column order of a
+      cube with one row; vorcoords, nvor, and vorbins (a VORBINS) describe
+      the bins.
+    vorcombine: in, optional, type=string, default='first'
+      How the spectra in each bin are combined: 'first' takes the first
+      spaxel of the bin (for tessellated cubes, in which each spaxel holds
+      its bin's spectrum), 'sum' adds them, and 'mean' averages them. The
+      variance is propagated and the DQ flags are combined with OR.
     waveunit: in, optional
       Default is micron; other option is Angstrom
     fluxunit: in, optional
       the flux unit input by the user to be multiplide to the flux
       (The fluxunit is assumed to be JWST default and then converted to
        erg/s/cm^s/um/sr)
+    lazy: in, optional, type=byte, default=False
+      If set, and the data are a 3D cube, don't read the planes into
+      memory. dat, var, err, and dq are then LAZYPLANEs over the
+      memory-mapped FITS file: indexing one (e.g., cube.dat[i, j, :]) reads
+      only those elements. gdmask is a LAZYMASK, computed from them in the
+      same way. Can't be combined with vormap or linearize.
+    dtype: in, optional, type=string, default='float64'
+      Working precision of the data and variance. 'float32' halves the
+      memory needed.
+    cols, rows: in, optional, type=intarr(2)
+      Read only these columns and rows (1-offset; a scalar, or the first
+      and last) of a 3D cube. Only those FITS sections are read.
+    waverange: in, optional, type=dblarr(2)
+      Read only the wavelength planes within this range, in the output
+      wavelength units. The wavelengths, the WCS of the headers, and the
+      unit conversions are those of the planes read.
 ; :Author:
 ;    David S. N. Rupke::
 ;      Rhodes College
@@ -124,6 +161,276 @@ cube = CUBE(fp='/path/to/data/', infile='datafits')
 '''
 
 
+def _variance(raw, error=False, invvar=False):
+    # Variance from the variance plane as stored: inverse variance, error,
+    # or variance, which may be negative
+    var = raw
+    if invvar:
+        var = 1./var
+    if error:
+        return var**2.
+    return np.abs(var)
+
+
+def _gdmask(dat, var, dq):
+    # Good data: nonzero and finite flux, positive and finite variance,
+    # and DQ of 0
+    mask = (dat != 0.) & np.isfinite(dat)
+    if var is not None:
+        mask &= (var > 0.) & np.isfinite(var)
+    if dq is not None:
+        mask &= (dq == 0)
+    return mask
+
+
+def _roi_slice(sel, n):
+    # Slice for a selection of columns or rows: None (all), a scalar or
+    # one-element list (one), or the first and last, all 1-offset
+    if sel is None:
+        return slice(0, n)
+    if not isinstance(sel, (list, tuple, np.ndarray)):
+        sel = [sel, sel]
+    elif len(sel) == 1:
+        sel = [sel[0], sel[0]]
+    if sel[0] < 1 or sel[1] > n or sel[0] > sel[1]:
+        raise CubeError('CUBE: cols or rows out of range')
+    return slice(int(sel[0])-1, int(sel[1]))
+
+
+def _crop_header(header, starts, sizes):
+    # Copy of a header with the WCS reference pixels and axis lengths of
+    # the region read, given the first pixel (0-offset) and the number of
+    # pixels read along each FITS axis
+    header = header.copy()
+    for n, (start, size) in enumerate(zip(starts, sizes), 1):
+        if f'CRPIX{n}' in header:
+            header[f'CRPIX{n}'] -= start
+        if f'NAXIS{n}' in header:
+            header[f'NAXIS{n}'] = size
+    return header
+
+
+def _rebin_matrix(wavein, waveout):
+    # Sparse matrix that resamples a flux density from pixels centered on
+    # wavein to pixels centered on waveout, conserving flux: each output
+    # pixel is the mean of the input over the part of it that the input
+    # covers, weighted by the overlap of each input pixel
+    def edges(wave):
+        mid = (wave[1:] + wave[:-1]) / 2.
+        return np.concatenate(([2.*wave[0] - mid[0]], mid,
+                               [2.*wave[-1] - mid[-1]]))
+    edgein = edges(np.asarray(wavein, dtype=np.float64))
+    edgeout = edges(np.asarray(waveout, dtype=np.float64))
+    # each piece between consecutive edges of either grid lies within one
+    # input and one output pixel
+    cuts = np.union1d(edgein, edgeout)
+    mid = (cuts[1:] + cuts[:-1]) / 2.
+    iin = np.searchsorted(edgein, mid) - 1
+    iout = np.searchsorted(edgeout, mid) - 1
+    keep = (iin >= 0) & (iin < len(wavein)) & \
+        (iout >= 0) & (iout < len(waveout))
+    matrix = sparse.csr_matrix((np.diff(cuts)[keep],
+                                (iout[keep], iin[keep])),
+                               shape=(len(waveout), len(wavein)))
+    covered = np.asarray(matrix.sum(axis=1)).ravel()
+    covered[covered == 0.] = 1.
+    return sparse.csr_matrix(sparse.diags(1./covered) @ matrix)
+
+
+def _rebin(plane, matrix, chunk=4096):
+    # Resample a plane along its last (wavelength) axis, a chunk of
+    # spectra at a time
+    spec = np.reshape(plane, (-1, plane.shape[-1]))
+    dtype = plane.dtype if np.issubdtype(plane.dtype, np.floating) \
+        else np.float64
+    out = np.empty((spec.shape[0], matrix.shape[0]), dtype=dtype)
+    for k in range(0, spec.shape[0], chunk):
+        sl = slice(k, k+chunk)
+        out[sl] = (matrix @ spec[sl].T).T
+    return out.reshape(plane.shape[:-1] + (matrix.shape[0],))
+
+
+def _rebin_dq(plane, matrix, chunk=4096):
+    # Resample a DQ plane: each output pixel gets the flags of all input
+    # pixels that overlap it, OR'd together (or their maximum, if DQ is
+    # not an integer type)
+    spec = np.reshape(plane, (-1, plane.shape[-1]))
+    if np.issubdtype(spec.dtype, np.integer) or spec.dtype == bool:
+        combine = np.bitwise_or
+    else:
+        combine = np.maximum
+    out = np.empty((spec.shape[0], matrix.shape[0]), dtype=spec.dtype)
+    empty = np.diff(matrix.indptr) == 0
+    starts = np.minimum(matrix.indptr[:-1], matrix.nnz-1)
+    for k in range(0, spec.shape[0], chunk):
+        sl = slice(k, k+chunk)
+        out[sl] = combine.reduceat(spec[sl][:, matrix.indices], starts,
+                                   axis=1)
+        # output pixels with no input are bad
+        out[sl, empty] = 1
+    return out.reshape(plane.shape[:-1] + (matrix.shape[0],))
+
+
+class VORBINS:
+    '''
+    Index of a Voronoi binning map, built once.
+
+    Attributes: nbins, the number of bins; binof, the bin (0-offset) of
+    each spaxel of the map, or -1; nvor, the number of spaxels in each bin;
+    vorcoords, the column and row of the first spaxel of each bin; and
+    matrix, the sparse (nbins, nspaxels) matrix that sums the spaxels of
+    each bin.
+    '''
+
+    def __init__(self, vormap):
+        vormap = np.asarray(vormap, dtype=np.float64)
+        self.shape = vormap.shape
+        flat = np.where(np.isfinite(vormap), vormap, 0.).ravel()
+        self.binof = flat.astype(np.int64) - 1
+        self.nbins = int(max(self.binof.max() + 1, 0))
+        inbin = np.flatnonzero(self.binof >= 0)
+        self.nvor = np.bincount(self.binof[inbin], minlength=self.nbins)
+        if np.any(self.nvor == 0):
+            raise CubeError('CUBE: Voronoi bins ' +
+                            str(np.flatnonzero(self.nvor == 0) + 1) +
+                            ' have no spaxels')
+        # first spaxel of each bin, in the order of np.where
+        order = inbin[np.argsort(self.binof[inbin], kind='stable')]
+        first = order[np.concatenate(([0], np.cumsum(self.nvor)[:-1]))]
+        self.vorcoords = np.column_stack(np.unravel_index(first, self.shape))
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(inbin)), (self.binof[inbin], inbin)),
+            shape=(self.nbins, flat.size))
+
+    def combine(self, dat, var, dq, method='first'):
+        '''
+        Bin a cube.
+
+        :Params:
+            dat, var, dq: in, required, type=dblarr(ncols, nrows, nw)
+                Planes of the cube; var and dq may be None.
+            method: in, optional, type=string, default='first'
+                'first', 'sum', or 'mean'; see CUBE.
+
+        :Returns:
+            dat, var, and dq of the binned cube, of shape (nbins, 1, nw).
+        '''
+        nw = np.shape(dat)[-1]
+        shape = (self.nbins, 1, nw)
+        if method == 'first':
+            i, j = self.vorcoords[:, 0], self.vorcoords[:, 1]
+            return (dat[i, j, :].reshape(shape),
+                    None if var is None else var[i, j, :].reshape(shape),
+                    None if dq is None else dq[i, j, :].reshape(shape))
+        if method not in ['sum', 'mean']:
+            raise CubeError('CUBE: vorcombine must be first, sum, or mean')
+        if method == 'mean':
+            norm = 1./self.nvor[:, np.newaxis]
+        else:
+            norm = np.ones((self.nbins, 1))
+        bindat = (self.matrix @ np.reshape(dat, (-1, nw)))*norm
+        binvar = None
+        if var is not None:
+            binvar = (self.matrix @ np.reshape(var, (-1, nw)))*norm**2.
+        bindq = None
+        if dq is not None:
+            inbin = self.binof >= 0
+            bindq = np.zeros((self.nbins, nw), dtype=np.int64)
+            np.bitwise_or.at(bindq, self.binof[inbin],
+                             np.reshape(dq, (-1, nw))[inbin].astype(np.int64))
+        return (bindat.astype(np.asarray(dat).dtype).reshape(shape),
+                None if binvar is None else
+                binvar.astype(np.asarray(var).dtype).reshape(shape),
+                None if bindq is None else bindq.reshape(shape))
+
+    def to_map(self, values, fill=np.nan):
+        '''
+        Broadcast values of the bins back to the spaxels of the map.
+
+        :Params:
+            values: in, required, type=dblarr(nbins, ...)
+                One value (or array) per bin.
+            fill: in, optional, default=NaN
+                Value for spaxels in no bin.
+
+        :Returns:
+            Array of shape (ncols, nrows, ...).
+        '''
+        values = np.asarray(values)
+        out = np.full((len(self.binof),) + values.shape[1:], fill,
+                      dtype=np.result_type(values, type(fill)))
+        inbin = self.binof >= 0
+        out[inbin] = values[self.binof[inbin]]
+        return out.reshape(self.shape + values.shape[1:])
+
+
+class LAZYPLANE:
+    '''
+    One plane (data, variance, error, or DQ) of a lazy CUBE.
+
+    Indexing reads only the indexed elements from the memory-mapped file
+    and returns them as a new array, converted to dtype and passed through
+    fcn. np.asarray() reads the whole plane.
+    '''
+
+    def __init__(self, raw, fcn=None, dtype=None):
+        self.raw = raw
+        self.fcn = fcn
+        if dtype is None:
+            self.dtype = raw.dtype.newbyteorder('=')
+        else:
+            self.dtype = np.dtype(dtype)
+        self.shape = raw.shape
+        self.ndim = raw.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        out = np.array(self.raw[key], dtype=self.dtype)
+        if self.fcn is not None:
+            out = self.fcn(out)
+        return out
+
+    def __array__(self, dtype=None):
+        out = self[...]
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+
+class LAZYMASK:
+    '''
+    Good-data mask of a lazy CUBE.
+
+    Indexing reads the indexed elements of the data, variance, and DQ
+    planes and returns the mask for them (see CUBE.gdmask), so that nothing
+    is read until a spaxel is needed. np.asarray() computes the whole mask.
+    '''
+
+    def __init__(self, dat, var, dq):
+        self.dat = dat
+        self.var = var
+        self.dq = dq
+        self.dtype = np.dtype(bool)
+        self.shape = dat.shape
+        self.ndim = dat.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return _gdmask(self.dat[key],
+                       None if self.var is None else self.var[key],
+                       None if self.dq is None else self.dq[key])
+
+    def __array__(self, dtype=None):
+        out = self[...]
+        if dtype is not None:
+            out = out.astype(dtype)
+        return out
+
+
 class CUBE:
     def __init__(self, **kwargs):
         warnings.filterwarnings("ignore")
@@ -136,9 +443,16 @@ class CUBE:
         self.infile = infile
         # log file; default STDOUT
         logfile = kwargs.get('logfile', stdout)
+        # memory-mapped planes, and working precision
+        lazy = kwargs.get('lazy', False)
+        dtype = np.dtype(kwargs.get('dtype', 'float64'))
         # input file
         try:
-            hdu = fits.open(fp+infile, ignore_missing_end=True)
+            if lazy:
+                hdu = fits.open(fp+infile, ignore_missing_end=True,
+                                memmap=True)
+            else:
+                hdu = fits.open(fp+infile, ignore_missing_end=True)
         except FileNotFoundError:
             raise CubeError(infile+' does not exist')
         # fits extensions labels
@@ -159,57 +473,33 @@ class CUBE:
         wavext = kwargs.get('wavext', None)
         zerodq = kwargs.get('zerodq', False)
         vormap = kwargs.get('vormap', None)
+        if vormap is False:
+            vormap = None
+        vorcombine = kwargs.get('vorcombine', 'first')
+
+        # region of interest: first and last columns and rows (1-offset),
+        # and wavelength range
+        cols = kwargs.get('cols', None)
+        rows = kwargs.get('rows', None)
+        waverange = kwargs.get('waverange', None)
 
         # populate hdus
         self.hdu = hdu
         self.phu = hdu[0]
         try:
-            self.dat = np.array((hdu[datext].data).T, dtype='float64')
+            datashape = hdu[datext].shape[::-1]
         except (IndexError or KeyError):
             raise CubeError('Data extension not properly specified or absent')
-
-        if varext is not None:
-            try:
-                self.var = np.array((hdu[varext].data).T, dtype='float64')
-            except (IndexError or KeyError):
-                raise CubeError('Variance extension not properly specified ' +
-                                'or absent')
-            if invvar:
-                self.var = 1./self.var
-            if error:
-                self.err = self.var
-                self.var = self.var**2.
-            else:
-                badvar = np.where(self.var < 0)
-                if np.size(badvar) > 0:
-                    print('CUBE: Negative values encountered in variance ' +
-                          'array. Taking absolute value.', file=logfile)
-                self.var = np.abs(self.var)
-                self.err = np.array(copy.copy(self.var) ** 0.5)
-        else:
-            self.var = None
-            self.err = None
-
-        if dqext is not None:
-            try:
-                self.dq = np.array((hdu[dqext].data).T)
-            except (IndexError or KeyError):
-                raise CubeError('DQ extension not properly specified ' +
-                                'or absent')
-        else:
-            self.dq = None
-        # put all dq to good (0)
-        if zerodq:
-            self.dq = np.zeros(np.shape(self.dat))
-
-        if wmapext is not None:
-            try:
-                self.wmap = (hdu[wmapext].data).T
-            except (IndexError or KeyError):
-                raise CubeError('WMAP extension not properly specified ' +
-                                'or absent')
-        else:
-            self.wmap = None
+        # only cubes are worth reading lazily, or in part
+        lazy = lazy and len(datashape) == 3
+        if lazy and (vormap is not None or linearize):
+            raise CubeError('CUBE: lazy can\'t be combined with vormap ' +
+                            'or linearize')
+        self.lazy = lazy
+        roi = cols is not None or rows is not None or waverange is not None
+        if roi and (len(datashape) != 3 or vormap is not None or linearize):
+            raise CubeError('CUBE: cols, rows, and waverange need a 3D ' +
+                            'cube, without vormap or linearize')
 
         # headers
         self.header_phu = hdu[0].header
@@ -219,7 +509,6 @@ class CUBE:
         header = copy.copy(self.header_dat)
 
         # Get shape of cube
-        datashape = np.shape(self.dat)
         if np.size(datashape) == 3:
             ncols = (datashape)[0]
             nrows = (datashape)[1]
@@ -335,26 +624,115 @@ class CUBE:
             wave_in = self.wave * u.Unit(self.waveunit_in)
             self.wave = wave_in.to(u.Unit(self.waveunit_out)).value
 
+        # region of interest, as slices of the (transposed) planes
+        csl = _roi_slice(cols, self.ncols)
+        rsl = _roi_slice(rows, self.nrows)
+        if waverange is not None:
+            iw = np.flatnonzero((self.wave >= waverange[0]) &
+                                (self.wave <= waverange[1]))
+            if len(iw) == 0:
+                raise CubeError('CUBE: no wavelengths in waverange')
+            wsl = slice(iw[0], iw[-1]+1)
+        else:
+            wsl = slice(0, self.nw)
+        # first column and row read (0-offset), and the ranges read, in the
+        # same form as the cols and rows keywords
+        self.col0 = csl.start
+        self.row0 = rsl.start
+        self.cols = [csl.start+1, csl.stop]
+        self.rows = [rsl.start+1, rsl.stop]
+        if roi:
+            self.wave = self.wave[wsl]
+            self.nw = len(self.wave)
+            if wavext is None:
+                self.crpix -= wsl.start
+                self.wav0 += wsl.start*self.cdelt
+            # WCS of the planes read
+            starts = [csl.start, rsl.start, wsl.start]
+            sizes = [csl.stop-csl.start, rsl.stop-rsl.start, self.nw]
+            self.header_dat = _crop_header(self.header_dat, starts, sizes)
+            self.header_var = _crop_header(self.header_var, starts, sizes)
+            self.header_dq = _crop_header(self.header_dq, starts, sizes)
+        # FITS order of axes
+        fitsroi = (wsl, rsl, csl)
+
+        def read(ext):
+            # a plane as stored, or only its region of interest
+            if not roi:
+                return hdu[ext].data
+            elif lazy:
+                return hdu[ext].data[fitsroi]
+            return hdu[ext].section[fitsroi]
+
+        datraw = read(datext)
+        if lazy:
+            self.dat = LAZYPLANE(datraw.T, dtype=dtype)
+        else:
+            self.dat = np.array(datraw.T, dtype=dtype)
+
+        self.__err = None
+        if varext is not None:
+            try:
+                varraw = read(varext)
+            except (IndexError or KeyError):
+                raise CubeError('Variance extension not properly specified ' +
+                                'or absent')
+            if lazy:
+                self.var = LAZYPLANE(varraw.T, lambda raw:
+                                     _variance(raw, error, invvar),
+                                     dtype=dtype)
+                self.__err = LAZYPLANE(varraw.T, lambda raw:
+                                       np.sqrt(_variance(raw, error, invvar)),
+                                       dtype=dtype)
+            else:
+                if not error and np.any(varraw < 0):
+                    print('CUBE: Negative values encountered in variance ' +
+                          'array. Taking absolute value.', file=logfile)
+                self.var = _variance(np.array(varraw.T, dtype=dtype), error,
+                                     invvar)
+        else:
+            self.var = None
+
+        if dqext is not None:
+            try:
+                if lazy:
+                    self.dq = LAZYPLANE(read(dqext).T)
+                else:
+                    self.dq = np.array(read(dqext).T)
+            except (IndexError or KeyError):
+                raise CubeError('DQ extension not properly specified ' +
+                                'or absent')
+        else:
+            self.dq = None
+        # put all dq to good (0)
+        if zerodq:
+            if lazy:
+                self.dq = LAZYPLANE(np.broadcast_to(np.uint8(0),
+                                                    self.dat.shape))
+            else:
+                self.dq = np.zeros(np.shape(self.dat))
+
+        if wmapext is not None:
+            try:
+                self.wmap = read(wmapext).T
+            except (IndexError or KeyError):
+                raise CubeError('WMAP extension not properly specified ' +
+                                'or absent')
+        else:
+            self.wmap = None
+
         # indexing of Voronoi-tessellated data
-        if vormap:
-            ncols = np.max(vormap)
-            nrows = 1
-            vordat = np.zeros((ncols, nrows, nw))
-            vorvar = np.zeros((ncols, nrows, nw))
-            vordq = np.zeros((ncols, nrows, nw))
-            vorcoords = np.zeros((ncols, 2), dtype=int)
-            nvor = np.zeros((ncols))
-            for i in np.arange(ncols):
-                ivor = np.where(vormap == i+1)
-                xyvor = [ivor[0][0], ivor[0][1]]
-                vordat[i, 0, :] = self.dat[xyvor[0], xyvor[1], :]
-                vorvar[i, 0, :] = self.var[xyvor[0], xyvor[1], :]
-                vordq[i, 0, :] = self.dq[xyvor[0], xyvor[1], :]
-                vorcoords[i, :] = xyvor
-                nvor[i] = (np.shape(ivor))[1]
-            self.dat = vordat
-            self.var = vorvar
-            self.dq = vordq
+        if vormap is not None:
+            self.vorbins = VORBINS(vormap)
+            self.vorcoords = self.vorbins.vorcoords
+            self.nvor = self.vorbins.nvor
+            self.dat, self.var, self.dq = \
+                self.vorbins.combine(self.dat, self.var, self.dq,
+                                     method=vorcombine)
+            # spaxels are now bins; ncols and nrows stay those of the map,
+            # which is what vorcoords index
+            self.cols = [1, self.vorbins.nbins]
+            self.rows = [1, 1]
 
         # Flux unit conversions
         # default working flux unit is erg/s/cm^2/um/sr or erg/s/cm^2/um
@@ -395,29 +773,79 @@ class CUBE:
 
         # linearize in the wavelength direction
         if linearize:
-            waveold = copy.copy(self.wave)
-            datold = copy.copy(self.dat)
-            varold = copy.copy(self.var)
-            dqold = copy.copy(self.dq)
+            # flux-conserving resampling, with one sparse matrix from the
+            # old to the new grid applied to all spaxels
+            waveold = self.wave
+            self.wave = np.linspace(waveold[0], waveold[-1], num=self.nw)
             self.crpix = 1
-            self.cdelt = (waveold[-1]-waveold[0]) / (self.nz-1)
-            wave = np.linspace(waveold[0], waveold[-1], num=self.nz)
-            self.wave = wave
-            spldat = interpolate.splrep(waveold, datold, s=0)
-            self.dat = interpolate.splev(waveold, spldat, der=0)
-            splvar = interpolate.splrep(waveold, varold, s=0)
-            self.var = interpolate.splev(waveold, splvar, der=0)
-            spldq = interpolate.splrep(waveold, dqold, s=0)
-            self.dq = interpolate.splev(waveold, spldq, der=0)
+            self.cdelt = (waveold[-1]-waveold[0]) / (self.nw-1)
+            self.crval = self.wave[0]
+            self.wav0 = self.wave[0]
+            rebin = _rebin_matrix(waveold, self.wave)
+            self.dat = _rebin(self.dat, rebin)
+            if self.var is not None:
+                # input pixels are independent, so the weights add in
+                # quadrature
+                self.var = _rebin(self.var, rebin.multiply(rebin))
+            if self.dq is not None:
+                self.dq = _rebin_dq(self.dq, rebin)
             if not quiet:
-                print('CUBE: Interpolating DQ; values > 0.01 set to 1.',
+                print('CUBE: Resampling to a linear wavelength scale; DQ ' +
+                      'flags of overlapping pixels are combined.',
                       file=logfile)
-            ibd = np.where(self.dq > 0.01)
-            if np.size(ibd) > 0:
-                self.dq[ibd] = 1
 
-        # close the fits file
-        hdu.close()
+        # good data, computed once for the whole cube; fit-specific masks
+        # (fit range, cutrange) are applied on top of this
+        if lazy:
+            # computed for each spaxel as it's read
+            self.gdmask = LAZYMASK(self.dat, self.var, self.dq)
+        else:
+            self.gdmask = _gdmask(self.dat, self.var, self.dq)
+        # wavelength masks, by range; see wavemask
+        self.__wavemasks = dict()
+
+        # close the fits file; lazy planes still read from it
+        if not lazy:
+            hdu.close()
+
+    @property
+    def err(self):
+        '''
+        Error array, the square root of the variance. Computed when first
+        needed; if lazy, a LAZYPLANE that computes it for what is read.
+        '''
+        if self.var is None:
+            return None
+        if not self.lazy and (self.__err is None or
+                              self.__err.shape != np.shape(self.var)):
+            self.__err = np.sqrt(self.var)
+        return self.__err
+
+    @err.setter
+    def err(self, value):
+        self.__err = value
+
+    def wavemask(self, ranges):
+        '''
+        Mask of wavelengths within any of a set of ranges.
+
+        :Params:
+            ranges: in, required, type=dblarr(2) or dblarr(nranges, 2)
+                Lower and upper limits of each range, inclusive.
+
+        :Returns:
+            Boolean array over wave. It is computed once per set of ranges
+            and shared, so don't modify it.
+        '''
+        ranges = np.atleast_2d(np.asarray(ranges, dtype=np.float64))
+        key = ranges.tobytes()
+        if key not in self.__wavemasks:
+            mask = np.zeros(len(self.wave), dtype=bool)
+            for lo, hi in ranges:
+                mask |= (self.wave >= lo) & (self.wave <= hi)
+            mask.flags.writeable = False
+            self.__wavemasks[key] = mask
+        return self.__wavemasks[key]
 
 
 if __name__ == "__main__":
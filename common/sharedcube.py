@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Node-local shared copy of a CUBE, for Q3DF's MPI and multi-process paths.
+
+Without it, every MPI rank reads the cube and holds its own copy of dat,
+var, err, dq, and gdmask. With initdat['sharedcube'] set, one process per
+node reads the cube and moves these planes into shared memory
+(multiprocessing.shared_memory), and the other processes attach read-only
+views of them. The rest of the CUBE (wavelengths, headers, and so on) is
+small and is passed along as usual.
+
+SHARE_CUBE is called by the process that reads the cube. It returns a stub,
+a copy of the CUBE with SHAREDPLANEs in place of the planes, which can be
+sent to the other processes (by MPI broadcast or as a pool initializer
+argument). Each of them calls ATTACH_CUBE on the stub. When all are done,
+the reading process calls RELEASE_CUBE with unlink=True. Processes forked
+after SHARE_CUBE already have the views, and can use the CUBE as is.
+
+Lazy (memory-mapped) cubes are already shared through the page cache, so
+they aren't copied into shared memory.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import copy
+import multiprocessing as mp
+import numpy as np
+
+from multiprocessing import shared_memory
+
+# Planes of a CUBE that are shared
+_planes = ['dat', 'var', 'err', 'dq', 'gdmask']
+# Shared-memory blocks created or attached by this process, by name
+_blocks = dict()
+
+
+class SHAREDPLANE:
+    '''
+    Name, shape, and type of a CUBE plane in shared memory.
+    '''
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.ndim = len(self.shape)
+
+
+def __attach(name):
+    # Open an existing block, once per process
+    if name not in _blocks:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13, attaching registers the block with this
+            # process's resource tracker. A process of its own (e.g., an
+            # MPI rank) has its own tracker, which would remove the block
+            # at exit from under the others, so the registration is undone.
+            # A multiprocessing child shares its parent's tracker, where
+            # that would undo the creator's registration instead.
+            shm = shared_memory.SharedMemory(name=name)
+            if mp.parent_process() is None:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        _blocks[name] = shm
+    return _blocks[name]
+
+
+def __view(shm, shape, dtype):
+    view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    view.flags.writeable = False
+    return view
+
+
+def share_cube(cube):
+    '''
+    Move the planes of a CUBE into shared memory.
+
+    :Params:
+        cube: in, required, type=CUBE
+            Cube, not lazy. Its planes are replaced by read-only views of
+            the shared copies.
+
+    :Returns:
+        Stub to pass to ATTACH_CUBE in the other processes: a copy of the
+        CUBE, without its HDU list, with SHAREDPLANEs in place of the
+        planes.
+    '''
+    if cube.lazy:
+        raise ValueError('SHARE_CUBE: lazy cubes are already shared')
+    stub = copy.copy(cube)
+    stub.hdu = None
+    for plane in _planes:
+        arr = getattr(cube, plane)
+        if arr is None:
+            continue
+        arr = np.asarray(arr)
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(arr.nbytes, 1))
+        _blocks[shm.name] = shm
+        view = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+        view[...] = arr
+        view.flags.writeable = False
+        setattr(cube, plane, view)
+        setattr(stub, plane, SHAREDPLANE(shm.name, arr.shape, arr.dtype.str))
+    return stub
+
+
+def attach_cube(stub):
+    '''
+    Get a CUBE whose planes are views of the shared copies.
+
+    :Params:
+        stub: in, required, type=CUBE
+            Output of SHARE_CUBE.
+
+    :Returns:
+        CUBE, with read-only planes.
+    '''
+    cube = copy.copy(stub)
+    for plane in _planes:
+        desc = getattr(stub, plane)
+        if isinstance(desc, SHAREDPLANE):
+            setattr(cube, plane,
+                    __view(__attach(desc.name), desc.shape, desc.dtype))
+    return cube
+
+
+def release_cube(unlink=False):
+    '''
+    Close this process's shared blocks.
+
+    :Params:
+        unlink: in, optional, type=boolean, default=False
+            Also remove the blocks. Only the process that called SHARE_CUBE
+            should set this, once the others are done with the cube.
+    '''
+    for name in list(_blocks):
+        shm = _blocks.pop(name)
+        try:
+            shm.close()
+        except BufferError:
+            # views of the block are still around; the mapping goes
+            # away with them
+            pass
+        if unlink:
+            shm.unlink()
@@ -10,6 +10,9 @@ The user also can choose alternative methods.
 METHOD 0 = flat convolution by wavelength bins (takes median resolving power at middle of wavelength bin)
 METHOD 1 = convolution by dispersion curves: loop through each pixel element)
 METHOD 2 = PPXF dispersion curve convolution (convolution by dispersion curves) - DEFAULT  
+METHOD 3 = analytic: no numerical convolution. For Gaussian lines, convolving with a Gaussian
+           LSF is the same as adding the LSF sigma in quadrature, so PARINIT sets each line's
+           srsigslam from the dispersion curve at the line's initial wavelength instead
 
 How to run this :
 import spectConvol
@@ -30,6 +33,12 @@ EDIT:
 - Fixed the wavelength matching. Now the convolution function can read in any spectrum and convolve lines according to desired JWST instrument/channel
 - cleaned/slimmed the __init__() call and generalized get_dispersion_data() call. The convolution method solely depends on the dispersion file selection
 - adding km/s reading implementation
+- METHOD 2 now builds a sparse convolution operator once per grating and wavelength grid, and
+  applies it as a single matrix-vector product. Operators are looked up by the identity of the
+  wavelength array, which is the same object for every evaluation of a fit, and only hashed
+  when a new array comes in; at most _maxoperators of each are kept. Set
+  initdat['spect_convol']['opcache'] to a directory to also save up to _maxopfiles operators
+  per grating there and reuse them in later runs.
 
 """
 
@@ -38,10 +47,24 @@ import os
 from astropy.io import fits
 import glob
 import copy
+import hashlib
+from scipy import sparse
 from scipy.ndimage import gaussian_filter1d
 from scipy.interpolate import interp1d
 import q3dfit.data.dispersion_files
 
+# METHOD 2 operators kept in memory, by grid content and by grid array; oldest dropped first
+_maxoperators = 16
+# METHOD 2 operators saved to opcache, per grating
+_maxopfiles = 64
+
+
+def _cache_put(cache,key,val):
+    if len(cache) >= _maxoperators:
+        del cache[next(iter(cache))]
+    cache[key] = val
+
+
 class spectConvol:
     def __init__(self,initdat):
         #self.datDIR = '../data/dispersion_files'
@@ -58,6 +81,12 @@ class spectConvol:
             for grat in inst:
                 self.init_inst[wsi.upper()][grat.upper()]=None
         self.wavelength = initdat['argsreadcube']['waveunit_in']  
+        # METHOD 2 operators, by grating and wavelength grid content, and by grating and grid
+        # array (with a reference to the array, so that its id isn't reused); and where to
+        # save them
+        self.operators = {}
+        self.gridoperators = {}
+        self.opcache = initdat['spect_convol'].get('opcache')
         
         dispfiles = [dfile.split('/')[-1] for dfile in glob.glob(os.path.join(self.datDIR,'*.fits'))]
         self.get_dispersion_data(dispfiles)
@@ -101,30 +130,25 @@ class spectConvol:
         METHOD 0 = flat convolution by wavelength bins
         METHOD 1 = convolution by dispersion curves: loop through each pixel element)
         METHOD 2 = PPXF method (convolution by dispersion curves) - DEFAULT
+        METHOD 3 = analytic; the LSF is in srsigslam, so nothing to do here
         '''
         self.printSILENCE = SILENCE
-        if self.init_inst == {} or self.init_meth > 2:
+        if self.init_inst == {} or self.init_meth > 3:
             print('ERROR: select the instrument or correct method')
             return None
+        if self.init_meth == 3:
+            return fluxIN
         
         wvnOUT,datOUT = [],[]
-        found = False
-        for inst,gratlist in self.init_inst.items():
-            for igrat in gratlist:
-                wvrng = self.init_inst[inst][igrat]['gwvRng']
-                if ((wvlcen > wvrng[0])  & (wvlcen < wvrng[1])) == True:
-                    found = True
-                    #print('conv w/',inst,igrat,self.init_meth,wvrng[0],wvrng[1],wvlcen)
-                    break
-                #else:
-                #    wvnOUT = []
-                #    datOUT = []
+        found,inst,igrat = self.find_grating(wvlcen)
         if found == False:
             return fluxIN   
         if self.printSILENCE != True:
-            print(':: '+inst.upper()+' - convolution',grat,self.init_meth)
+            print(':: '+inst.upper()+' - convolution',igrat,self.init_meth)
         
         # now do the convolution 
+        if self.init_meth == 2:
+            return self.get_operator(wvlIN,inst,igrat) @ fluxIN
         igwave = self.init_inst[inst][igrat]['gwave']
         #igdisp = self.init_inst[inst][igrat]['gdisp']
         igdwvn = self.init_inst[inst][igrat]['gdwvn']
@@ -156,6 +180,102 @@ class spectConvol:
         datOUT = np.concatenate((fluxIN[w1x],iR_datconv,fluxIN[w2x]))
         return datOUT
     
+    # first grating whose range contains wvlcen
+    def find_grating(self,wvlcen):
+        for inst,gratlist in self.init_inst.items():
+            for igrat in gratlist:
+                wvrng = self.init_inst[inst][igrat]['gwvRng']
+                if ((wvlcen > wvrng[0])  & (wvlcen < wvrng[1])) == True:
+                    #print('conv w/',inst,igrat,self.init_meth,wvrng[0],wvrng[1],wvlcen)
+                    return True,inst,igrat
+        return False,None,None
+
+    # METHOD 3: LSF sigma at wvlcen, in the units of the dispersion files; zero outside the
+    # gratings, where the other methods don't convolve
+    def lsf_sigma(self,wvlcen):
+        found,inst,igrat = self.find_grating(wvlcen)
+        if found == False:
+            return np.float64(0.)
+        func1 = interp1d(self.init_inst[inst][igrat]['gwave'],self.init_inst[inst][igrat]['gdwvn'])
+        return np.float64(func1(wvlcen)/2.355)
+
+    # METHOD 2 as a sparse operator on the whole input spectrum: the same convolution as
+    # gaussian_filter1d_ppxf within the grating's range, and the identity outside it.
+    # spect_convolver is called for every line component in every evaluation of a fit, with
+    # the same wavelength array, so the array itself is the first key; its content is hashed
+    # only the first time it is seen.
+    def get_operator(self,wvlIN,inst,igrat):
+        idkey = (inst,igrat,id(wvlIN))
+        if idkey in self.gridoperators and self.gridoperators[idkey][0] is wvlIN:
+            return self.gridoperators[idkey][1]
+        op = self.build_operator(wvlIN,inst,igrat)
+        _cache_put(self.gridoperators,idkey,(wvlIN,op))
+        return op
+
+    # METHOD 2 operator for a wavelength grid, from memory, opcache, or built
+    def build_operator(self,wvlIN,inst,igrat):
+        # the grid and dispersion tables as they are, as in spect_convolver, so the result is
+        # the same
+        wvlIN = np.asarray(wvlIN)
+        igwave = np.asarray(self.init_inst[inst][igrat]['gwave'])
+        igdwvn = np.asarray(self.init_inst[inst][igrat]['gdwvn'])
+        digest = hashlib.sha1()
+        for arr in [wvlIN,igwave,igdwvn]:
+            digest.update(str(arr.dtype).encode()+np.ascontiguousarray(arr).tobytes())
+        key = (inst,igrat,digest.hexdigest())
+        if key in self.operators:
+            return self.operators[key]
+
+        opfile = None
+        if self.opcache is not None:
+            gname = igrat.replace('/','-')
+            opname = f'lsf_{inst}_{gname}'.lower()
+            opfile = os.path.join(self.opcache,f'{opname}_{key[2]}.npz')
+            if os.path.isfile(opfile):
+                _cache_put(self.operators,key,sparse.load_npz(opfile).tocsr())
+                return self.operators[key]
+
+        n = wvlIN.size
+        ww = np.where((wvlIN >= min(igwave)) & (wvlIN <= max(igwave)))[0]
+        wx = np.where((wvlIN < min(igwave)) | (wvlIN > max(igwave)))[0]
+        rows = [wx]
+        cols = [wx]
+        vals = [np.ones(wx.size)]
+        if ww.size > 1:
+            iwvIN = wvlIN[ww]
+            func1 = interp1d(igwave,igdwvn)
+            fwhm = func1(iwvIN)
+            wdiff = iwvIN[1]-iwvIN[0]
+            sigma = np.divide(fwhm,2.355)/wdiff
+            p = int(np.ceil(np.max(3*sigma)))
+            m = 2*p + 1
+            x2 = np.linspace(-p,p,m)**2
+            gau = np.exp(-x2[:,None]/(2*sigma**2))
+            gau = np.divide(gau,np.sum(gau,0)[None,:])
+            # output pixel i is sum_j gau[j,i]*spec[i-p+j], for p <= i < nin-p, and zero
+            # at the edges, as in gaussian_filter1d_ppxf
+            ii = np.arange(p,ww.size-p)
+            if ii.size > 0:
+                jj = np.arange(m)[:,None]
+                rows.append(np.broadcast_to(ww[ii][None,:],(m,ii.size)).ravel())
+                cols.append(ww[ii[None,:]-p+jj].ravel())
+                vals.append(gau[:,ii].ravel())
+        op = sparse.csr_matrix((np.concatenate(vals),(np.concatenate(rows),np.concatenate(cols))),
+                               shape=(n,n))
+
+        if opfile is not None:
+            os.makedirs(self.opcache,exist_ok=True)
+            # grids that differ by their masked pixels each get an operator, so keep the
+            # number of files bounded
+            nfiles = len(glob.glob(os.path.join(self.opcache,f'{opname}_*.npz')))
+            if nfiles < _maxopfiles:
+                # write to a temporary file first, in case several processes build the same one
+                tmpfile = opfile[:-4]+f'.{os.getpid()}.tmp.npz'
+                sparse.save_npz(tmpfile,op)
+                os.replace(tmpfile,opfile)
+        _cache_put(self.operators,key,op)
+        return op
+
     # METHOD 0
     def flat_convolve(self,wvlIN,fluxIN,Rspec,WCEN=None):
         wdiff = wvlIN[1]-wvlIN[0]
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stellar template library for FITSPEC, loaded once per process.
+
+FITSPEC used to read initdat['startempfile'] and convert its wavelengths on
+every call. LOAD_TEMPLATE instead loads the library the first time it is
+asked for a file and keeps it, with its arrays made read-only. Q3DF loads
+the library before starting workers, so forked processes share one copy.
+
+STELLAR_TEMPLATE returns the observed-frame template wavelengths, converted
+exactly as FITSPEC always has: redshifted by zstar (unless
+initdat['keepstarz'] is set), then converted to vacuum (if
+initdat['vacuum'] is set), then scaled by initdat['waveunit']. The result
+is kept for each redshift, so spaxels with the same initial zstar share
+it.
+
+initdat['fcnconvtemp'] is not applied. FITSPEC used to call it and discard
+its output, so the templates have never been convolved. Applying it would
+change every fit that sets it, and needs the observed-frame wavelengths;
+it is left for a separate change.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import numpy as np
+
+from q3dfit.common.airtovac import airtovac
+
+# Template libraries, by file
+_templates = dict()
+# Observed-frame template wavelengths, by configuration and redshift; oldest
+# dropped first
+_wavelengths = dict()
+_maxwavelengths = 64
+
+
+def __startempfile(initdat):
+    startempfile = initdat['startempfile']
+    if isinstance(startempfile, bytes):
+        startempfile = startempfile.decode('utf-8')
+    return startempfile
+
+
+def load_template(initdat):
+    '''
+    Get the stellar template library for this initialization.
+
+    :Params:
+        initdat: in, required, type=dict
+            Initialization dictionary, with the startempfile tag.
+
+    :Returns:
+        Template dictionary, as in the file, with tags LAMBDA and FLUX.
+        Don't modify it; its arrays are read-only.
+    '''
+    startempfile = __startempfile(initdat)
+    if startempfile not in _templates:
+        template = np.load(startempfile, allow_pickle=True).item()
+        for val in template.values():
+            if isinstance(val, np.ndarray):
+                val.flags.writeable = False
+        _templates[startempfile] = template
+    return _templates[startempfile]
+
+
+def stellar_template(initdat, zstar):
+    '''
+    Get the stellar templates for this initialization and redshift.
+
+    :Params:
+        initdat: in, required, type=dict
+            Initialization dictionary, with the startempfile tag.
+        zstar: in, required, type=double
+            Stellar redshift.
+
+    :Returns:
+        Observed-frame template wavelengths, converted as described above,
+        and the template dictionary (see LOAD_TEMPLATE). Both are shared, so
+        don't modify them.
+    '''
+    template = load_template(initdat)
+    keepstarz = 'keepstarz' in initdat
+    key = (__startempfile(initdat), keepstarz, 'vacuum' in initdat,
+           initdat.get('waveunit'),
+           None if keepstarz else np.float64(zstar).tobytes())
+    if key not in _wavelengths:
+        # in the same order, and precision, as FITSPEC always has
+        templatelambdaz = np.copy(template['lambda'])
+        if not keepstarz:
+            templatelambdaz *= 1. + zstar
+        # This assumes template is in air wavelengths!
+        if 'vacuum' in initdat:
+            templatelambdaz = airtovac(templatelambdaz)
+        if 'waveunit' in initdat:
+            templatelambdaz *= initdat['waveunit']
+        templatelambdaz.flags.writeable = False
+        if len(_wavelengths) >= _maxwavelengths:
+            del _wavelengths[next(iter(_wavelengths))]
+        _wavelengths[key] = templatelambdaz
+    return _wavelengths[key], template
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Variable-projection fit of an lmfit model that is linear in some of its
+parameters, for the questfit continuum.
+
+Template scalings and blackbody and power-law normalizations enter the
+questfit model linearly: once the temperatures, exponents, Av, and tau are
+fixed, the model is a sum of columns times nonnegative amplitudes. VARPRO_FIT
+solves for those amplitudes exactly, by bounded linear least squares, inside
+each evaluation of the nonlinear problem, which then has only the nonlinear
+parameters. From the solution, it runs lmfit's least_squares once more,
+which converges at once, for uncertainties and a standard ModelResult.
+
+Use it with argscontfit['solver'] = 'varpro'.
+
+:Categories:
+   IFSFIT
+
+"""
+
+import copy
+import numpy as np
+
+from scipy.optimize import least_squares, lsq_linear
+
+
+def linear_params(params):
+    '''
+    Names of the varied questfit amplitudes: template scalings (*_amp) and
+    blackbody and power-law normalizations (blackbody*a, powerlaw*a).
+    '''
+    names = []
+    for name, par in params.items():
+        if not par.vary or par.expr:
+            continue
+        if name.endswith('_amp') or \
+            (name.startswith(('blackbody', 'powerlaw')) and
+             name.endswith('a') and '_' not in name):
+            names.append(name)
+    return names
+
+
+def varpro_fit(model, params, data, linear=None, max_nfev=None, **kws):
+    '''
+    Fit MODEL to DATA by variable projection.
+
+    :Params:
+        model: in, required, type=lmfit.Model
+            Model, linear in the LINEAR parameters.
+        params: in, required, type=lmfit.Parameters
+            Parameters, with initial values and limits.
+        data: in, required, type=dblarr(npix)
+            Data to fit, unweighted. Non-finite points are ignored.
+        linear: in, optional, type=list
+            Names of the linear parameters. Default is LINEAR_PARAMS.
+        max_nfev: in, optional, type=int
+            Maximum number of evaluations for each of the nonlinear fit and
+            the final lmfit fit.
+        kws: in, optional
+            Independent variables of the model.
+
+    :Returns:
+        lmfit.ModelResult of the final fit.
+    '''
+    if linear is None:
+        linear = linear_params(params)
+    nonlin = [name for name, par in params.items()
+              if par.vary and not par.expr and name not in linear]
+    good = np.isfinite(data)
+    y = np.asarray(data, dtype=np.float64)[good]
+
+    # working copy; the linear parameters are set to 0 or 1 to get the
+    # columns, so their limits go to the linear solver instead
+    pars = copy.deepcopy(params)
+    lo = np.array([pars[name].min for name in linear], dtype=np.float64)
+    hi = np.array([pars[name].max for name in linear], dtype=np.float64)
+    for name in linear:
+        pars[name].set(min=-np.inf, max=np.inf)
+
+    def evaluate():
+        return np.ravel(model.eval(pars, **kws))[good]
+
+    def solve(theta):
+        # Best amplitudes for the nonlinear parameters theta, and the model
+        for name, val in zip(nonlin, theta):
+            pars[name].value = val
+        for name in linear:
+            pars[name].value = 0.
+        # anything not scaled by a varied amplitude
+        offset = evaluate()
+        cols = np.empty((len(y), len(linear)))
+        for k, name in enumerate(linear):
+            pars[name].value = 1.
+            cols[:, k] = evaluate() - offset
+            pars[name].value = 0.
+        if len(linear) > 0:
+            amps = lsq_linear(cols, y - offset, bounds=(lo, hi),
+                              method='bvls').x
+        else:
+            amps = np.zeros(0)
+        return amps, cols @ amps + offset
+
+    theta = np.array([params[name].value for name in nonlin],
+                     dtype=np.float64)
+    if len(nonlin) > 0:
+        lo_nl = np.array([params[name].min for name in nonlin],
+                         dtype=np.float64)
+        hi_nl = np.array([params[name].max for name in nonlin],
+                         dtype=np.float64)
+        theta = np.clip(theta, lo_nl, hi_nl)
+        out = least_squares(lambda th: solve(th)[1] - y, theta,
+                            bounds=(lo_nl, hi_nl),
+                            max_nfev=max_nfev)
+        theta = out.x
+    amps, _ = solve(theta)
+
+    # final fit from the solution, for uncertainties
+    best = copy.deepcopy(params)
+    for name, val in zip(nonlin, theta):
+        best[name].value = val
+    for name, val in zip(linear, amps):
+        best[name].value = val
+    return model.fit(data, best, method='least_squares', nan_policy='omit',
+                     max_nfev=max_nfev, **kws)
@@ -10,6 +10,7 @@ Initialize parameters for fitting.
 
 from astropy.table import QTable, Table
 from lmfit import Model
+import copy
 from q3dfit.common.lmlabel import lmlabel
 from q3dfit.exceptions import InitializationError
 import numpy as np
@@ -17,17 +18,15 @@ import pdb
 import q3dfit.data
 import os
 
+# Doublets table, read on first use
+_doublets = None
+# Line models and parameter templates, by configuration; see __model_key
+_models = dict()
+
+
 def parinit(linelist, linelistz, linetie, initflux, initsig, maxncomp, ncomp, specConv,
             lineratio=None, siglim=None, sigfix=None, blrcomp=None,
-            blrlines=None, specres=None):
-
-    # Get fixed-ratio doublet pairs for tying intensities
-    data_path = os.path.abspath(q3dfit.data.__file__)[:-11]
-    doublets = Table.read(data_path+'linelists/doublets.tbl', format='ipac')
-    dblt_pairs = dict()
-    for idx, name in enumerate(doublets['line1']):
-        if doublets['fixed_ratio'][idx] == 1:
-            dblt_pairs[doublets['line2'][idx]] = doublets['line1'][idx]
+            blrlines=None, specres=None, nsigwin=None):
 
     if not specres:
         specres = np.float64(0.)
@@ -39,6 +38,131 @@ def parinit(linelist, linelistz, linetie, initflux, initsig, maxncomp, ncomp, sp
     else:
         siglim = np.array(siglim, dtype='float64')
 
+    # The model and the parameter names, limits, and ties depend only on the
+    # configuration, so they are built once per process for each. Each call
+    # gets a copy of the parameters with its own initial values.
+    key = __model_key(linelist, linetie, ncomp, specConv, lineratio, siglim,
+                      specres, nsigwin)
+    if key not in _models:
+        _models[key] = \
+            __build_model(linelist, linelistz, linetie, initflux, initsig,
+                          ncomp, specConv, lineratio, siglim, specres,
+                          nsigwin)
+    totmod, template, updates, ratios, _ = _models[key]
+    fit_params = copy.deepcopy(template)
+
+    # initial values, and wavelength limits
+    values = dict()
+    for parname, gpar, label, comp in updates:
+        if gpar == 'flx':
+            value = initflux[label][comp]
+            limits = None
+        elif gpar == 'cwv':
+            value = linelistz[label][comp]
+            limits = np.array([value*0.997, value*1.003], dtype='float64')
+        elif gpar == 'sig':
+            value = initsig[label][comp]
+            limits = None
+        else:
+            value = __srsigslam(specConv, specres, linelistz[label][comp])
+            limits = None
+        __set_value(fit_params[parname], value, limits)
+        values[parname] = value
+    # line ratios with no initial value in the lineratio table start at the
+    # ratio of the initial fluxes
+    for lmrat, flx1, expr1, flx2, expr2 in ratios:
+        ratio = np.divide(__init_value(flx1, expr1, values),
+                          __init_value(flx2, expr2, values))
+        __set_value(fit_params[lmrat], ratio)
+        values[lmrat] = ratio
+
+    # pass siglim_gas back because the default is set here, and it's needed
+    # downstream
+    return totmod, fit_params, siglim
+
+
+def __read_doublets():
+    # Doublets table, read from disk on first use
+    global _doublets
+    if _doublets is None:
+        data_path = os.path.abspath(q3dfit.data.__file__)[:-11]
+        _doublets = Table.read(data_path+'linelists/doublets.tbl',
+                               format='ipac')
+    return _doublets
+
+
+def __model_key(linelist, linetie, ncomp, specConv, lineratio, siglim,
+                specres, nsigwin):
+    # Hashable description of everything that sets the model and the
+    # parameter names, limits, and ties. specConv enters by identity; the
+    # cache keeps a reference to it, so the id can't be reused.
+    lines = tuple((str(name), float(np.asarray(wave)))
+                  for name, wave in zip(linelist['name'], linelist['lines']))
+    ncomps = tuple(sorted((str(line), int(nc)) for line, nc in ncomp.items()))
+    ties = tuple(sorted((str(line), str(tie))
+                        for line, tie in linetie.items()))
+    if lineratio is None:
+        ratios = None
+    else:
+        ratios = (tuple(lineratio.colnames),
+                  tuple(tuple(str(row[col]) for col in lineratio.colnames)
+                        for row in lineratio))
+    return (lines, ncomps, ties, ratios, tuple(siglim), float(specres),
+            nsigwin, id(specConv))
+
+
+def __analytic_lsf(specConv):
+    # True if the spectral resolution goes into srsigslam instead of
+    # being applied by numerical convolution (ws_method 3)
+    return specConv is not None and getattr(specConv, 'init_meth', None) == 3
+
+
+def __srsigslam(specConv, specres, wave):
+    # Instrumental sigma for a line at wavelength wave
+    if __analytic_lsf(specConv):
+        return specConv.lsf_sigma(wave)
+    return specres
+
+
+def __set_value(par, value, limits=None):
+    # Set an initial value the way SET_PARAMS does: value first, then limits.
+    # Setting the value drops any tie, so it is put back.
+    expr = par.expr
+    vmin = par.min
+    vmax = par.max
+    par.min = -np.inf
+    par.max = np.inf
+    par.set(value=value)
+    if expr:
+        par.expr = expr
+    if limits is not None:
+        vmin, vmax = limits
+    par.min = vmin
+    par.max = vmax
+
+
+def __init_value(parname, expr, values):
+    # Initial value of a parameter, given its tie when the template was built
+    if expr:
+        return eval(expr, {'__builtins__': {}}, values)
+    return values[parname]
+
+
+def __build_model(linelist, linelistz, linetie, initflux, initsig, ncomp,
+                  specConv, lineratio, siglim, specres, nsigwin):
+    # Build the line model and a template of its parameters. Also returns
+    # the parameters whose values and limits change with each call, and the
+    # line ratios whose initial values come from the initial fluxes.
+
+    # Get fixed-ratio doublet pairs for tying intensities
+    doublets = __read_doublets()
+    dblt_pairs = dict()
+    for idx, name in enumerate(doublets['line1']):
+        if doublets['fixed_ratio'][idx] == 1:
+            dblt_pairs[doublets['line2'][idx]] = doublets['line1'][idx]
+    updates = []
+    ratios = []
+
     # converts the astropy.Table structure of linelist into a Python
     # dictionary that is compatible with the code downstream
     lines_arr = {name: linelist['lines'][idx] for idx, name
@@ -55,7 +179,12 @@ def parinit(linelist, linelistz, linetie, initflux, initsig, maxncomp, ncomp, sp
             # LMFIT parameters can only consist of letters,  numbers, or _
             lmline = lmlabel(line)
             mName = f'{lmline.lmlabel}_{i}_'
-            imodel = Model(manygauss, prefix=mName,SPECRES=specConv)
+            # no numerical convolution if the LSF is in srsigslam
+            if __analytic_lsf(specConv):
+                imodel = Model(manygauss, prefix=mName, NSIGWIN=nsigwin)
+            else:
+                imodel = Model(manygauss, prefix=mName, SPECRES=specConv,
+                               NSIGWIN=nsigwin)
             if isinstance(totmod, Model):
                 totmod += imodel
             else:
@@ -117,11 +246,12 @@ def parinit(linelist, linelistz, linetie, initflux, initsig, maxncomp, ncomp, sp
             else:
                 tied = ''
         else:
-            value = specres
+            value = __srsigslam(specConv, specres, linelistz[line.label][comp])
             limited = None
             limits = None
             vary = False
             tied = ''
+        updates.append((parname, gpar, line.label, comp))
 
         fit_params = \
             set_params(fit_params, parname, VALUE=value,
@@ -149,13 +279,18 @@ def parinit(linelist, linelistz, linetie, initflux, initsig, maxncomp, ncomp, sp
                 if f'{lmline1.lmlabel}_{comp}_flx' in fit_params.keys() and \
                     f'{lmline2.lmlabel}_{comp}_flx' in fit_params.keys():
                     # set initial value
+                    flx1 = f'{lmline1.lmlabel}_{comp}_flx'
+                    flx2 = f'{lmline2.lmlabel}_{comp}_flx'
                     if 'value' in lineratio.colnames:
                         initval = lineratio['value'][ilinrat]
                     else:
-                        initval = \
-                            np.divide(
-                                fit_params[f'{lmline1.lmlabel}_{comp}_flx'],
-                                fit_params[f'{lmline2.lmlabel}_{comp}_flx'])
+                        initval = np.divide(fit_params[flx1],
+                                            fit_params[flx2])
+                        # redone with each call's initial fluxes
+                        ratios.append((f'{lmline1.lmlabel}_div_' +
+                                       f'{lmline2.lmlabel}_{comp}',
+                                       flx1, fit_params[flx1].expr,
+                                       flx2, fit_params[flx2].expr))
                     lmrat = f'{lmline1.lmlabel}_div_{lmline2.lmlabel}_{comp}'
                     fit_params.add(lmrat, value=initval)
                     # tie second line to first line divided by the ratio
@@ -197,9 +332,7 @@ def parinit(linelist, linelistz, linetie, initflux, initsig, maxncomp, ncomp, sp
                             lower = 1. / doublets['upper'][iline1][0]
                         fit_params[lmrat].min = lower
 
-    # pass siglim_gas back because the default is set here, and it's needed
-    # downstream
-    return totmod, fit_params, siglim
+    return totmod, fit_params, updates, ratios, specConv
 
 
 def set_params(fit_params, NAME, VALUE=None, VARY=True, LIMITED=None,
@@ -217,13 +350,21 @@ def set_params(fit_params, NAME, VALUE=None, VARY=True, LIMITED=None,
     return fit_params
 
 
-def manygauss(x, flx, cwv, sig, srsigslam, SPECRES=None):
+def manygauss(x, flx, cwv, sig, srsigslam, SPECRES=None, NSIGWIN=None):
     # param 0 flux
     # param 1 central wavelength
     # param 2 sigma
+    # NSIGWIN: if set, evaluate only within this many sigma of the center;
+    # x must then be increasing
     c = np.float64(299792.458)
     sigs = np.sqrt(np.power((sig/c)*cwv, 2.) + np.power(srsigslam, 2.))
-    gaussian = flx*np.exp(-np.power((x-cwv) / sigs, 2.)/2.)
+    if NSIGWIN is not None:
+        lo, hi = gausswin(x, cwv, NSIGWIN*sigs)
+        gaussian = np.zeros(len(x))
+        gaussian[lo:hi] = \
+            flx*np.exp(-np.power((x[lo:hi]-cwv) / sigs, 2.)/2.)
+    else:
+        gaussian = flx*np.exp(-np.power((x-cwv) / sigs, 2.)/2.)
     if SPECRES != None:
         datconv = SPECRES.spect_convolver(x,gaussian,cwv)
         return datconv
@@ -232,3 +373,10 @@ def manygauss(x, flx, cwv, sig, srsigslam, SPECRES=None):
     #gaussian[maskind] = np.float64(0.)
     else:
         return gaussian
+
+
+def gausswin(x, cwv, halfwidth):
+    # Index range [lo, hi) of the increasing array x within halfwidth of cwv
+    lo = np.searchsorted(x, cwv - halfwidth, side='left')
+    hi = np.searchsorted(x, cwv + halfwidth, side='right')
+    return lo, hi
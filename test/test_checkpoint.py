@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from q3dfit.common.checkpoint import fit_is_current, fithash, initdathash, \
+    save_fit
+from q3dfit.exceptions import InitializationError
+
+
+def _initdat(tmp_path):
+    return {'label': 'test', 'outdir': str(tmp_path) + '/',
+            'lines': ['Halpha', '[NII]6583'], 'maxncomp': 2,
+            'argsinitpar': {'siglim': [5., 1000.]}}
+
+
+def _spectrum():
+    wave = np.linspace(6400., 6700., 301)
+    flux = np.exp(-0.5*((wave-6563.)/3.)**2)
+    err = np.full(wave.shape, 0.1)
+    dq = np.zeros(wave.shape)
+    return wave, flux, err, dq
+
+
+def test_initdathash_sees_in_place_changes(tmp_path):
+    initdat = _initdat(tmp_path)
+    before = initdathash(initdat)
+    initdat['argsinitpar']['siglim'] = [5., 2000.]
+    assert initdathash(initdat) != before
+    initdat['argsinitpar']['siglim'] = [5., 1000.]
+    assert initdathash(initdat) == before
+
+
+def test_initdathash_ignores_output_keys(tmp_path):
+    initdat = _initdat(tmp_path)
+    before = initdathash(initdat)
+    initdat['outdir'] = 'elsewhere/'
+    assert initdathash(initdat) == before
+
+
+def test_resume_invalidated_by_line_list(tmp_path):
+    initdat = _initdat(tmp_path)
+    spec = _spectrum()
+    outlab = str(tmp_path / 'test_0001_0001')
+    save_fit(outlab, {'fithash': fithash(initdat, *spec)})
+    assert fit_is_current(outlab, fithash(initdat, *spec))
+
+    # same dictionary, changed in place
+    initdat['lines'].append('[NII]6548')
+    assert not fit_is_current(outlab, fithash(initdat, *spec))
+
+    # new dictionary with a different line list
+    initdat = _initdat(tmp_path)
+    initdat['lines'] = ['Halpha']
+    assert not fit_is_current(outlab, fithash(initdat, *spec))
+
+
+def test_resume_invalidated_by_data(tmp_path):
+    initdat = _initdat(tmp_path)
+    wave, flux, err, dq = _spectrum()
+    outlab = str(tmp_path / 'test_0001_0001')
+    save_fit(outlab, {'fithash': fithash(initdat, wave, flux, err, dq)})
+    dq[10] = 1
+    assert not fit_is_current(outlab, fithash(initdat, wave, flux, err, dq))
+
+
+def _make_model(scale):
+    def model(x):
+        return scale*x
+    return model
+
+
+def test_initdathash_functions_by_name(tmp_path):
+    # distinct function objects, at different addresses, in every run
+    initdat = _initdat(tmp_path)
+    initdat['fcnmodel'] = _make_model(1.)
+    before = initdathash(initdat)
+    initdat['fcnmodel'] = _make_model(2.)
+    assert initdathash(initdat) == before
+
+
+def test_initdathash_rejects_unknown_objects(tmp_path):
+    initdat = _initdat(tmp_path)
+    initdat['argsinitpar']['state'] = object()
+    with pytest.raises(InitializationError, match='hashignore'):
+        initdathash(initdat)
+    initdat['hashignore'] = ['argsinitpar']
+    initdathash(initdat)
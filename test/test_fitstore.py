@@ -0,0 +1,53 @@
+import numpy as np
+import os
+
+from types import SimpleNamespace
+
+from q3dfit.common.fitstore import FITSTORE, create_store, store_path
+
+
+def _initdat(tmp_path):
+    return {'label': 'test', 'outdir': str(tmp_path) + '/',
+            'noemlinfit': True}
+
+
+def _cube():
+    wave = np.linspace(6400., 6700., 31)
+    return SimpleNamespace(wave=wave, dat=np.zeros((2, 1, len(wave))),
+                           ncols=2, nrows=1)
+
+
+def _struct(wave, coeff):
+    spec = np.ones(len(wave))
+    struct = {'fitran_indx': np.arange(len(wave)), 'noemlinfit': True,
+              'noemlinmask': b'0', 'siglim': None, 'param': 0,
+              'perror': 0, 'gd_indx': np.arange(len(wave)), 'ct_indx': 0,
+              'ct_coeff': coeff}
+    for key in ['spec', 'spec_err', 'cont_dat', 'cont_fit',
+                'cont_fit_pretweak', 'emlin_dat', 'emlin_fit']:
+        struct[key] = spec
+    for key in ['zstar', 'zstar_err', 'ct_ebv', 'ct_ppxf_sigma',
+                'ct_ppxf_sigma_err', 'ct_rchisq', 'redchisq', 'nfev', 'bic',
+                'aic']:
+        struct[key] = 1.
+    return struct
+
+
+def test_writers_with_different_keys(tmp_path):
+    # e.g. MPI workers with the same process ID on different nodes
+    initdat = _initdat(tmp_path)
+    cube = _cube()
+    path = create_store(initdat, cube)
+    for i, key in enumerate(['node0-100', 'node1-100']):
+        store = FITSTORE(path, mode='r+', key=key)
+        store.write(i, 0, _struct(cube.wave, {'writer': key}), 'hash')
+        store.close()
+    assert sorted(f for f in os.listdir(path) if f.endswith('.pkl')) \
+        == ['extras_node0-100.pkl', 'extras_node1-100.pkl']
+
+    store = FITSTORE(store_path(initdat))
+    for i, key in enumerate(['node0-100', 'node1-100']):
+        assert store.is_current(i, 0, 'hash')
+        struct = store.read(i, 0, cube.wave)
+        assert struct['ct_coeff'] == {'writer': key}
+        assert struct['ct_indx'] == 0
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from astropy.table import Table
+
+from q3dfit.common.linejac import linejac
+from q3dfit.init.parinit import parinit
+
+lines = ['Halpha', '[NII]6583', '[NII]6548']
+waves = [6562.80, 6583.45, 6548.05]
+ncomp = {line: 2 for line in lines}
+
+
+def _model(nsigwin):
+    # [NII] tied to Halpha in wavelength and width, [NII]6548 to [NII]6583
+    # by the doublet ratio, and [NII]6583 to Halpha by a free line ratio
+    linelist = Table({'name': lines, 'lines': waves})
+    linelistz = {line: np.array([wave, wave - 2.])
+                 for line, wave in zip(lines, waves)}
+    linetie = {line: 'Halpha' for line in lines}
+    initflux = {line: np.array([1., 0.5]) for line in lines}
+    initsig = {line: np.array([150., 400.]) for line in lines}
+    lineratio = Table({'line1': ['[NII]6583'], 'line2': ['Halpha'],
+                       'comp': [0], 'lower': [0.], 'upper': [10.]})
+    return parinit(linelist, linelistz, linetie, initflux, initsig, 2,
+                   ncomp, None, lineratio=lineratio, specres=1.,
+                   nsigwin=nsigwin)[:2]
+
+
+def _weighted_model(model, params, varnames, x, weights, xvals):
+    params = params.copy()
+    for name, val in zip(varnames, xvals):
+        params[name].value = val
+    params.update_constraints()
+    return model.eval(params, x=x)*weights
+
+
+@pytest.mark.parametrize('nsigwin', [None, 10.])
+def test_linejac_matches_numerical(nsigwin):
+    model, params = _model(nsigwin)
+    x = np.linspace(6500., 6650., 601)
+    weights = np.random.default_rng(3).uniform(0.5, 2., x.size)
+    jac = linejac(model, params, x, weights)
+    assert jac is not None
+
+    varnames = [name for name, par in params.items()
+                if par.vary and not par.expr]
+    assert 'lbNIIrb6583_div_Halpha_0' in varnames
+    # away from the initial values, and from the limits
+    xvals = np.array([params[name].value for name in varnames])
+    for k, name in enumerate(varnames):
+        if name.endswith('_cwv'):
+            xvals[k] += 0.5
+        elif name.endswith('_sig'):
+            xvals[k] *= 1.2
+        else:
+            xvals[k] *= 1.3
+
+    analytic = jac(xvals)
+    numerical = np.zeros_like(analytic)
+    for k in range(len(varnames)):
+        step = 1e-6*max(abs(xvals[k]), 1.)
+        hi = xvals.copy()
+        hi[k] += step
+        lo = xvals.copy()
+        lo[k] -= step
+        numerical[:, k] = \
+            (_weighted_model(model, params, varnames, x, weights, hi) -
+             _weighted_model(model, params, varnames, x, weights, lo)) / \
+            (2.*step)
+    scale = np.abs(numerical).max(axis=0)
+    assert np.all(scale > 0)
+    assert np.all(np.abs(analytic - numerical).max(axis=0) < 1e-5*scale)
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from ppxf.ppxf_util import log_rebin
+
+from q3dfit.common import logrebin as lr
+
+
+@pytest.mark.parametrize('lamrange, npix', [([6400., 6700.], 301),
+                                            ([4000., 9000.], 3000),
+                                            ([1., 5.], 7)])
+def test_operator_matches_log_rebin(lamrange, npix):
+    spec = np.random.default_rng(npix).normal(size=(npix, 3))
+    expected, lnlam, velscale = log_rebin(np.array(lamrange), spec)
+    rebinned, oplnlam, opvelscale = lr.log_rebin_spectra(lamrange, spec)
+    assert np.allclose(rebinned, expected, rtol=0., atol=1e-12)
+    assert np.array_equal(oplnlam, lnlam)
+    assert np.isclose(opvelscale, velscale, rtol=1e-14)
+
+
+def test_operator_is_sparse_and_cached():
+    op, _, _ = lr.log_rebin_operator([4000., 9000.], 3000)
+    # each log pixel overlaps at most a few linear pixels
+    assert op.nnz < 4*3000
+    assert lr.log_rebin_operator([4000., 9000.], 3000)[0] is op
@@ -0,0 +1,112 @@
+import copy
+import numpy as np
+
+from astropy.table import Table
+from types import SimpleNamespace
+
+from q3dfit.common.checkpoint import fithash, save_fit, spaxel_spectrum
+from q3dfit.common.neighborseed import apply_seed, neighbor_seed, \
+    seed_wavelengths
+from q3dfit.init.parinit import parinit
+
+c = 299792.458
+zinit = 0.011
+ztrue = 0.0115
+sigtrue = 250.
+
+
+def _initdat(tmp_path, lines=['Halpha']):
+    return {'label': 'test', 'outdir': str(tmp_path) + '/',
+            'lines': list(lines), 'maxncomp': 1, 'neighborseed': True}
+
+
+def _spectrum(wave):
+    cwv = 6562.80*(1. + ztrue)
+    sig = sigtrue/c*cwv
+    return np.exp(-0.5*((wave - cwv)/sig)**2)
+
+
+def _cube():
+    wave = np.linspace(6550., 6750., 401)
+    dat = np.zeros((3, 3, len(wave))) + _spectrum(wave)
+    return SimpleNamespace(wave=wave, dat=dat, err=np.full(dat.shape, 0.01),
+                           dq=np.zeros(dat.shape), ncols=3, nrows=3,
+                           col0=0, row0=0)
+
+
+def _neighbor_struct():
+    return {'redchisq': 1., 'zstar': np.nan,
+            'param': {'Halpha_0_cwv': 6562.80*(1. + ztrue) + 0.3,
+                      'Halpha_0_sig': sigtrue - 10.}}
+
+
+def _write_neighbor(initdat, cube, i, j):
+    struct = _neighbor_struct()
+    struct['fithash'] = \
+        fithash(initdat, cube.wave, *spaxel_spectrum(cube, i, j))
+    save_fit('{[outdir]}{[label]}_{:04d}_{:04d}'.format(initdat, initdat,
+                                                        i+1, j+1), struct)
+
+
+def test_current_neighbor_is_used(tmp_path):
+    cube = _cube()
+    initdat = _initdat(tmp_path)
+    _write_neighbor(initdat, cube, 0, 1)
+    seed = neighbor_seed(cube, initdat, 1, 1)
+    assert seed is not None
+    assert seed['param'] == _neighbor_struct()['param']
+
+
+def test_stale_neighbor_is_ignored(tmp_path):
+    cube = _cube()
+    # neighbor fit by a run with a different line list
+    _write_neighbor(_initdat(tmp_path, lines=['Halpha', '[NII]6583']),
+                    cube, 0, 1)
+    assert neighbor_seed(cube, _initdat(tmp_path), 1, 1) is None
+
+
+def test_stale_neighbor_data_is_ignored(tmp_path):
+    cube = _cube()
+    initdat = _initdat(tmp_path)
+    _write_neighbor(initdat, cube, 0, 1)
+    cube.dq[0, 1, 10] = 1
+    assert neighbor_seed(cube, initdat, 1, 1) is None
+
+
+def _fit(cwvinit=None, siginit=100.):
+    cube = _cube()
+    wave = cube.wave
+    flux = cube.dat[1, 1]
+    linelist = Table({'name': ['Halpha'], 'lines': [6562.80]})
+    listlinesz = {'Halpha': np.array([6562.80*(1. + zinit)])}
+    ncomp = {'Halpha': 1}
+    totmod, params, _ = \
+        parinit(linelist, listlinesz, {'Halpha': 'Halpha'},
+                {'Halpha': np.array([1.])}, {'Halpha': np.array([siginit])},
+                1, ncomp, None)
+    if cwvinit is not None:
+        seed_wavelengths(params, cwvinit, ncomp)
+    start = copy.deepcopy(params)
+    result = totmod.fit(flux, params, x=wave, method='least_squares')
+    return start, result
+
+
+def test_seed_keeps_limits_and_reduces_nfev(tmp_path):
+    initdat = _initdat(tmp_path)
+    listlinesz = {'Halpha': np.array([6562.80*(1. + zinit)])}
+    cwvinit, siginit, _ = \
+        apply_seed(_neighbor_struct(), initdat, {'Halpha': 1}, listlinesz,
+                   False, np.nan)
+    # the unseeded guesses are left alone
+    assert listlinesz['Halpha'][0] == 6562.80*(1. + zinit)
+
+    start0, fit0 = _fit()
+    start1, fit1 = _fit(cwvinit, siginit['Halpha'][0])
+    for name in start0:
+        assert start0[name].min == start1[name].min
+        assert start0[name].max == start1[name].max
+    assert start1['Halpha_0_cwv'].value == cwvinit['Halpha'][0]
+    for fit in [fit0, fit1]:
+        assert np.isclose(fit.params['Halpha_0_cwv'].value,
+                          6562.80*(1. + ztrue), rtol=1e-6)
+    assert fit1.nfev < fit0.nfev
@@ -0,0 +1,28 @@
+import numpy as np
+
+from astropy.table import Table
+
+from q3dfit.init.parinit import parinit
+
+lines = ['Halpha', '[NII]6583', '[NII]6548']
+waves = [6562.80, 6583.45, 6548.05]
+
+
+def _parinit(flux):
+    linelist = Table({'name': lines, 'lines': waves})
+    return parinit(linelist, {line: np.array([wave])
+                              for line, wave in zip(lines, waves)},
+                   {line: 'Halpha' for line in lines},
+                   {line: np.array([flux]) for line in lines},
+                   {line: np.array([100.]) for line in lines},
+                   1, {line: 1 for line in lines}, None)[1]
+
+
+def test_cached_model_keeps_ties():
+    # the second call reuses the cached model and parameter template
+    for flux in [1., 2.]:
+        params = _parinit(flux)
+        assert params['lbNIIrb6548_0_flx'].expr == 'lbNIIrb6583_0_flx/3.'
+        assert params['lbNIIrb6583_0_sig'].expr == 'Halpha_0_sig'
+        assert not params['lbNIIrb6583_0_sig'].vary
+        assert np.isclose(params['lbNIIrb6548_0_flx'].value, flux/3.)
@@ -0,0 +1,63 @@
+import numpy as np
+
+from scipy.interpolate import interp1d
+
+from q3dfit.common import spectConvol as sc
+
+inst = 'JWST_NIRSPEC'
+grat = 'G140M'
+
+
+def _convolver():
+    initdat = {'spect_convol': {'ws_instrum': {inst: [grat]},
+                                'ws_method': 2},
+               'argsreadcube': {'waveunit_in': 'micron'}}
+    return sc.spectConvol(initdat)
+
+
+def _grid(so, lo=0.2, hi=0.4, npix=600):
+    wvlo, wvhi = so.init_inst[inst][grat]['gwvRng']
+    return np.linspace(wvlo + lo*(wvhi-wvlo), wvlo + hi*(wvhi-wvlo), npix)
+
+
+def _expected(so, wave, flux):
+    # gaussian_filter1d_ppxf within the grating's range, as spect_convolver
+    # computes it without the operator
+    gwave = so.init_inst[inst][grat]['gwave']
+    fwhm = interp1d(gwave, so.init_inst[inst][grat]['gdwvn'])(wave)
+    return so.gaussian_filter1d_ppxf(wave, flux, fwhm)
+
+
+def test_operator_matches_ppxf_filter():
+    so = _convolver()
+    wave = _grid(so)
+    flux = np.random.default_rng(1).normal(size=wave.size)
+    op = so.get_operator(wave, inst, grat)
+    assert np.allclose(op @ flux, _expected(so, wave, flux))
+
+
+def test_operator_identity_outside_grating():
+    so = _convolver()
+    wvlo, wvhi = so.init_inst[inst][grat]['gwvRng']
+    wave = np.linspace(wvlo - 0.05*(wvhi-wvlo), wvlo + 0.2*(wvhi-wvlo), 600)
+    flux = np.random.default_rng(2).normal(size=wave.size)
+    conv = so.get_operator(wave, inst, grat) @ flux
+    out = wave < wvlo
+    assert np.array_equal(conv[out], flux[out])
+    inside = ~out
+    assert np.allclose(conv[inside], _expected(so, wave[inside], flux[inside]))
+
+
+def test_operator_cache_is_bounded_and_reused():
+    so = _convolver()
+    wave = _grid(so)
+    op = so.get_operator(wave, inst, grat)
+    # same array, and an equal copy
+    assert so.get_operator(wave, inst, grat) is op
+    assert so.get_operator(wave.copy(), inst, grat) is op
+    # many distinct grids, as from spaxels with different masks
+    grids = [np.delete(wave, k) for k in range(2*sc._maxoperators)]
+    for grid in grids:
+        so.get_operator(grid, inst, grat)
+    assert len(so.operators) <= sc._maxoperators
+    assert len(so.gridoperators) <= sc._maxoperators